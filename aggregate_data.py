@@ -0,0 +1,694 @@
+#!/usr/bin/env python
+"""
+Streaming NO2 averages over time windows.
+
+Merge_and_Mean.ipynb combines every granule into one cube and then builds
+the daily, weekly, weekday, monthly and hourly means with xarray
+resample/groupby, which keeps the whole cube around and recomputes it for
+every window that is looked at. Here each granule is read once, in time
+order, and added to a running per-cell sum and count of its valid values for
+every window it falls in. The mean is sum / count, the same as xarray's
+NaN-skipping mean.
+
+Windows that follow time (daily, weekly, monthly) are written out as soon as
+a granule from a later window arrives, so only the current one is held.
+Cyclic windows (weekday, hourly) stay open until the end; with --scratch-dir
+their accumulators are memmaps on disk instead of in memory.
+
+With --store the accumulators are kept between runs (AggregateStore) and
+only granules the store has not seen are read, so a new day of data
+updates the layers without going back over the old ones:
+
+    python aggregate_data.py -d data/2024.11.26 --store aggregated/store -o aggregated
+
+The results go to <output>/<aggregation>_avg.zarr (or .nc), one NO2 mean
+and one count per window, with the notebook's names and chunking:
+
+    python aggregate_data.py -d data -o aggregated -a daily weekly hourly --format zarr
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import sqlite3
+import sys
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+import numpy as np
+import tqdm
+
+from logger import setup_logging, set_log_level
+from tempo_process_funcs import fname_to_datetime64
+
+logger = setup_logging(debug=False, name="aggregate_data")
+
+# the notebook's no2_norm: means are written in units of 10^14 molecules/cm^2
+DEFAULT_NORM = 10**14
+# read_granule returns NO2 in units of 10^16 molecules/cm^2
+READ_SCALE = 10**16
+# output chunks along (latitude, longitude), as in the notebook
+SPATIAL_CHUNKS = (373, 188)
+FORMATS = {"zarr": ".zarr", "netcdf": ".nc"}
+
+
+def day(time: np.datetime64) -> np.datetime64:
+    return np.datetime64(time, "D")
+
+
+def weekday(time: np.datetime64) -> int:
+    # 1970-01-01 was a Thursday, Monday is 0 as in pandas
+    return int((day(time).astype(np.int64) + 3) % 7)
+
+
+def week_end(time: np.datetime64) -> np.datetime64:
+    """
+    The Sunday ending time's week, pandas' label for resample("1W")
+    """
+    return day(time) + np.timedelta64(6 - weekday(time), "D")
+
+
+def month_end(time: np.datetime64) -> np.datetime64:
+    """
+    The last day of time's month, pandas' label for resample("1M")
+    """
+    return (np.datetime64(time, "M") + 1).astype("datetime64[D]") - 1
+
+
+def hour(time: np.datetime64) -> int:
+    return int(np.datetime64(time, "h").astype(np.int64) % 24)
+
+
+class Aggregation(NamedTuple):
+    dim: str
+    key: Callable[[np.datetime64], object]
+    # cyclic windows can receive granules at any point in the pass
+    cyclic: bool
+
+
+AGGREGATIONS = {
+    "daily": Aggregation("time", day, False),
+    # Monday to Sunday, the ISO week, labelled by its Sunday
+    "weekly": Aggregation("time", week_end, False),
+    "monthly": Aggregation("time", month_end, False),
+    "weekday": Aggregation("weekday", weekday, True),
+    "hourly": Aggregation("hour", hour, True),
+}
+
+
+def parse_label(dim: str, text: str):
+    """
+    Inverse of str(key) for the window keys of an aggregation along dim
+    """
+    return np.datetime64(text, "D") if dim == "time" else int(text)
+
+
+class WindowSums:
+    """
+    Running per-cell sum and count (and with variance, sum of squares) of
+    the valid values of each window.
+
+    :arg shape: (latitude, longitude) grid shape
+    :kwarg scratch_dir: keep the accumulators in .npy memmaps here instead of memory
+    :kwarg keep: leave the memmaps in scratch_dir when a window is dropped
+        and reopen them when it is added to again, see AggregateStore
+    :kwarg variance: also accumulate the sum of squares
+    """
+
+    def __init__(
+        self, name: str, shape: tuple, scratch_dir: Path | None = None, keep: bool = False, variance: bool = False
+    ):
+        self.name = name
+        self.shape = tuple(shape)
+        self.scratch_dir = Path(scratch_dir) if scratch_dir is not None else None
+        self.keep = keep and self.scratch_dir is not None
+        self.variance = variance
+        self.sums: dict = {}
+        self.counts: dict = {}
+        self.squares: dict = {}
+
+    def __contains__(self, key) -> bool:
+        return key in self.sums
+
+    def keys(self) -> list:
+        return sorted(self.sums)
+
+    def path(self, key, kind: str) -> Path:
+        return self.scratch_dir / f"{self.name}_{str(key).replace(':', '')}_{kind}.npy"
+
+    def stored_keys(self, dim: str) -> list:
+        """
+        Keys with accumulators in scratch_dir, open or not
+        """
+        if self.scratch_dir is None or not self.scratch_dir.is_dir():
+            return []
+        prefix, suffix = f"{self.name}_", "_count.npy"
+        names = [p.name for p in self.scratch_dir.glob(f"{prefix}*{suffix}")]
+        return sorted(parse_label(dim, name[len(prefix):-len(suffix)]) for name in names)
+
+    def _zeros(self, key, kind: str, dtype) -> np.ndarray:
+        if self.scratch_dir is None:
+            return np.zeros(self.shape, dtype=dtype)
+        self.scratch_dir.mkdir(parents=True, exist_ok=True)
+        path = self.path(key, kind)
+        if self.keep and path.exists():
+            array = np.lib.format.open_memmap(path, mode="r+")
+            if array.shape != self.shape or array.dtype != dtype:
+                raise ValueError(f"{path} holds {array.dtype} {array.shape}, expected {np.dtype(dtype)} {self.shape}")
+            return array
+        # a new memmap is zero filled
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=self.shape)
+
+    def open(self, key) -> None:
+        if key not in self.sums:
+            self.sums[key] = self._zeros(key, "sum", np.float64)
+            self.counts[key] = self._zeros(key, "count", np.uint32)
+            if self.variance:
+                self.squares[key] = self._zeros(key, "sumsq", np.float64)
+
+    def add(self, key, data: np.ndarray) -> None:
+        self.open(key)
+        valid = ~np.isnan(data)
+        filled = np.where(valid, data, 0)
+        self.sums[key] += filled
+        self.counts[key] += valid
+        if self.variance:
+            self.squares[key] += filled * filled
+
+    def mean(self, key) -> tuple[np.ndarray, np.ndarray, np.ndarray | None]:
+        """
+        returns: (mean, count, standard deviation or None), NaN where nothing was valid
+        """
+        self.open(key)
+        count = np.asarray(self.counts[key])
+        std = None
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.sums[key] / count
+            if self.variance:
+                # population variance, as xarray's std; rounding can push it just below 0
+                std = np.sqrt(np.maximum(self.squares[key] / count - mean * mean, 0))
+        return mean, count, std
+
+    def flush(self) -> None:
+        for arrays in (self.sums, self.counts, self.squares):
+            for array in arrays.values():
+                if isinstance(array, np.memmap):
+                    array.flush()
+
+    def pop(self, key) -> None:
+        arrays = [self.sums.pop(key), self.counts.pop(key), self.squares.pop(key, None)]
+        for array in arrays:
+            if isinstance(array, np.memmap):
+                if self.keep:
+                    array.flush()
+                else:
+                    os.remove(array.filename)
+
+
+class AggregateWriter:
+    """
+    Writes one window at a time to <path>.
+
+    mode "w": a new file, written as <path>.part and moved into place by close()
+    mode "a": update an existing file in place, overwriting windows it
+        already has and appending later ones
+
+    :arg dim: "time" or the cyclic key's dimension
+    :arg coords: {"latitude": values, "longitude": values}
+    :kwarg fmt: "zarr" or "netcdf"
+    :kwarg norm: NO2 is written in units of norm molecules/cm^2
+    """
+
+    def __init__(
+        self, path: Path, dim: str, coords: dict, fmt: str = "zarr", norm: float = DEFAULT_NORM, mode: str = "w"
+    ):
+        self.path = Path(path)
+        self.dim = dim
+        self.coords = coords
+        self.fmt = fmt
+        self.norm = norm
+        self.mode = mode
+        self.written = 0
+        self.nc = None
+        if mode == "w":
+            self.target = self.path.with_name(self.path.name + ".part")
+            remove_path(self.target)
+            self.labels = []
+        else:
+            self.target = self.path
+            self.labels = existing_labels(self.path, dim, fmt)
+
+    def attrs(self) -> dict:
+        return {"units": f"{self.norm:.0e} molecules/cm^2", "long_name": "mean tropospheric NO2 vertical column"}
+
+    def can_write(self, labels) -> bool:
+        """
+        True if labels (ascending) are all existing windows or come after the last one
+        """
+        last = self.labels[-1] if self.labels else None
+        return all(label in self.labels or last is None or label > last for label in labels)
+
+    def write(self, label, mean: np.ndarray, count: np.ndarray, std: np.ndarray | None = None) -> None:
+        if not self.can_write([label]):
+            raise ValueError(f"Cannot insert {label} before the last window of {self.path}")
+        factor = READ_SCALE / self.norm
+        no2 = (mean * factor).astype(np.float32)
+        std = (std * factor).astype(np.float32) if std is not None else None
+        index = self.labels.index(label) if label in self.labels else len(self.labels)
+        if self.fmt == "zarr":
+            self._write_zarr(index, label, no2, count, std)
+        else:
+            self._write_netcdf(index, label, no2, count, std)
+        if index == len(self.labels):
+            self.labels.append(label)
+        self.written += 1
+
+    def _write_zarr(self, index: int, label, no2: np.ndarray, count: np.ndarray, std: np.ndarray | None) -> None:
+        import xarray as xr
+
+        dims = (self.dim, "latitude", "longitude")
+        data_vars = {"NO2": (dims, no2[None], self.attrs()), "count": (dims, count[None])}
+        if std is not None:
+            data_vars["NO2_std"] = (dims, std[None], {**self.attrs(), "long_name": "standard deviation of NO2"})
+        ds = xr.Dataset(data_vars, coords={self.dim: [label], **self.coords})
+        if not self.labels:
+            chunks = (1,) + tuple(min(c, n) for c, n in zip(SPATIAL_CHUNKS, no2.shape))
+            encoding = {name: {"chunks": chunks} for name in data_vars}
+            ds.to_zarr(self.target, mode="w", encoding=encoding)
+        elif index < len(self.labels):
+            ds = ds.drop_vars(list(self.coords))
+            ds.to_zarr(self.target, region={self.dim: slice(index, index + 1)})
+        else:
+            ds.to_zarr(self.target, append_dim=self.dim)
+
+    def _write_netcdf(self, index: int, label, no2: np.ndarray, count: np.ndarray, std: np.ndarray | None) -> None:
+        from netCDF4 import Dataset
+
+        if self.nc is None and self.labels:
+            self.nc = Dataset(self.target, "a")
+        elif self.nc is None:
+            self.nc = Dataset(self.target, "w")
+            self.nc.createDimension(self.dim, None)
+            for name, values in self.coords.items():
+                self.nc.createDimension(name, len(values))
+                self.nc.createVariable(name, values.dtype, (name,))[:] = values
+            if self.dim == "time":
+                var = self.nc.createVariable("time", "i8", ("time",))
+                var.setncatts({"units": "seconds since 1970-01-01 00:00:00", "calendar": "standard"})
+            else:
+                self.nc.createVariable(self.dim, "i4", (self.dim,))
+            dims = (self.dim, "latitude", "longitude")
+            chunks = (1,) + tuple(min(c, n) for c, n in zip(SPATIAL_CHUNKS, no2.shape))
+            self.nc.createVariable("NO2", "f4", dims, compression="zlib", chunksizes=chunks, fill_value=np.nan)
+            self.nc["NO2"].setncatts(self.attrs())
+            self.nc.createVariable("count", "u4", dims, compression="zlib", chunksizes=chunks)
+            if std is not None:
+                self.nc.createVariable("NO2_std", "f4", dims, compression="zlib", chunksizes=chunks, fill_value=np.nan)
+                self.nc["NO2_std"].setncatts({**self.attrs(), "long_name": "standard deviation of NO2"})
+        if self.dim == "time":
+            self.nc["time"][index] = np.datetime64(label, "s").astype(np.int64)
+        else:
+            self.nc[self.dim][index] = label
+        self.nc["NO2"][index] = no2
+        self.nc["count"][index] = count
+        if std is not None and "NO2_std" in self.nc.variables:
+            self.nc["NO2_std"][index] = std
+
+    def close(self) -> Path | None:
+        """
+        returns: the finished path, None if nothing was written
+        """
+        if self.nc is not None:
+            self.nc.close()
+            self.nc = None
+        if self.written == 0:
+            if self.mode == "w":
+                remove_path(self.target)
+            return None
+        if self.mode == "w":
+            remove_path(self.path)
+            os.replace(self.target, self.path)
+        logger.info(f"Wrote {self.written} windows to {self.path}")
+        return self.path
+
+
+def existing_labels(path: Path, dim: str, fmt: str) -> list:
+    """
+    Window labels already in an output file, in the form the aggregation keys use
+    """
+    import xarray as xr
+
+    if not Path(path).exists():
+        return []
+    with (xr.open_zarr(path) if fmt == "zarr" else xr.open_dataset(path)) as ds:
+        values = ds[dim].values
+    if dim == "time":
+        return [np.datetime64(v, "D") for v in values]
+    return [int(v) for v in values]
+
+
+def remove_path(path: Path) -> None:
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+
+
+def sort_by_scan_time(input_files: list[str]) -> list[str]:
+    """
+    Time order, from the file names, falling back to the name itself
+    """
+    def key(f):
+        time = fname_to_datetime64(f)
+        return (time is None, time if time is not None else np.datetime64(0, "s"), Path(f).name)
+
+    return sorted(input_files, key=key)
+
+
+def aggregate_files(
+    input_files: list[str],
+    output: Path | str,
+    aggregations=tuple(AGGREGATIONS),
+    quality_flag: str = "svs",
+    fmt: str = "zarr",
+    norm: float = DEFAULT_NORM,
+    scratch_dir: Path | str | None = None,
+    variance: bool = False,
+) -> dict[str, Path]:
+    """
+    Mean NO2 per window for each aggregation, in one pass over input_files.
+
+    :arg input_files: granules on one lat/lon grid (others are skipped)
+    :arg output: directory for the <aggregation>_avg files
+    :kwarg aggregations: names from AGGREGATIONS
+    :kwarg quality_flag: as in process_data.py
+    :kwarg fmt: "zarr" or "netcdf"
+    :kwarg norm: NO2 units of the output, in molecules/cm^2
+    :kwarg scratch_dir: hold the accumulators in memmaps here
+    :kwarg variance: also write the standard deviation, NO2_std
+    returns: {aggregation: path written}
+    """
+    from process_data import read_granule
+
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    scratch_dir = Path(scratch_dir) if scratch_dir is not None else None
+
+    grid = None
+    sums: dict[str, WindowSums] = {}
+    writers: dict[str, AggregateWriter] = {}
+    # the last window written for each time-ordered aggregation
+    flushed: dict[str, object] = {}
+
+    def flush(name, before=None):
+        # write (and drop) every window of name that ends before `before`
+        for key in sums[name].keys():
+            if before is not None and key >= before:
+                break
+            writers[name].write(key, *sums[name].mean(key))
+            sums[name].pop(key)
+            flushed[name] = key
+
+    for input_file in tqdm.tqdm(sort_by_scan_time(input_files), desc="Aggregating"):
+        no2, _, _ = read_granule(input_file, quality_flag)
+        no2 = no2.transpose("time", "latitude", "longitude")
+        coords = {dim: no2[dim].values for dim in ("latitude", "longitude")}
+        if grid is None:
+            grid = coords
+            shape = (len(grid["latitude"]), len(grid["longitude"]))
+            for name in aggregations:
+                sums[name] = WindowSums(name, shape, scratch_dir, variance=variance)
+                writers[name] = AggregateWriter(
+                    output / f"{name}_avg{FORMATS[fmt]}", AGGREGATIONS[name].dim, grid, fmt, norm
+                )
+        elif not all(np.array_equal(grid[dim], coords[dim]) for dim in grid):
+            logger.warning(f"Skipping {input_file}: not on the same grid as the first granule")
+            continue
+
+        for i, time in enumerate(no2["time"].values):
+            data = no2.values[i]
+            for name in aggregations:
+                aggregation = AGGREGATIONS[name]
+                key = aggregation.key(time)
+                if not aggregation.cyclic:
+                    if name in flushed and key <= flushed[name]:
+                        logger.warning(f"Skipping {input_file} for {name}: window {key} was already written")
+                        continue
+                    flush(name, before=key)
+                sums[name].add(key, data)
+
+    paths = {}
+    for name in sums:
+        flush(name)
+        path = writers[name].close()
+        if path is not None:
+            paths[name] = path
+    return paths
+
+
+class AggregateStore:
+    """
+    Accumulators persisted on disk per window, so new granules are folded
+    into the windows they belong to without revisiting older ones. Adding a
+    granule touches one day, one week, one month, one weekday and one hour
+    of day, however many granules those windows already hold.
+
+    The aggregations, variance and quality flag are fixed when the store is
+    created; folding with different settings would mix incompatible sums.
+
+    <path>/store.sqlite: settings and the granules already folded in
+    <path>/grid.npz: latitude and longitude of the grid
+    <path>/<aggregation>_<window>_{sum,count,sumsq}.npy: the accumulators
+
+    :arg path: store directory, created if missing
+    :kwarg aggregations, variance, quality_flag: settings of a new store,
+        checked against an existing one (None to use what it has)
+    """
+
+    def __init__(self, path: Path | str, aggregations=None, variance: bool | None = None, quality_flag: str | None = None):
+        self.path = Path(path).expanduser()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path / "store.sqlite")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS granules (name TEXT PRIMARY KEY, scan_time TEXT, folded_at TEXT);
+            """
+        )
+        requested = {
+            "aggregations": ",".join(aggregations) if aggregations is not None else None,
+            "variance": str(int(variance)) if variance is not None else None,
+            "quality_flag": quality_flag,
+        }
+        defaults = {"aggregations": ",".join(AGGREGATIONS), "variance": "0", "quality_flag": "svs"}
+        settings = dict(self.db.execute("SELECT name, value FROM settings"))
+        with self.db:
+            for name, value in requested.items():
+                if name not in settings:
+                    settings[name] = value if value is not None else defaults[name]
+                    self.db.execute("INSERT INTO settings VALUES (?, ?)", (name, settings[name]))
+                elif value is not None and value != settings[name]:
+                    raise ValueError(f"{self.path} was created with {name}={settings[name]}, not {value}")
+        self.aggregations = settings["aggregations"].split(",")
+        self.variance = settings["variance"] == "1"
+        self.quality_flag = settings["quality_flag"]
+
+        self.grid = None
+        if (self.path / "grid.npz").exists():
+            with np.load(self.path / "grid.npz") as grid:
+                self.grid = {dim: grid[dim] for dim in ("latitude", "longitude")}
+        self.sums: dict[str, WindowSums] = {}
+
+    def __repr__(self) -> str:
+        return f"AggregateStore({str(self.path)!r})"
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def window_sums(self, name: str) -> WindowSums:
+        if name not in self.sums:
+            shape = (len(self.grid["latitude"]), len(self.grid["longitude"]))
+            self.sums[name] = WindowSums(name, shape, self.path, keep=True, variance=self.variance)
+        return self.sums[name]
+
+    def folded(self) -> set[str]:
+        return {name for (name,) in self.db.execute("SELECT name FROM granules")}
+
+    def fold(self, input_files: list[str]) -> dict[str, set]:
+        """
+        Add the granules in input_files that are not in the store yet.
+
+        returns: {aggregation: keys of the windows that changed}
+        """
+        from process_data import read_granule
+
+        folded = self.folded()
+        new = [f for f in sort_by_scan_time(input_files) if Path(f).name not in folded]
+        logger.info(f"Folding {len(new)} new granules into {self.path} ({len(input_files) - len(new)} already in)")
+        touched: dict[str, set] = {name: set() for name in self.aggregations}
+        for input_file in tqdm.tqdm(new, desc="Folding"):
+            no2, _, _ = read_granule(input_file, self.quality_flag)
+            no2 = no2.transpose("time", "latitude", "longitude")
+            coords = {dim: no2[dim].values for dim in ("latitude", "longitude")}
+            if self.grid is None:
+                self.grid = coords
+                np.savez(self.path / "grid.npz", **coords)
+            elif not all(np.array_equal(self.grid[dim], coords[dim]) for dim in self.grid):
+                logger.warning(f"Skipping {input_file}: not on the grid of {self.path}")
+                continue
+
+            for i, time in enumerate(no2["time"].values):
+                for name in self.aggregations:
+                    aggregation = AGGREGATIONS[name]
+                    key = aggregation.key(time)
+                    sums = self.window_sums(name)
+                    if not aggregation.cyclic:
+                        # granules arrive in time order, earlier windows are done for now
+                        for done in [k for k in sums.keys() if k < key]:
+                            sums.pop(done)
+                    sums.add(key, no2.values[i])
+                    touched[name].add(key)
+            # the sums are on disk before the granule counts as folded
+            for sums in self.sums.values():
+                sums.flush()
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO granules VALUES (?, ?, datetime('now'))",
+                    (Path(input_file).name, str(no2["time"].values[0])),
+                )
+        for sums in self.sums.values():
+            for key in sums.keys():
+                sums.pop(key)
+        return touched
+
+    def export(
+        self, output: Path | str, fmt: str = "zarr", norm: float = DEFAULT_NORM, touched: dict | None = None
+    ) -> dict[str, Path]:
+        """
+        Write the mean of each window to <output>/<aggregation>_avg.zarr (or .nc).
+        With touched, an existing file only has those windows rewritten or
+        appended; anything else (a missing file, a window older than its
+        last one) rewrites the whole file from the store.
+
+        returns: {aggregation: path written}
+        """
+        output = Path(output)
+        output.mkdir(parents=True, exist_ok=True)
+        paths = {}
+        if self.grid is None:
+            return paths
+        for name in self.aggregations:
+            dim = AGGREGATIONS[name].dim
+            sums = self.window_sums(name)
+            path = output / f"{name}_avg{FORMATS[fmt]}"
+            keys = sorted(touched.get(name, ())) if touched is not None else None
+            writer = AggregateWriter(path, dim, self.grid, fmt, norm, mode="a") if keys is not None and path.exists() else None
+            if writer is None or not writer.can_write(keys):
+                writer = AggregateWriter(path, dim, self.grid, fmt, norm)
+                keys = sums.stored_keys(dim)
+            for key in keys:
+                writer.write(key, *sums.mean(key))
+                sums.pop(key)
+            written = writer.close()
+            if written is not None:
+                paths[name] = written
+        return paths
+
+
+def update_store(
+    input_files: list[str],
+    store: Path | str,
+    output: Path | str | None = None,
+    fmt: str = "zarr",
+    norm: float = DEFAULT_NORM,
+    **settings,
+) -> dict[str, set]:
+    """
+    Fold the new granules of input_files into the store and, with output,
+    update the mean files for the windows that changed.
+
+    :kwarg settings: aggregations, variance, quality_flag, see AggregateStore
+    returns: {aggregation: keys of the windows that changed}
+    """
+    with AggregateStore(store, **settings) as aggregates:
+        touched = aggregates.fold(input_files)
+        if output is not None and any(touched.values()):
+            aggregates.export(output, fmt, norm, touched)
+    return touched
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Average TEMPO NO2 over time windows")
+    parser.add_argument("-d", "--directory", type=str, help="Directory containing TEMPO data", default="./data")
+    parser.add_argument(
+        "-i", "--input", type=str, help="Input files pattern", default="TEMPO_NO2_L3_V0*_S*.nc"
+    )
+    parser.add_argument("-o", "--output", type=str, help="Output directory", default="aggregated")
+    parser.add_argument(
+        "-a",
+        "--aggregations",
+        type=str,
+        nargs="+",
+        choices=list(AGGREGATIONS),
+        default=None,
+        help="Windows to average over (default: all, or the store's)",
+    )
+    parser.add_argument("--format", type=str, choices=list(FORMATS), default="zarr", help="Output format")
+    parser.add_argument("-q", "--quality", type=str, help="Quality flag for data (default: svs, or the store's)", default=None)
+    parser.add_argument("--norm", type=float, help="Output NO2 units, molecules/cm^2", default=DEFAULT_NORM)
+    parser.add_argument("--scratch-dir", type=str, help="Keep accumulators in memmaps here", default=None)
+    parser.add_argument(
+        "--store",
+        type=str,
+        help="Persistent accumulator store: fold in only granules it has not seen and update the outputs",
+        default=None,
+    )
+    parser.add_argument("--variance", action="store_true", help="Also keep sums of squares (new stores only)")
+    parser.add_argument("--rewrite", action="store_true", help="With --store, rewrite every output from the store")
+    parser.add_argument("--debug", action="store_true", help="Verbose output")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_arguments()
+    set_log_level(args.debug)
+    input_files = glob.glob(f"{args.directory}/{args.input}")
+    if args.store is not None:
+        try:
+            store = AggregateStore(args.store, args.aggregations, args.variance or None, args.quality)
+        except ValueError as e:
+            logger.error(str(e))
+            sys.exit(1)
+        with store:
+            touched = store.fold(input_files)
+            if args.rewrite:
+                store.export(args.output, args.format, args.norm)
+            elif any(touched.values()):
+                store.export(args.output, args.format, args.norm, touched)
+        return
+    if not input_files:
+        logger.error(f"No files matching {args.input} in {args.directory}")
+        return
+    aggregations = args.aggregations or list(AGGREGATIONS)
+    logger.info(f"Aggregating {len(input_files)} files into {', '.join(aggregations)}")
+    aggregate_files(
+        input_files,
+        args.output,
+        aggregations,
+        quality_flag=args.quality or "svs",
+        fmt=args.format,
+        norm=args.norm,
+        scratch_dir=args.scratch_dir,
+        variance=args.variance,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+Pack a day's image frames into one delta-encoded animated PNG.
+
+The viewer's time slider steps through tens of tempo_<time>.png frames per
+day, each a complete PNG. animate_day writes them as a single APNG in which
+the first frame (and every keyframe_interval-th frame after it) is a whole
+image and every other frame is only the rectangle that changed since the
+frame before it. Inside that rectangle, pixels that did not change are
+written as the transparent palette entry and composited over the previous
+frame (APNG blend_op OVER), which deflate stores in a few bytes.
+
+This only pays off when consecutive frames share most of their pixels, as in
+cumulative composites where each scan paints over one swath. The per-granule
+frames process_data.py renders differ nearly everywhere, and pixels that turn
+transparent (clouds, missing data) force the whole rectangle to SOURCE, so
+their animation is about as large as the PNGs it replaces; animate_day logs
+a warning when that happens.
+
+Next to each animation a JSON index gives the time of every frame (in the
+times file's units) and the byte span of its chunks, so the viewer can
+fetch frames with HTTP range requests and seek from the nearest keyframe.
+Browsers play the file as an ordinary <img>, and decoders without APNG
+support show the first frame.
+
+    python animate_frames.py -d images --days 2024-05-01
+    python animate_frames.py -d images -o images/animations --keyframe-interval 6
+"""
+
+import argparse
+import json
+import os
+import re
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from logger import setup_logging, set_log_level
+from png_encoder import BLEND_OVER, BLEND_SOURCE, ApngFrame, encode_apng, quantize_rgba
+from tempo_process_funcs import datetime64_to_jstime
+
+logger = setup_logging(debug=False, name="animate_frames")
+
+ANIMATION_DIRECTORY = "animations"
+DELAY_MS = 500
+PART_SUFFIX = ".part"
+
+
+def frame_pattern(suffix: str = "") -> re.Pattern:
+    """
+    tempo_2024-05-01T12h00m<suffix>.png, capturing the day and the time
+    """
+    return re.compile(rf"^tempo_(\d{{4}}-\d{{2}}-\d{{2}})T(\d{{2}}h\d{{2}}m){re.escape(suffix)}\.png$")
+
+
+def find_frames(directory: Path | str, suffix: str = "") -> dict[str, list[Path]]:
+    """
+    Frames in directory grouped by UTC day, each day sorted by time
+    """
+    pattern = frame_pattern(suffix)
+    days = defaultdict(list)
+    for name in sorted(os.listdir(directory)):
+        match = pattern.match(name)
+        if match:
+            days[match.group(1)].append(Path(directory) / name)
+    return dict(days)
+
+
+def frame_time(path: Path, suffix: str = "") -> np.datetime64:
+    day, time = frame_pattern(suffix).match(path.name).groups()
+    return np.datetime64(datetime.strptime(f"{day}T{time}", "%Y-%m-%dT%Hh%Mm"), "s")
+
+
+def read_frame(path: Path | str) -> tuple[np.ndarray, np.ndarray | None]:
+    """
+    returns: (indices, RGBA palette) for an indexed PNG, (RGBA image, None) otherwise
+    """
+    with Image.open(path) as image:
+        if image.mode != "P":
+            return np.asarray(image.convert("RGBA")), None
+        indices = np.asarray(image)
+        rgb = np.array(image.getpalette("RGB"), dtype=np.uint8).reshape(-1, 3)
+        alpha = np.full(len(rgb), 255, dtype=np.uint8)
+        transparency = image.info.get("transparency")
+        if isinstance(transparency, bytes):
+            alpha[: len(transparency)] = np.frombuffer(transparency, dtype=np.uint8)[: len(rgb)]
+        elif transparency is not None:
+            alpha[transparency] = 0
+    return indices, np.column_stack([rgb, alpha])
+
+
+def shared_palette(frames: list[tuple[np.ndarray, np.ndarray | None]]) -> tuple[list[np.ndarray], np.ndarray]:
+    """
+    Put every frame on one palette. Frames written by save_image_lut already
+    share the colormap's palette; anything else is converted to RGBA and
+    quantized together, exactly if the day has at most 256 colours.
+
+    returns: (index arrays, (n, 4) palette)
+    """
+    first = frames[0][1]
+    if first is not None and all(p is not None and np.array_equal(p, first) for _, p in frames):
+        return [indices for indices, _ in frames], first
+    rgba = [image if palette is None else palette[image] for image, palette in frames]
+    indices, palette = quantize_rgba(np.concatenate(rgba))
+    return np.split(indices, np.cumsum([len(image) for image in rgba])[:-1]), palette
+
+
+def delta_frames(
+    frames: list[np.ndarray], palette: np.ndarray, keyframe_interval: int | None = None
+) -> tuple[list[ApngFrame], list[dict]]:
+    """
+    Replace each frame after the first by the rectangle that changed since
+    the frame before it.
+
+    The rectangle is blended OVER the previous frame only if every changed
+    pixel is opaque; a pixel that turns transparent cannot be drawn over the
+    old one, so the whole rectangle is then stored as SOURCE. Frames that
+    change nearly everywhere therefore shrink little (see the module docstring).
+
+    :arg frames: (height, width) palette indices, one array per frame
+    :kwarg keyframe_interval: store every n-th frame whole (None: only the first)
+    returns: (APNG frames, index entries with the rectangle and kind of each frame)
+    """
+    alpha = palette[:, 3] if palette.shape[1] == 4 else np.full(len(palette), 255, dtype=np.uint8)
+    clear = np.nonzero(alpha == 0)[0]
+    # OVER needs a fully transparent entry for "unchanged" and opaque pixels
+    # for everything that changed, so that they replace what is below them
+    transparent = int(clear[0]) if len(clear) else None
+    opaque = alpha == 255
+
+    apng, entries = [], []
+    previous = None
+    for i, frame in enumerate(frames):
+        height, width = frame.shape
+        if previous is None or (keyframe_interval and i % keyframe_interval == 0):
+            apng.append(ApngFrame(frame))
+            entries.append({"x": 0, "y": 0, "width": width, "height": height, "blend": "source", "keyframe": True})
+            previous = frame
+            continue
+        changed = frame != previous
+        rows, cols = np.nonzero(changed.any(axis=1))[0], np.nonzero(changed.any(axis=0))[0]
+        if len(rows) == 0:
+            # frames need at least one pixel, redraw the top left one
+            y0, y1, x0, x1 = 0, 1, 0, 1
+        else:
+            y0, y1, x0, x1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        region, region_changed = frame[y0:y1, x0:x1], changed[y0:y1, x0:x1]
+        if transparent is not None and opaque[region[region_changed]].all():
+            apng.append(ApngFrame(np.where(region_changed, region, transparent), x0, y0, BLEND_OVER))
+            blend = "over"
+        else:
+            apng.append(ApngFrame(region, x0, y0, BLEND_SOURCE))
+            blend = "source"
+        entries.append(
+            {"x": int(x0), "y": int(y0), "width": int(x1 - x0), "height": int(y1 - y0), "blend": blend, "keyframe": False}
+        )
+        previous = frame
+    return apng, entries
+
+
+def animate_day(
+    paths: list[Path],
+    output: Path | str,
+    suffix: str = "",
+    keyframe_interval: int | None = None,
+    delay_ms: int = DELAY_MS,
+    overwrite=False,
+) -> int:
+    """
+    Pack one day's frames into output (an APNG) and output with .json (its index).
+    Both are written as .part files and moved into place when complete.
+
+    returns: bytes written, 0 if the animation already holds exactly these
+        frames and overwrite is False
+    """
+    output = Path(output)
+    index_path = output.with_suffix(".json")
+    if not overwrite and output.exists() and index_path.exists():
+        with open(index_path) as f:
+            packed = [frame["name"] for frame in json.load(f)["frames"]]
+        if packed == [path.name for path in paths]:
+            logger.debug(f"Animation {output} is up to date. Skipping creation.")
+            return 0
+    output.parent.mkdir(parents=True, exist_ok=True)
+
+    frames, palette = shared_palette([read_frame(path) for path in paths])
+    apng, entries = delta_frames(frames, palette, keyframe_interval)
+    # filter None, as save_image_lut uses for palette images
+    data, spans = encode_apng(apng, palette=palette, delay_ms=delay_ms, compression_filter=0)
+
+    for entry, path, (offset, length) in zip(entries, paths, spans):
+        entry.update(time=datetime64_to_jstime(frame_time(path, suffix)), name=path.name, offset=offset, length=length)
+    index = {
+        "width": int(frames[0].shape[1]),
+        "height": int(frames[0].shape[0]),
+        "delay_ms": delay_ms,
+        # bytes before the first frame, which every decoder needs
+        "header_length": spans[0][0],
+        "frames": entries,
+    }
+
+    for path, content, mode in [(output, data, "wb"), (index_path, json.dumps(index), "w")]:
+        part = path.with_name(path.name + PART_SUFFIX)
+        with open(part, mode) as f:
+            f.write(content)
+        os.replace(part, path)
+    logger.debug(f"Packed {len(paths)} frames into {output} ({len(data) / 2**20:.1f} MB)")
+    frame_bytes = sum(path.stat().st_size for path in paths)
+    if len(data) > 0.8 * frame_bytes:
+        logger.warning(
+            f"{output} is {len(data) / 2**20:.1f} MB, against {frame_bytes / 2**20:.1f} MB for its "
+            "frames: they change nearly everywhere, and the animation only pays off for cumulative composites"
+        )
+    return len(data)
+
+
+def animate_directory(
+    directory: Path | str,
+    output: Path | str | None = None,
+    suffix: str = "",
+    days: list[str] | None = None,
+    keyframe_interval: int | None = None,
+    delay_ms: int = DELAY_MS,
+    overwrite=False,
+) -> list[Path]:
+    """
+    One animation per UTC day of the frames in directory, written to
+    output/tempo_<day><suffix>.png (default output: directory/animations)
+
+    :kwarg days: only these days, YYYY-MM-DD
+    returns: paths of the animations written or already present
+    """
+    directory = Path(directory)
+    output = Path(output) if output is not None else directory / ANIMATION_DIRECTORY
+    found = find_frames(directory, suffix)
+    written = []
+    for day in sorted(found if days is None else set(days) & set(found)):
+        paths = found[day]
+        path = output / f"tempo_{day}{suffix}.png"
+        size = animate_day(paths, path, suffix, keyframe_interval, delay_ms, overwrite)
+        frames = sum(os.path.getsize(p) for p in paths)
+        if size:
+            logger.info(
+                f"{day}: {len(paths)} frames, {frames / 2**20:.1f} MB as PNGs -> {size / 2**20:.1f} MB animation"
+            )
+        written.append(path)
+    return written
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Pack each day's TEMPO image frames into a delta-encoded APNG")
+    parser.add_argument("-d", "--directory", type=str, required=True, help="Directory holding the frames")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Output directory (default: <directory>/animations)")
+    parser.add_argument("--days", type=str, nargs="*", default=None, help="Only these days, YYYY-MM-DD (default: all)")
+    parser.add_argument("--suffix", type=str, help="Suffix of the frame file names", default="")
+    parser.add_argument(
+        "--keyframe-interval", type=int, default=None, help="Store every n-th frame whole (default: only the first)"
+    )
+    parser.add_argument("--delay", type=int, default=DELAY_MS, help="Milliseconds per frame when played")
+    parser.add_argument("--overwrite", action="store_true", help="Overwrite existing animations")
+    parser.add_argument("--debug", help="Enable debug logging", action="store_true")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_arguments()
+    set_log_level(args.debug)
+    animate_directory(
+        args.directory, args.output, args.suffix, args.days, args.keyframe_interval, args.delay, args.overwrite
+    )
+
+
+if __name__ == "__main__":
+    main()
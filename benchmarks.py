@@ -0,0 +1,700 @@
+#!/usr/bin/env python
+"""
+Timing comparisons for the processing pipeline on a synthetic TEMPO-like grid.
+
+    python benchmarks.py reprojection --scale 4
+"""
+import argparse
+import time
+
+import numpy as np
+
+from logger import setup_logging
+
+logger = setup_logging(debug=False, name="benchmarks")
+
+# full TEMPO L3 grid is 2950 x 7750 at 0.02 degrees
+TEMPO_SHAPE = (2950, 7750)
+TEMPO_LAT_MIN, TEMPO_LON_MIN = 14.01, -167.99
+TEMPO_STEP = 0.02
+
+
+def synthetic_granule(scale: int = 4, nan_fraction: float = 0.3, seed: int = 0):
+    """
+    Smooth NO2-like field on the TEMPO grid, downsampled by `scale`, with
+    NaN patches covering roughly `nan_fraction` of it.
+
+    returns: (array, bounds) with bounds as [(lat_min, lon_min), (lat_max, lon_max)]
+    """
+    from scipy import ndimage
+
+    rng = np.random.default_rng(seed)
+    nlat, nlon = TEMPO_SHAPE[0] // scale, TEMPO_SHAPE[1] // scale
+    step = TEMPO_STEP * scale
+    sigma = 20 / scale
+    array = ndimage.gaussian_filter(rng.gamma(2.0, 1.0, size=(nlat, nlon)), sigma)
+    array = 5 * (array - array.min()) / np.ptp(array)
+    patches = ndimage.gaussian_filter(rng.random((nlat, nlon)), sigma)
+    array[patches > np.quantile(patches, 1 - nan_fraction)] = np.nan
+    bounds = [
+        (TEMPO_LAT_MIN, TEMPO_LON_MIN),
+        (TEMPO_LAT_MIN + nlat * step, TEMPO_LON_MIN + nlon * step),
+    ]
+    return array, bounds
+
+
+def timeit(func, repeat: int = 5) -> float:
+    """
+    Best wall time of `repeat` calls, in seconds
+    """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(name: str, baseline: float, new: float) -> None:
+    logger.info(f"{name:<40s} before {baseline*1000:9.1f} ms  after {new*1000:9.1f} ms  speedup {baseline/new:6.1f}x")
+
+
+def bench_reprojection(args: argparse.Namespace) -> None:
+    from tempo_process_funcs import project_array
+
+    array, bounds = synthetic_granule(args.scale)
+    for method in ["average", "nearest"]:
+        for refinement in [1, 0.5]:
+            gdal = lambda: project_array(array, bounds, refinement, method=method, use_plan=False)
+            plan = lambda: project_array(array, bounds, refinement, method=method, use_plan=True)
+            plan()  # build (or load) the plan outside of the timing
+            expected, result = gdal(), plan()
+            valid = ~np.isnan(expected) & ~np.isnan(result)
+            logger.info(
+                f"{method} x{refinement}: max |diff| {np.abs(expected - result)[valid].max():.2e}, "
+                f"NaN mismatch {np.mean(np.isnan(expected) != np.isnan(result)):.2%}"
+            )
+            report(f"project_array {method} x{refinement}", timeit(gdal, args.repeat), timeit(plan, args.repeat))
+
+
+def bench_pyramid(args: argparse.Namespace) -> None:
+    import xarray as xr
+    from tempo_process_funcs import reproject_data
+
+    array, bounds = synthetic_granule(args.scale)
+    data = xr.DataArray(array, dims=("latitude", "longitude"))
+    for use_plan in [False, True]:
+        warps = lambda: reproject_data(data, bounds, use_plan=use_plan)
+        pyramid = lambda: reproject_data(data, bounds, use_plan=use_plan, pyramid=True)
+        (_, expected), (_, result) = warps(), pyramid()
+        valid = ~np.isnan(expected) & ~np.isnan(result)
+        logger.info(
+            f"half resolution: median |diff| {np.median(np.abs(expected - result)[valid]):.2e}, "
+            f"NaN mismatch {np.mean(np.isnan(expected) != np.isnan(result)):.2%}"
+        )
+        report(f"reproject_data use_plan={use_plan}", timeit(warps, args.repeat), timeit(pyramid, args.repeat))
+
+
+def bench_multiband(args: argparse.Namespace) -> None:
+    import xarray as xr
+    from tempo_process_funcs import reproject_bands, reproject_data
+
+    no2, bounds = synthetic_granule(args.scale, seed=0)
+    cloud, _ = synthetic_granule(args.scale, seed=1)
+    bands = {
+        "data": xr.DataArray(no2, dims=("latitude", "longitude")),
+        "cloud": xr.DataArray(cloud, dims=("latitude", "longitude")),
+    }
+    for use_plan in [False, True]:
+        separate = lambda: {name: reproject_data(band, bounds, use_plan=use_plan) for name, band in bands.items()}
+        together = lambda: reproject_bands(bands, bounds, use_plan=use_plan)
+        expected, result = separate(), together()
+        for name in bands:
+            for a, b in zip(expected[name], result[name]):
+                np.testing.assert_allclose(a, b, rtol=1e-9)
+        report(f"NO2 + cloud use_plan={use_plan}", timeit(separate, args.repeat), timeit(together, args.repeat))
+
+
+def bench_png(args: argparse.Namespace) -> None:
+    import os
+    import shutil
+    import tempfile
+    import matplotlib.image as mimg
+    from tempo_process_funcs import (
+        save_image_compressed_command,
+        save_image_compressed_native,
+        svs_tempo_cmap,
+    )
+
+    array, _ = synthetic_granule(args.scale)
+    with tempfile.TemporaryDirectory() as tmp:
+        current = os.path.join(tmp, "current.png")
+        native = os.path.join(tmp, "native.png")
+        palette = os.path.join(tmp, "palette.png")
+        if shutil.which("convert"):
+            baseline = lambda: save_image_compressed_command(array, svs_tempo_cmap, 0.01, 1.5, current, overwrite=True)
+            name = "imsave + convert"
+        else:
+            logger.info("ImageMagick convert not found, comparing against imsave alone")
+            baseline = lambda: mimg.imsave(current, array, cmap=svs_tempo_cmap, vmin=0.01, vmax=1.5, origin="upper")
+            name = "imsave"
+        before = timeit(baseline, args.repeat)
+        after = timeit(lambda: save_image_compressed_native(array, svs_tempo_cmap, 0.01, 1.5, native, overwrite=True), args.repeat)
+        quantized = timeit(lambda: save_image_compressed_native(array, svs_tempo_cmap, 0.01, 1.5, palette, quantize=True, overwrite=True), args.repeat)
+        # settings used by compress_and_diff.sh
+        fast = os.path.join(tmp, "fast.png")
+        fast_time = timeit(lambda: save_image_compressed_native(array, svs_tempo_cmap, 0.01, 1.5, fast, 5, 1, 3, overwrite=True), args.repeat)
+        report(f"{name} vs native RGBA", before, after)
+        report(f"{name} vs native palette", before, quantized)
+        report(f"{name} vs native filter=5 level=1 RLE", before, fast_time)
+        for label, path in [(name, current), ("native RGBA", native), ("native palette", palette), ("native filter=5 level=1 RLE", fast)]:
+            logger.info(f"{label:<40s} {os.path.getsize(path) / 1024:9.1f} kB")
+
+
+def bench_lut(args: argparse.Namespace) -> None:
+    import os
+    import tempfile
+    import matplotlib.image as mimg
+    from colormap import colormap_palette
+    from tempo_process_funcs import (
+        colormap_indices,
+        colormap_rgba,
+        save_image_compressed_native,
+        save_image_lut,
+        svs_tempo_cmap,
+    )
+
+    array, _ = synthetic_granule(args.scale)
+    _, level_to_index = colormap_palette(svs_tempo_cmap)
+    rgba = lambda: colormap_rgba(array, svs_tempo_cmap, 0.01, 1.5)
+    indices = lambda: level_to_index[colormap_indices(array, 0.01, 1.5)]
+    report("colormap RGBA vs palette indices", timeit(rgba, args.repeat), timeit(indices, args.repeat))
+    logger.info(f"rendered image: RGBA {rgba().nbytes / 2**20:.1f} MB, indexed {indices().nbytes / 2**20:.1f} MB")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = {name: os.path.join(tmp, f"{name}.png") for name in ["imsave", "native", "lut"]}
+        imsave = lambda: mimg.imsave(paths["imsave"], array, cmap=svs_tempo_cmap, vmin=0.01, vmax=1.5, origin="upper")
+        native = lambda: save_image_compressed_native(array, svs_tempo_cmap, 0.01, 1.5, paths["native"], overwrite=True)
+        lut = lambda: save_image_lut(array, svs_tempo_cmap, 0.01, 1.5, paths["lut"], overwrite=True)
+        report("imsave vs LUT indexed PNG", timeit(imsave, args.repeat), timeit(lut, args.repeat))
+        report("native RGBA vs LUT indexed PNG", timeit(native, args.repeat), timeit(lut, args.repeat))
+        for name, path in paths.items():
+            logger.info(f"{name:<40s} {os.path.getsize(path) / 1024:9.1f} kB")
+
+
+def write_synthetic_file(filename: str, scale: int = 4, seed: int = 0, time: str = "2024-05-01T12:00:00") -> None:
+    """
+    Write a granule with the TEMPO L3 group layout, including variables the
+    pipeline does not use, so metadata parsing costs are realistic.
+    """
+    import pandas as pd
+    import xarray as xr
+
+    array, bounds = synthetic_granule(scale, seed=seed)
+    (lat_min, lon_min), _ = bounds
+    nlat, nlon = array.shape
+    step = TEMPO_STEP * scale
+    dims = ("time", "latitude", "longitude")
+    rng = np.random.default_rng(seed)
+    field = lambda dtype: (dims, rng.random((1, nlat, nlon)).astype(dtype))
+    root = xr.Dataset(
+        coords={
+            "time": pd.to_datetime([time]),
+            "latitude": lat_min + step * (np.arange(nlat) + 0.5),
+            "longitude": lon_min + step * (np.arange(nlon) + 0.5),
+        },
+        attrs={"time_coverage_start": f"{time}Z", "geospatial_bounds": "POLYGON((0 0,1 0,1 1,0 0))"},
+    )
+    root["weight"] = field(np.float32)
+    groups = {
+        "product": xr.Dataset({
+            "vertical_column_troposphere": (dims, 1e16 * array[None]),
+            "vertical_column_troposphere_uncertainty": field(np.float64),
+            "vertical_column_stratosphere": field(np.float64),
+            "main_data_quality_flag": (dims, rng.integers(0, 3, (1, nlat, nlon)).astype(np.int16)),
+        }),
+        "geolocation": xr.Dataset({
+            "solar_zenith_angle": (dims, 20 + 70 * rng.random((1, nlat, nlon)).astype(np.float32)),
+            "viewing_zenith_angle": field(np.float32),
+            "relative_azimuth_angle": field(np.float32),
+        }),
+        "support_data": xr.Dataset({
+            name: field(np.float32)
+            for name in ["eff_cloud_fraction", "vertical_column_total", "amf_total", "amf_troposphere",
+                         "amf_cloud_fraction", "amf_cloud_pressure", "snow_ice_fraction", "surface_pressure",
+                         "terrain_height", "ground_pixel_quality_flag"]
+        }),
+    }
+    encoding = lambda ds: {name: {"zlib": True, "chunksizes": (1, min(nlat, 500), min(nlon, 500))} for name in ds.data_vars}
+    root.to_netcdf(filename, engine="h5netcdf", encoding=encoding(root))
+    for group, ds in groups.items():
+        ds.to_netcdf(filename, engine="h5netcdf", mode="a", group=group, encoding=encoding(ds))
+
+
+def bench_read(args: argparse.Namespace) -> None:
+    import glob
+    import tempfile
+    from tempo_process_funcs import process_file
+
+    def read(files, lazy):
+        for filename in files:
+            product, _, _, support = process_file(filename, "svs", lazy=lazy)
+            product["vertical_column_troposphere"].to_numpy()
+            support["eff_cloud_fraction"].to_numpy()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = sorted(glob.glob(args.files)) if args.files else []
+        if not files:
+            files = [f"{tmp}/TEMPO_NO2_L3_V03_20240501T120000Z_S001.nc"]
+            write_synthetic_file(files[0], args.scale)
+        read(files, False)  # warm the OS file cache for both
+        lazy = timeit(lambda: read(files, True), args.repeat)
+        eager = timeit(lambda: read(files, False), args.repeat)
+        report(f"process_file x{len(files)}: 4 opens vs 1 handle", lazy, eager)
+        logger.info(f"per file: {lazy / len(files) * 1000:.1f} ms vs {eager / len(files) * 1000:.1f} ms")
+
+
+def bench_mask(args: argparse.Namespace) -> None:
+    import xarray as xr
+    from tempo_process_funcs import QUALITY_LIMITS, mask_granule, quality_mask
+
+    no2, _ = synthetic_granule(args.scale)
+    rng = np.random.default_rng(0)
+    dims = ("time", "latitude", "longitude")
+    shape = (1,) + no2.shape
+    product = xr.Dataset({
+        "vertical_column_troposphere": (dims, 1e16 * no2[None]),
+        "main_data_quality_flag": (dims, rng.integers(0, 3, shape).astype(np.float32)),
+    })
+    geoloc = xr.Dataset({"solar_zenith_angle": (dims, 20 + 70 * rng.random(shape, dtype=np.float32))})
+    support = xr.Dataset({"eff_cloud_fraction": (dims, rng.random(shape, dtype=np.float32))})
+    arrays = [product["vertical_column_troposphere"].values, product["main_data_quality_flag"].values,
+              geoloc["solar_zenith_angle"].values, support["eff_cloud_fraction"].values]
+
+    for flag in QUALITY_LIMITS:
+        def datasets():
+            mask = quality_mask(geoloc, product, support, flag)
+            return (product.where(mask)["vertical_column_troposphere"] / 10**16).values, support.where(mask)["eff_cloud_fraction"].values
+
+        expected = datasets()
+        result = mask_granule(*arrays, flag, dtype=np.float64)
+        for a, b in zip(expected, result):
+            np.testing.assert_array_equal(a, b)
+        before = timeit(datasets, args.repeat)
+        report(f"mask {flag} float64: where vs fused", before, timeit(lambda: mask_granule(*arrays, flag, dtype=np.float64), args.repeat))
+        report(f"mask {flag} float32: where vs fused", before, timeit(lambda: mask_granule(*arrays, flag), args.repeat))
+
+
+def bench_float32(args: argparse.Namespace) -> None:
+    from colormap import colormap_palette
+    from tempo_process_funcs import colormap_indices, reproject_bands, svs_tempo_cmap
+
+    no2, bounds = synthetic_granule(args.scale, seed=0)
+    cloud, _ = synthetic_granule(args.scale, seed=1)
+    _, level_to_index = colormap_palette(svs_tempo_cmap)
+    results = {}
+    for dtype in [np.float64, np.float32]:
+        bands = {"data": no2.astype(dtype), "cloud": cloud.astype(np.float32)}
+        warp = lambda: reproject_bands(bands, bounds, pyramid=True, dtype=dtype)
+        projected = warp()
+        nbytes = sum(level.nbytes for levels in projected.values() for level in levels)
+        images = [level_to_index[colormap_indices(level.astype(np.float64), 0.01, 1.5)] for level in projected["data"]]
+        results[dtype] = (timeit(warp, args.repeat), nbytes, images)
+        logger.info(f"{np.dtype(dtype).name}: input {bands['data'].nbytes / 2**20:.1f} MB, reprojected {nbytes / 2**20:.1f} MB")
+    (before, _, expected), (after, _, result) = results[np.float64], results[np.float32]
+    report("reproject_bands float64 vs float32", before, after)
+    for level, (a, b) in enumerate(zip(expected, result)):
+        changed = np.mean(a != b)
+        logger.info(f"level {level}: {changed:.2e} of pixels change colour")
+        # float32 rounding can move a value across a colour boundary, but only rarely
+        assert changed < 1e-4, f"float32 changed {changed:.2%} of level {level}"
+
+    # peak of the arrays allocated from read to saved images for one granule
+    # (tracemalloc sees numpy's buffers, not GDAL's internal ones)
+    import os
+    import tempfile
+    import tracemalloc
+    from pathlib import Path
+    from process_data import process_and_save_arrays, read_granule
+    from tempo_process_funcs import get_bounds
+
+    with tempfile.TemporaryDirectory() as tmp:
+        granule = os.path.join(tmp, "TEMPO_NO2_L3_V03_20240501T120000Z_S001.nc")
+        write_synthetic_file(granule, args.scale)
+        peaks = {}
+        for dtype in [np.float64, np.float32]:
+            tracemalloc.start()
+            no2, cloud, _ = read_granule(granule, "svs", dtype)
+            left, right, bottom, top = get_bounds(no2.isel(time=0))
+            process_and_save_arrays(
+                no2.values[0], cloud.values[0], no2.time.values[0], svs_tempo_cmap, 0.01, 1.5,
+                Path(tmp, np.dtype(dtype).name), "", [(bottom, left), (top, right)], pyramid=True, dtype=dtype,
+            )
+            peaks[dtype] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            del no2, cloud
+        logger.info(
+            f"read to images peak: float64 {peaks[np.float64] / 2**20:.1f} MB, float32 {peaks[np.float32] / 2**20:.1f} MB "
+            f"({peaks[np.float64] / peaks[np.float32]:.2f}x less)"
+        )
+
+
+def bench_combine(args: argparse.Namespace) -> None:
+    import pandas as pd
+    import xarray as xr
+    from process_data import combine_data
+
+    array, bounds = synthetic_granule(args.scale)
+    (lat_min, lon_min), _ = bounds
+    nlat, nlon = array.shape
+    step = TEMPO_STEP * args.scale
+    grid = {
+        "latitude": lat_min + step * (np.arange(nlat) + 0.5),
+        "longitude": lon_min + step * (np.arange(nlon) + 0.5),
+    }
+    dims = ("time", "latitude", "longitude")
+    lazy = xr.DataArray(array[None], dims=dims).chunk()
+    times = pd.date_range("2024-05-01T12:00", periods=args.granules, freq="40min")
+    # shuffled, as glob returns them in no particular order
+    order = np.random.default_rng(0).permutation(args.granules)
+    # each granule offset by its time index, so the check below sees the order
+    product = [
+        xr.Dataset(
+            {name: lazy + i for name in ["vertical_column_troposphere", "vertical_column_troposphere_uncertainty", "main_data_quality_flag"]},
+            coords={"time": [times[i]], **grid},
+        )
+        for i in order
+    ]
+    support = [xr.Dataset({name: lazy + i for name in ["eff_cloud_fraction", "amf_total", "snow_ice_fraction"]}) for i in order]
+
+    def by_coords():
+        aligned = [s.assign_coords(p.coords) for s, p in zip(support, product)]
+        return xr.combine_by_coords(product), xr.combine_by_coords(aligned)
+
+    stacked = lambda: combine_data(product, support)
+    (expected, expected_support), (result, result_support) = by_coords(), stacked()
+    np.testing.assert_array_equal(expected["time"], result["time"])
+    np.testing.assert_array_equal(
+        expected["vertical_column_troposphere"].values, result["vertical_column_troposphere"].values
+    )
+    np.testing.assert_array_equal(expected_support["eff_cloud_fraction"].values, result_support["eff_cloud_fraction"].values)
+    report(f"combine {args.granules} granules", timeit(by_coords, args.repeat), timeit(stacked, args.repeat))
+
+
+def _subset_in_child(filein: str, fileout: str, mode: str, settings: dict) -> tuple[float, int]:
+    """
+    Run one subset in a fresh process so its peak RSS is its own.
+
+    returns: (seconds, peak RSS in bytes)
+    """
+    import resource
+    import subset_tempo_data
+
+    if mode == "whole":
+        # the previous copy: each variable read and written in one piece
+        subset_tempo_data.copy_data = lambda src, dst: dst.__setitem__(slice(None), src[:])
+    if mode == "idle":
+        seconds = 0.0
+    else:
+        start = time.perf_counter()
+        subset_tempo_data.subset_files(filein, fileout, show_time=False, **settings)
+        seconds = time.perf_counter() - start
+    try:
+        # ru_maxrss survives exec on Linux, so it would include the parent's peak
+        with open("/proc/self/status") as f:
+            peak = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+    except (OSError, StopIteration):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return seconds, peak * 1024
+
+
+def bench_subset(args: argparse.Namespace) -> None:
+    import glob
+    import multiprocessing
+    import os
+    import tempfile
+
+    modes = {
+        "idle (imports only)": ("idle", {}),
+        "whole variable, zlib 4": ("whole", {}),
+        "chunked, zlib 4": ("chunked", {}),
+        "chunked, zlib 1": ("chunked", {"complevel": 1}),
+        "chunked, zlib 1, no shuffle": ("chunked", {"complevel": 1, "shuffle": False}),
+        "chunked, uncompressed": ("chunked", {"complevel": 0}),
+        "passthrough": ("chunked", {"passthrough": True}),
+    }
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp:
+        files = sorted(glob.glob(args.files)) if args.files else []
+        if not files:
+            files = [f"{tmp}/TEMPO_NO2_L3_V03_20240501T120000Z_S001.nc"]
+            write_synthetic_file(files[0], args.scale)
+        filein = files[0]
+        logger.info(f"{os.path.basename(filein)}: {os.path.getsize(filein) / 2**20:.1f} MB")
+        for name, (mode, settings) in modes.items():
+            fileout = f"{tmp}/subset.nc"
+            best, peak = np.inf, 0
+            for _ in range(1 if mode == "idle" else args.repeat):
+                if os.path.exists(fileout):
+                    os.remove(fileout)
+                with ctx.Pool(1) as pool:
+                    seconds, rss = pool.apply(_subset_in_child, (filein, fileout, mode, settings))
+                best, peak = min(best, seconds), max(peak, rss)
+            size = os.path.getsize(fileout) / 2**20 if mode != "idle" else 0
+            logger.info(f"{name:<30s} {best:7.2f} s  peak RSS {peak / 2**20:7.1f} MB  output {size:7.1f} MB")
+
+
+def bench_aggregate(args: argparse.Namespace) -> None:
+    import glob
+    import os
+    import tempfile
+    import pandas as pd
+    import xarray as xr
+    from aggregate_data import AGGREGATIONS, aggregate_files, update_store
+    from process_data import process_files
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = sorted(glob.glob(args.files)) if args.files else []
+        if not files:
+            # hourly scans over a little more than two weeks
+            times = pd.date_range("2024-04-25T12:00", periods=args.granules, freq="6h")
+            files = [f"{tmp}/TEMPO_NO2_L3_V03_{t:%Y%m%dT%H%M%S}Z_S001.nc" for t in times]
+            for seed, (filename, t) in enumerate(zip(files, times)):
+                write_synthetic_file(filename, args.scale, seed=seed, time=f"{t:%Y-%m-%dT%H:%M:%S}")
+
+        def notebook():
+            # Merge_and_Mean.ipynb
+            input_data, _, _, _ = process_files(files, "svs", False)
+            no2 = xr.combine_by_coords(input_data)["vertical_column_troposphere"] / 10**14
+            return {
+                "daily": no2.resample(time="1D").mean().compute(),
+                "weekly": no2.resample(time="1W").mean().compute(),
+                "monthly": no2.resample(time="1ME").mean().compute(),
+                "weekday": no2.groupby("time.weekday").mean(dim="time").compute(),
+                "hourly": no2.groupby("time.hour").mean().compute(),
+            }
+
+        streamed = lambda: aggregate_files(files, f"{tmp}/aggregated", fmt="netcdf")
+        expected, paths = notebook(), streamed()
+        for name in AGGREGATIONS:
+            with xr.open_dataset(paths[name]) as result:
+                dim = AGGREGATIONS[name].dim
+                # resample also emits empty windows, the stream only the ones with data
+                reference = expected[name].dropna(dim, how="all")
+                np.testing.assert_array_equal(reference[dim].values, result[dim].values)
+                np.testing.assert_allclose(reference.values, result["NO2"].values, rtol=1e-6)
+                logger.info(f"{name}: {result.sizes[dim]} windows, {os.path.getsize(paths[name]) / 2**20:.1f} MB")
+        report(f"5 aggregations of {len(files)} granules", timeit(notebook, args.repeat), timeit(streamed, args.repeat))
+
+        # a new granule arriving: recompute everything vs fold it into a store
+        store, output = f"{tmp}/store", f"{tmp}/incremental"
+        update_store(files[:-1], store, output, fmt="netcdf")
+        start = time.perf_counter()
+        update_store(files[-1:], store, output, fmt="netcdf")
+        fold = time.perf_counter() - start
+        report("add 1 granule: recompute vs fold", timeit(streamed, 1), fold)
+        for name in AGGREGATIONS:
+            with xr.open_dataset(paths[name]) as expected, xr.open_dataset(f"{output}/{name}_avg.nc") as result:
+                np.testing.assert_allclose(expected["NO2"].values, result["NO2"].values, rtol=1e-6)
+
+
+def bench_tiles(args: argparse.Namespace) -> None:
+    import os
+    import tempfile
+    from tempo_process_funcs import reproject_bands, save_image, svs_tempo_cmap
+    from xyz_tiles import ORIGIN, TILE_SIZE, default_zooms, frame_extent, save_tiles
+
+    array, bounds = synthetic_granule(args.scale)
+    levels = reproject_bands({"data": array}, bounds)["data"]
+    extent = frame_extent(bounds, levels[0].shape)
+    zooms = default_zooms(extent, levels[0].shape)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        frames = [os.path.join(tmp, f"level{level}.png") for level in range(len(levels))]
+
+        def images():
+            for level, filename in zip(levels, frames):
+                save_image(level, svs_tempo_cmap, 0.01, 1.5, filename, overwrite=True)
+
+        tiles = lambda: save_tiles(levels[0], bounds, svs_tempo_cmap, 0.01, 1.5, f"{tmp}/tiles", zooms, overwrite=True)
+        count, size = tiles()
+        report(f"full + half frame vs tiles z{zooms[0]}-{zooms[1]}", timeit(images, args.repeat), timeit(tiles, args.repeat))
+        logger.info(f"frames: {' + '.join(f'{os.path.getsize(f) / 1024:.0f} kB' for f in frames)}")
+        logger.info(f"tiles: {count} non-empty, {size / 2**20:.1f} MB in total")
+
+        # what a 1280 x 800 map view downloads: every tile it overlaps
+        for name, (lon, lat), zoom in [
+            ("North America", (-100.0, 40.0), zooms[0] + 1),
+            ("New York", (-74.0, 40.7), zooms[1]),
+        ]:
+            world = TILE_SIZE * 2**zoom
+            x = (lon + 180) / 360 * world
+            y = (ORIGIN - 6378137.0 * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))) / (2 * ORIGIN) * world
+            view = [
+                f"{tmp}/tiles/{zoom}/{tx}/{ty}.png"
+                for tx in range(int((x - 640) // TILE_SIZE), int((x + 640) // TILE_SIZE) + 1)
+                for ty in range(int((y - 400) // TILE_SIZE), int((y + 400) // TILE_SIZE) + 1)
+            ]
+            view_bytes = sum(os.path.getsize(f) for f in view if os.path.exists(f))
+            logger.info(
+                f"{name} view at z{zoom}: {len(view)} tiles, {view_bytes / 1024:.0f} kB "
+                f"vs {os.path.getsize(frames[0]) / 1024:.0f} kB full frame"
+            )
+
+
+def bench_product(args: argparse.Namespace) -> None:
+    import os
+    import tempfile
+    from pathlib import Path
+    from data_product import product_filename, read_product, render_product, write_product
+    from process_data import read_granule, save_projected
+    from tempo_process_funcs import get_bounds, reproject_bands, svs_tempo_cmap
+
+    with tempfile.TemporaryDirectory() as tmp:
+        granule = os.path.join(tmp, "TEMPO_NO2_L3_V03_20240501T120000Z_S001.nc")
+        write_synthetic_file(granule, args.scale)
+
+        def from_granule():
+            no2, cloud, _ = read_granule(granule, "svs")
+            left, right, bottom, top = get_bounds(no2.isel(time=0))
+            bounds = [(bottom, left), (top, right)]
+            projected = reproject_bands({"data": no2[0], "cloud": cloud[0]}, bounds, pyramid=True)
+            save_projected(projected, no2.time.values[0], svs_tempo_cmap, 0.02, 1.0, Path(tmp, "granule"), "", bounds, overwrite=True)
+            return projected, no2.time.values[0], bounds
+
+        projected, time_, bounds = from_granule()
+        product = os.path.join(tmp, product_filename(time_))
+        for max_error in [None, 0.001]:
+            start = time.perf_counter()
+            size = write_product(product, projected["data"][0], projected["cloud"][0], time_, bounds, overwrite=True, max_error=max_error)
+            logger.info(
+                f"product max_error={max_error}: {size / 2**20:.1f} MB in {time.perf_counter() - start:.2f} s, "
+                f"granule {os.path.getsize(granule) / 2**20:.1f} MB"
+            )
+        # lossless product reads back as written and renders the same images as the granule
+        write_product(product, projected["data"][0], projected["cloud"][0], time_, bounds, overwrite=True)
+        no2, cloud, meta = read_product(product)
+        np.testing.assert_array_equal(no2, projected["data"][0].astype(np.float32))
+        np.testing.assert_array_equal(cloud, projected["cloud"][0].astype(np.float32))
+        assert meta["time"] == np.datetime64(time_, "s") and meta["reproject"], meta
+        np.testing.assert_allclose(np.array(meta["bounds"], dtype=float), np.array(bounds, dtype=float))
+        from_product = lambda: render_product(product, svs_tempo_cmap, 0.02, 1.0, f"{tmp}/product", overwrite=True)
+        from_product()
+        for name in sorted(os.listdir(f"{tmp}/granule")):
+            if name.endswith(".png"):
+                with open(f"{tmp}/granule/{name}", "rb") as a, open(f"{tmp}/product/{name}", "rb") as b:
+                    assert a.read() == b.read(), name
+        report("re-render from granule vs product", timeit(from_granule, args.repeat), timeit(from_product, args.repeat))
+
+
+def bench_animation(args: argparse.Namespace) -> None:
+    import os
+    import tempfile
+    from pathlib import Path
+    from PIL import Image
+    from animate_frames import animate_day, find_frames
+    from tempo_process_funcs import reproject_bands, save_image, svs_tempo_cmap
+
+    def decode_pngs(paths):
+        return [np.asarray(Image.open(path).convert("RGBA")) for path in paths]
+
+    def decode_apng(path):
+        frames = []
+        with Image.open(path) as image:
+            for i in range(image.n_frames):
+                image.seek(i)
+                frames.append(np.asarray(image.convert("RGBA")))
+        return frames
+
+    def compare(name, paths, output):
+        size = animate_day(paths, output, overwrite=True)
+        pngs = sum(os.path.getsize(path) for path in paths)
+        logger.info(f"{name}: {len(paths)} PNGs {pngs / 2**20:.2f} MB, APNG {size / 2**20:.2f} MB ({pngs / size:.1f}x smaller)")
+        for expected, result in zip(decode_pngs(paths), decode_apng(output)):
+            # fully transparent pixels may differ in colour
+            np.testing.assert_array_equal(expected[..., 3], result[..., 3])
+            np.testing.assert_array_equal(expected[expected[..., 3] > 0], result[expected[..., 3] > 0])
+        report(f"{name}: decode PNGs vs APNG", timeit(lambda: decode_pngs(paths), args.repeat), timeit(lambda: decode_apng(output), args.repeat))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.files:
+            for day, paths in find_frames(Path(args.files)).items():
+                compare(day, paths, f"{tmp}/tempo_{day}.png")
+            return
+
+        # hourly scans of one day: a new swath of each scan replaces the
+        # previous values, the rest of the frame is unchanged ...
+        ntimes = 12
+        base, bounds = synthetic_granule(args.scale, seed=0)
+        fields = [base] + [synthetic_granule(args.scale, seed=k)[0] for k in range(1, ntimes)]
+        scenarios = {"new swath each scan": []}
+        frame = base.copy()
+        swath = base.shape[1] // ntimes
+        for k, field in enumerate(fields):
+            columns = slice(base.shape[1] - (k + 1) * swath, base.shape[1] - k * swath)
+            frame[:, columns] = field[:, columns]
+            scenarios["new swath each scan"].append(frame.copy())
+        for name, arrays in scenarios.items():
+            directory = Path(tmp, name.replace(" ", "_"))
+            directory.mkdir()
+            paths = []
+            for hour, array in enumerate(arrays, start=12):
+                projected = reproject_bands({"data": array}, bounds, levels=1)["data"][0]
+                paths.append(directory / f"tempo_2024-05-01T{hour:02d}h00m.png")
+                save_image(projected, svs_tempo_cmap, 0.01, 1.5, paths[-1])
+            compare(name, paths, directory / "animation.png")
+
+        # what process_data --animate packs: one granule per frame, read,
+        # warped and cloud masked like the pipeline does it
+        from process_data import process_and_save_arrays, read_granule
+        from tempo_process_funcs import get_bounds
+
+        directory = Path(tmp, "process_data")
+        for hour in range(12, 12 + ntimes):
+            granule = os.path.join(tmp, f"TEMPO_NO2_L3_V03_20240501T{hour:02d}0000Z_S001.nc")
+            write_synthetic_file(granule, args.scale, seed=hour, time=f"2024-05-01T{hour:02d}:00:00")
+            no2, cloud, _ = read_granule(granule, "svs")
+            left, right, bottom, top = get_bounds(no2.isel(time=0))
+            process_and_save_arrays(
+                no2.values[0], cloud.values[0], no2.time.values[0], svs_tempo_cmap, 0.01, 1.5,
+                directory, "", [(bottom, left), (top, right)], levels=1,
+            )
+            os.remove(granule)
+        paths = find_frames(directory)["2024-05-01"]
+        compare("process_data frames", paths, directory / "animation.png")
+
+
+BENCHMARKS = {
+    "reprojection": bench_reprojection,
+    "pyramid": bench_pyramid,
+    "multiband": bench_multiband,
+    "png": bench_png,
+    "lut": bench_lut,
+    "read": bench_read,
+    "mask": bench_mask,
+    "float32": bench_float32,
+    "combine": bench_combine,
+    "subset": bench_subset,
+    "aggregate": bench_aggregate,
+    "tiles": bench_tiles,
+    "product": bench_product,
+    "animation": bench_animation,
+}
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark TEMPO processing steps")
+    parser.add_argument("benchmark", choices=list(BENCHMARKS) + ["all"], help="Benchmark to run")
+    parser.add_argument("--scale", type=int, default=4, help="Downsample the TEMPO grid by this factor")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed repeats")
+    parser.add_argument("--granules", type=int, default=100, help="Number of granules for the combine and aggregate benchmarks")
+    parser.add_argument("--files", type=str, default=None, help="Glob of TEMPO granules for the read, subset and aggregate benchmarks, or a directory of frames for the animation benchmark (default: synthetic ones)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    names = list(BENCHMARKS) if args.benchmark == "all" else [args.benchmark]
+    for name in names:
+        logger.info(f"==== {name} ====")
+        BENCHMARKS[name](args)
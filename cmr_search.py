@@ -0,0 +1,252 @@
+"""
+CMR granule search with paging, concurrent day windows and a local index.
+
+A single CMR request returns at most one page of granules, so a long
+backfill window used to be cut off silently. search_granules splits the
+temporal range into UTC days, queries the days concurrently and follows
+CMR's search-after paging within each day.
+
+Results are stored in a SQLite index keyed by collection concept ID and
+day. A day that ended more than SETTLE_TIME before it was searched is
+marked complete and is never queried again. For the other (recent) days only
+the window starting at the newest granule already in the index is queried,
+so repeated check_new_files.py polls ask CMR for just the latest scans.
+"""
+
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import NamedTuple
+from urllib.parse import unquote
+
+import requests
+
+from logger import setup_logging
+
+logger = setup_logging(debug=False, name="cmr_search")
+
+CMR_URL = "https://cmr.earthdata.nasa.gov/search/granules"
+CMR_DATE_FMT = "%Y-%m-%dT%H:%M:%SZ"  # format requirement for datetime search
+PAGE_SIZE = 2000  # CMR's maximum
+DEFAULT_WORKERS = 4
+TIMEOUT = (30, 120)
+
+# how long after the end of a day CMR is assumed to have all of its granules
+SETTLE_TIME = timedelta(days=2)
+
+# set to None to disable the index
+INDEX_PATH: Path | None = Path("~/.cache/tempo_processing/cmr_index.sqlite").expanduser()
+
+# only links into the protected bucket are downloadable granules
+DATA_LINK = "asdc-prod-protected"
+
+
+class CMRSearchError(Exception):
+    """
+    CMR returned something that is not a granule feed
+    """
+
+
+class Granule(NamedTuple):
+    url: str
+    time_start: str
+    time_end: str
+    size_mb: float | None
+
+
+def parse_cmr_time(value: str) -> datetime:
+    # "2024-11-26T22:52:08.000Z" -> aware datetime
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).astimezone(timezone.utc)
+
+
+def format_cmr_time(value: datetime) -> str:
+    return value.astimezone(timezone.utc).strftime(CMR_DATE_FMT)
+
+
+def day_windows(start_date: datetime, end_date: datetime) -> list[datetime]:
+    """
+    Midnight (UTC) of every day that overlaps [start_date, end_date]
+    """
+    day = start_date.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    days = []
+    while day <= end_date:
+        days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+def entry_to_granule(entry: dict) -> Granule | None:
+    url = next((link["href"] for link in entry.get("links", []) if DATA_LINK in link.get("href", "")), None)
+    if url is None:
+        return None
+    size = entry.get("granule_size")
+    return Granule(
+        url=url,
+        time_start=format_cmr_time(parse_cmr_time(entry["time_start"])),
+        time_end=format_cmr_time(parse_cmr_time(entry.get("time_end", entry["time_start"]))),
+        size_mb=float(size) if size is not None else None,
+    )
+
+
+def search_window(
+    session: requests.Session,
+    concept_id: str,
+    start_date: datetime,
+    end_date: datetime,
+    cmr_url: str = CMR_URL,
+    page_size: int = PAGE_SIZE,
+) -> list[Granule]:
+    """
+    Every granule of concept_id overlapping [start_date, end_date],
+    following CMR-Search-After until the last page.
+    """
+    params = {
+        "concept_id": concept_id,
+        "temporal": f"{format_cmr_time(start_date)},{format_cmr_time(end_date)}",
+        "page_size": page_size,
+        "sort_key": "start_date",
+    }
+    headers = {"Accept": "application/json"}
+    granules = []
+    while True:
+        response = session.get(cmr_url, params=params, headers=headers, timeout=TIMEOUT)
+        logger.debug(f"CMR Request URL: {unquote(response.url)}")
+        response.raise_for_status()
+        try:
+            entries = response.json()["feed"]["entry"]
+        except (KeyError, ValueError) as e:
+            raise CMRSearchError(f"Unexpected CMR response for {unquote(response.url)}: {response.text[:500]}") from e
+        granules.extend(g for g in map(entry_to_granule, entries) if g is not None)
+        search_after = response.headers.get("CMR-Search-After")
+        if not entries or search_after is None or len(entries) < page_size:
+            break
+        headers["CMR-Search-After"] = search_after
+    return granules
+
+
+class GranuleIndex:
+    """
+    SQLite store of search results per (concept_id, day).
+    Only used from the thread that created it.
+
+    :arg path: database file, created if missing
+    """
+
+    def __init__(self, path: Path | str):
+        self.path = Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS granules (
+                concept_id TEXT, day TEXT, url TEXT, time_start TEXT, time_end TEXT, size_mb REAL,
+                PRIMARY KEY (concept_id, day, url)
+            );
+            CREATE TABLE IF NOT EXISTS days (
+                concept_id TEXT, day TEXT, complete INTEGER, searched_at TEXT,
+                PRIMARY KEY (concept_id, day)
+            );
+            """
+        )
+
+    def close(self):
+        self.db.close()
+
+    def is_complete(self, concept_id: str, day: str) -> bool:
+        row = self.db.execute(
+            "SELECT complete FROM days WHERE concept_id = ? AND day = ?", (concept_id, day)
+        ).fetchone()
+        return bool(row and row[0])
+
+    def newest(self, concept_id: str, day: str) -> str | None:
+        """
+        time_start of the newest granule stored for this day
+        """
+        row = self.db.execute(
+            "SELECT MAX(time_start) FROM granules WHERE concept_id = ? AND day = ?", (concept_id, day)
+        ).fetchone()
+        return row[0]
+
+    def granules(self, concept_id: str, day: str) -> list[Granule]:
+        rows = self.db.execute(
+            "SELECT url, time_start, time_end, size_mb FROM granules WHERE concept_id = ? AND day = ?",
+            (concept_id, day),
+        )
+        return [Granule(*row) for row in rows]
+
+    def update(self, concept_id: str, day: str, granules: list[Granule], complete: bool, searched_at: str):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO granules VALUES (?, ?, ?, ?, ?, ?)",
+                [(concept_id, day, *g) for g in granules],
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO days VALUES (?, ?, ?, ?)", (concept_id, day, int(complete), searched_at)
+            )
+
+
+def search_granules(
+    concept_id: str,
+    start_date: datetime,
+    end_date: datetime,
+    index_path: Path | str | None = INDEX_PATH,
+    workers: int = DEFAULT_WORKERS,
+    cmr_url: str = CMR_URL,
+    session: requests.Session | None = None,
+    page_size: int = PAGE_SIZE,
+) -> list[Granule]:
+    """
+    All granules of concept_id overlapping [start_date, end_date], sorted by start time.
+
+    :arg concept_id: CMR collection concept ID
+    :arg start_date: aware datetime
+    :arg end_date: aware datetime
+    :kwarg index_path: SQLite index file, None to always query CMR
+    :kwarg workers: days queried at the same time
+    :kwarg cmr_url: granule search endpoint
+    :kwarg page_size: granules per CMR page
+    """
+    now = datetime.now(tz=timezone.utc)
+    index = GranuleIndex(index_path) if index_path is not None else None
+    session = session or requests.Session()
+
+    # (day, query start) for every day the index cannot answer on its own
+    queries = []
+    days = day_windows(start_date, end_date)
+    for day in days:
+        key = day.strftime("%Y-%m-%d")
+        if index is not None and index.is_complete(concept_id, key):
+            continue
+        newest = index.newest(concept_id, key) if index is not None else None
+        queries.append((day, parse_cmr_time(newest) if newest else day))
+
+    logger.debug(f"{len(days) - len(queries)} of {len(days)} days answered from the index")
+
+    def query(job):
+        day, query_start = job
+        # the temporal range is inclusive, stop just before the next midnight
+        return search_window(session, concept_id, query_start, day + timedelta(days=1, seconds=-1), cmr_url, page_size)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(queries) or 1))) as pool:
+        results = list(pool.map(query, queries))
+
+    found: dict[str, Granule] = {}
+    for (day, _), granules in zip(queries, results):
+        if index is not None:
+            complete = day + timedelta(days=1) + SETTLE_TIME < now
+            index.update(concept_id, day.strftime("%Y-%m-%d"), granules, complete, format_cmr_time(now))
+        else:
+            found.update((g.url, g) for g in granules)
+    if index is not None:
+        for day in days:
+            found.update((g.url, g) for g in index.granules(concept_id, day.strftime("%Y-%m-%d")))
+        index.close()
+
+    start, end = format_cmr_time(start_date), format_cmr_time(end_date)
+    # same overlap test as CMR's temporal filter
+    granules = sorted(
+        (g for g in found.values() if g.time_start <= end and g.time_end >= start), key=lambda g: g.time_start
+    )
+    logger.info(f"Found {len(granules)} granules in search ({len(queries)} CMR day queries)")
+    return granules
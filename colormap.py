@@ -1,5 +1,6 @@
 
-from matplotlib.colors import LinearSegmentedColormap
+import numpy as np
+from matplotlib.colors import Colormap, LinearSegmentedColormap
 from matplotlib import cm
 from matplotlib import colormaps
 
@@ -11,4 +12,34 @@ svs_tempo_cmap = LinearSegmentedColormap.from_list('svs_tempo', list(zip(r, g, b
 
 # register this new colormap with matplotlib
 
-colormaps.register(name='svs_tempo', cmap=svs_tempo_cmap)
\ No newline at end of file
+colormaps.register(name='svs_tempo', cmap=svs_tempo_cmap)
+
+
+_palettes = {}
+
+
+def colormap_palette(cmap: Colormap | str):
+    """
+    Indexed-PNG palette for a colormap, as matplotlib renders it with bytes=True.
+
+    The colormap lookup table is cmap.N levels followed by the under, over and
+    bad colours. Duplicate colours are merged so that the 256 svs_tempo levels
+    (249 distinct colours) plus the transparent bad colour fit in one palette.
+
+    returns: (palette (n, 4) uint8 RGBA, level_to_index (cmap.N + 3,) uint8)
+    """
+    if isinstance(cmap, str):
+        cmap = colormaps[cmap]
+    key = (cmap.name, cmap.N, id(cmap))
+    if key not in _palettes:
+        levels = cmap(np.arange(cmap.N), bytes=True)
+        extremes = (np.array([cmap.get_under(), cmap.get_over(), cmap.get_bad()]) * 255).astype(np.uint8)
+        lut = np.vstack([levels, extremes])
+        palette, level_to_index = np.unique(lut, axis=0, return_inverse=True)
+        if len(palette) > 256:
+            raise ValueError(f"Colormap {cmap.name} has {len(palette)} colours, too many for an indexed PNG")
+        _palettes[key] = (palette, level_to_index.ravel().astype(np.uint8))
+    return _palettes[key]
+
+
+svs_tempo_palette, svs_tempo_palette_index = colormap_palette(svs_tempo_cmap)
@@ -0,0 +1,258 @@
+"""
+Georeferenced data product written next to the PNGs.
+
+The PNGs bake in the colormap, vmin/vmax and cloud threshold, so restyling
+used to mean reading and reprojecting every granule again. With
+process_data.py --product-dir each timestep is also written as a
+cloud-optimized GeoTIFF holding the reprojected grids before any colouring:
+
+    band 1  NO2             tropospheric column in units of 10^16 molecules/cm^2
+    band 2  cloud_fraction  effective cloud fraction, 0-1
+
+Both are float32, NaN where there is no data, in 512 px DEFLATE tiles (or
+LERC tiles with a bounded error, see write_product) with average overviews,
+so a client (QGIS, rasterio, a tile server, a browser through HTTP range
+requests) can read a window or a zoomed out view without downloading the
+file. The time, lat/lon bounds and the cloud
+threshold used for the PNGs are stored as tags.
+
+Rendering images from products skips the granules and the reprojection:
+
+    python data_product.py -i "products/*.tif" -o images --vmin 1 --vmax 100
+    python data_product.py -i "products/*.tif" -o clouds --clouds
+    python data_product.py -i "products/*.tif" -o images --tiles
+"""
+
+import argparse
+import glob
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.io import MemoryFile
+
+from logger import setup_logging, set_log_level
+from reprojection_plan import _destination_grid
+from tempo_process_funcs import block_average, datetime64_to_fname
+
+logger = setup_logging(debug=False, name="data_product")
+
+PRODUCT_SUFFIX = ".tif"
+PART_SUFFIX = ".part"
+BANDS = ("NO2", "cloud_fraction")
+NO2_UNITS = "1e16 molecules/cm^2"
+COG_OPTIONS = dict(blocksize=512, overview_resampling="average", level=6)
+# lossless and readable by every GeoTIFF client, the floating point
+# predictor makes it about 10% smaller than DEFLATE alone
+LOSSLESS_OPTIONS = dict(compress="DEFLATE", predictor=3)
+
+
+def product_filename(time: np.datetime64, suffix: str = "") -> str:
+    """
+    tempo_2024-05-01T12h00m<suffix>.tif, named like the images
+    """
+    return Path(datetime64_to_fname(time, suffix)).stem + PRODUCT_SUFFIX
+
+
+def write_product(
+    path: Path | str,
+    data: np.ndarray,
+    cloud: np.ndarray,
+    time: np.datetime64,
+    bounds,
+    reproject=True,
+    cloud_threshold: float | None = None,
+    overwrite=False,
+    max_error: float | None = None,
+) -> int:
+    """
+    Write one timestep's full resolution grids as a cloud-optimized GeoTIFF.
+    The file is written as <name>.part and moved into place when complete.
+
+    :arg data: NO2 frame as returned by reproject_bands, units of 10^16
+    :arg cloud: cloud fraction frame on the same grid
+    :arg bounds: [(lat_min, lon_min), (lat_max, lon_max)] the frames were reprojected from
+    :kwarg reproject: frames are Web Mercator (True) or lat/lon (False)
+    :kwarg cloud_threshold: threshold the images were masked with, kept as a tag
+    :kwarg max_error: compress with LERC, keeping every value within max_error
+        (NO2 in 10^16 units). 0.001 makes the file about 3.5x smaller than the
+        lossless DEFLATE default, 0 is lossless LERC. Needs a LERC capable reader.
+    returns: bytes written, 0 if the file exists and overwrite is False
+    """
+    path = Path(path)
+    if not overwrite and path.exists():
+        logger.debug(f"Product {path} already exists. Skipping creation.")
+        return 0
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    projection = "EPSG:3857" if reproject else "EPSG:4326"
+    transform, height, width = _destination_grid(bounds, data.shape, 1, projection)
+    if (height, width) != data.shape:
+        raise ValueError(f"Frame shape {data.shape} does not match the grid for {bounds} ({height}, {width})")
+
+    (lat_min, lon_min), (lat_max, lon_max) = bounds
+    tags = {
+        "TIME": str(np.datetime64(time, "s")),
+        "BOUNDS": json.dumps([float(lat_min), float(lon_min), float(lat_max), float(lon_max)]),
+        "NO2_UNITS": NO2_UNITS,
+    }
+    if cloud_threshold is not None:
+        tags["CLOUD_THRESHOLD"] = str(float(cloud_threshold))
+
+    profile = dict(
+        driver="GTiff",
+        width=width,
+        height=height,
+        count=len(BANDS),
+        dtype="float32",
+        crs=projection,
+        transform=transform,
+        nodata=np.nan,
+    )
+    part = path.with_name(path.name + PART_SUFFIX)
+    with MemoryFile() as memory:
+        with memory.open(**profile) as dst:
+            dst.write(np.stack([data, cloud]).astype(np.float32))
+            for band, name in enumerate(BANDS, start=1):
+                dst.set_band_description(band, name)
+            dst.update_tags(**tags)
+            # the COG driver lays out the tiles and builds the overviews
+            if max_error is None:
+                options = dict(COG_OPTIONS, **LOSSLESS_OPTIONS)
+            else:
+                options = dict(COG_OPTIONS, compress="LERC_DEFLATE", max_z_error=max_error)
+            rasterio.shutil.copy(dst, part, driver="COG", **options)
+    os.replace(part, path)
+    size = path.stat().st_size
+    logger.debug(f"Wrote product {path} ({size / 2**20:.1f} MB)")
+    return size
+
+
+def read_product(path: Path | str) -> tuple[np.ndarray, np.ndarray, dict]:
+    """
+    Full resolution grids and tags of a product
+
+    returns: (no2, cloud, meta) with meta
+        time: np.datetime64
+        bounds: [(lat_min, lon_min), (lat_max, lon_max)]
+        reproject: True for Web Mercator
+        cloud_threshold: float or None
+    """
+    with rasterio.open(path) as src:
+        no2, cloud = src.read().astype(np.float64)
+        tags = src.tags()
+        reproject = src.crs.to_epsg() == 3857
+    lat_min, lon_min, lat_max, lon_max = json.loads(tags["BOUNDS"])
+    meta = {
+        "time": np.datetime64(tags["TIME"], "s"),
+        "bounds": [(lat_min, lon_min), (lat_max, lon_max)],
+        "reproject": reproject,
+        "cloud_threshold": float(tags["CLOUD_THRESHOLD"]) if "CLOUD_THRESHOLD" in tags else None,
+    }
+    return no2, cloud, meta
+
+
+def render_product(
+    path: Path | str,
+    cmap,
+    vmin: float,
+    vmax: float,
+    output: Path,
+    suffix: str = "",
+    levels: int = 2,
+    cloud_threshold: float | None = None,
+    cloud_output=False,
+    overwrite=False,
+    tiles=False,
+    tile_zooms: tuple[int, int] | None = None,
+) -> None:
+    """
+    Save the images of one product the way process_data.py would.
+    The lower levels are block averaged from the full resolution grid like
+    process_data.py --pyramid.
+
+    :kwarg cloud_threshold: default the threshold stored in the product, else 0.5
+    """
+    from process_data import save_projected
+
+    no2, cloud, meta = read_product(path)
+    if cloud_threshold is None:
+        cloud_threshold = meta["cloud_threshold"] if meta["cloud_threshold"] is not None else 0.5
+    data = cloud if cloud_output else no2
+    if tiles:
+        levels = 1
+    projected = {"data": [data], "cloud": [cloud]}
+    for _ in range(1, levels):
+        projected["data"].append(block_average(projected["data"][-1], 2))
+        projected["cloud"].append(block_average(projected["cloud"][-1], 2))
+    save_projected(
+        projected,
+        meta["time"],
+        cmap,
+        vmin,
+        vmax,
+        Path(output),
+        suffix,
+        meta["bounds"],
+        cloud_threshold,
+        cloud_output=cloud_output,
+        overwrite=overwrite,
+        tiles=tiles,
+        tile_zooms=tile_zooms,
+    )
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Render images from TEMPO data products")
+    parser.add_argument("-i", "--input", type=str, required=True, help="Glob of product files")
+    parser.add_argument("-o", "--output", type=str, default=".", help="Output directory for images")
+    parser.add_argument("--vmin", type=float, help="Minimum value for color map (10^14 molecules/cm^2)", default=1)
+    parser.add_argument("--vmax", type=float, help="Maximum value for color map (10^14 molecules/cm^2)", default=150)
+    parser.add_argument("--clouds", action="store_true", help="Render the cloud layer instead of NO2")
+    parser.add_argument("--cloud-cmap", help="Color map for the cloud layer. Default is solid grey")
+    parser.add_argument(
+        "--cloud-threshold", type=float, help="Cloud mask threshold (default: the one stored in the product)", default=None
+    )
+    parser.add_argument("--levels", type=int, help="Number of resolution levels to output (full, half, ...)", default=2)
+    parser.add_argument("--tiles", action="store_true", help="Write z/x/y map tiles instead of full-frame images")
+    parser.add_argument("--tile-zooms", type=int, nargs=2, metavar=("MIN", "MAX"), help="Zoom range for --tiles", default=None)
+    parser.add_argument("--suffix", type=str, help="A suffix to append to filename", default="")
+    parser.add_argument("--overwrite", action="store_true", help="Overwrite the output images if they already exist")
+    parser.add_argument("--debug", help="Enable debug logging", action="store_true")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_arguments()
+    set_log_level(args.debug)
+    from process_data import cloud_cmap, svs_tempo_cmap
+
+    if args.clouds:
+        cmap, vmin, vmax = cloud_cmap if args.cloud_cmap is None else args.cloud_cmap, 0.5, 1
+    else:
+        cmap, vmin, vmax = svs_tempo_cmap, args.vmin / 100, args.vmax / 100
+
+    paths = sorted(glob.glob(args.input))
+    logger.info(f"Rendering {len(paths)} products to {args.output}")
+    for path in paths:
+        render_product(
+            path,
+            cmap,
+            vmin,
+            vmax,
+            Path(args.output),
+            args.suffix,
+            args.levels,
+            args.cloud_threshold,
+            cloud_output=args.clouds,
+            overwrite=args.overwrite,
+            tiles=args.tiles,
+            tile_zooms=args.tile_zooms,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -13,8 +13,9 @@ from get_tempo_data_utils import (
     make_absolute,
     fetch_granule_data, 
     validate_directory_exists,
-    escape_spaces
 )
+from granule_downloader import DEFAULT_WORKERS
+from granule_inventory import SUBSET_DIRECTORY, GranuleInventory
 from typing import cast
 import argparse
 from logger import setup_logging, set_log_level
@@ -55,6 +56,23 @@ def parse_arguments() -> argparse.Namespace:
     parser.add_argument("--data-range-min", type=int, default=None)
     parser.add_argument("--data-range-max", type=int, default=None)
     parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--skip-existing", action="store_true", help="Do not reprocess files that already have images")
+    parser.add_argument("--executor", type=str, choices=["threads", "processes", "serial"], help="How process_data.py runs the image rendering", default=None)
+    parser.add_argument("--workers", type=int, help="Number of rendering workers for process_data.py", default=None)
+    parser.add_argument("--cache-dir", type=str, help="Cache directory for masked and reprojected arrays (process_data.py)", default=None)
+    parser.add_argument("--scratch-dir", type=str, help="Directory for the memory-mapped combined cube (process_data.py)", default=None)
+    parser.add_argument("--keep-scratch", action="store_true", help="Keep the --scratch-dir cubes after rendering (process_data.py)")
+    parser.add_argument("--tiles", action="store_true", help="Write z/x/y map tiles instead of full-frame images (process_data.py)")
+    parser.add_argument("--animate", action="store_true", help="Also pack each day's images into a delta-encoded APNG (process_data.py); only pays off for cumulative composites")
+    parser.add_argument("--tile-zooms", type=int, nargs=2, metavar=("MIN", "MAX"), help="Zoom range for --tiles", default=None)
+    parser.add_argument("--product-dir", type=str, help="Also write cloud-optimized GeoTIFFs of the NO2 and cloud grids here (process_data.py)", default=None)
+    parser.add_argument("--product-max-error", type=float, help="LERC error bound for the GeoTIFFs (default: lossless)", default=None)
+    parser.add_argument("--inventory", type=str, help="Granule inventory database to look files up in and record them to", default=None)
+    parser.add_argument("--subset-workers", type=int, help="Number of processes for the subset step", default=None)
+    parser.add_argument("--download-workers", type=int, help="Number of concurrent granule downloads", default=None)
+    parser.add_argument("--download-script", action="store_true", help="Download serially with download_template.sh instead of granule_downloader.py")
+    parser.add_argument("--aggregate-store", type=str, help="Accumulator store to fold the new granules into (aggregate_data.py)", default=None)
+    parser.add_argument("--aggregate-dir", type=str, help="Where the mean layers go (default: <merge-dir>/aggregated)", default=None)
     # parser.add_argument("--skip-compress", action="store_true", help="Skip the compress")
     return parser.parse_args()
 
@@ -187,8 +205,11 @@ def main() -> None:
             args.verbose,
             args.dry_run,
             args.one_file,
+            download_workers=args.download_workers or DEFAULT_WORKERS,
+            use_download_script=args.download_script,
+            inventory_path=args.inventory,
         )
-        validate_directory_exists([download_list, download_script])
+        validate_directory_exists([download_list, download_script] if args.download_script else [download_list])
     
     # log the relaveant directoris
     logger.info(f"Root directory: {root_dir}")
@@ -208,8 +229,16 @@ def main() -> None:
         exit(1)
     
 
-    nc_files = list(netcdf_data_location.glob("*.nc"))
-    subset_nc_files = list(netcdf_data_location.glob("subsetted_netcdf/*.nc"))
+    inventory = GranuleInventory(args.inventory) if args.inventory else None
+    if inventory is not None and args.download_script:
+        # the shell downloader does not record what it fetched
+        inventory.scan(netcdf_data_location)
+    if inventory is not None:
+        nc_files = inventory.granules(netcdf_data_location, "*.nc")
+        subset_nc_files = inventory.granules(netcdf_data_location / SUBSET_DIRECTORY, "*.nc")
+    else:
+        nc_files = list(netcdf_data_location.glob("*.nc"))
+        subset_nc_files = list(netcdf_data_location.glob("subsetted_netcdf/*.nc"))
     doesnt_need_data = args.merge_only or args.text_files_only or args.use_subset or args.dry_run
     if not doesnt_need_data and not nc_files and (not args.use_subset or not subset_nc_files):
         logger.info("No new data downloaded")
@@ -240,9 +269,37 @@ def main() -> None:
         process_args += ["--vmin", str(args.data_range_min)] if args.data_range_min is not None else []
         process_args += ["--vmax", str(args.data_range_max)] if args.data_range_max is not None else []
         process_args += ["--overwrite"] if args.overwrite else []
+        process_args += ["--skip-existing"] if args.skip_existing else []
+        process_args += ["--executor", args.executor] if args.executor else []
+        process_args += ["--workers", str(args.workers)] if args.workers else []
+        process_args += ["--cache-dir", str(args.cache_dir)] if args.cache_dir else []
+        process_args += ["--scratch-dir", str(args.scratch_dir)] if args.scratch_dir else []
+        process_args += ["--keep-scratch"] if args.keep_scratch else []
+        process_args += ["--inventory", str(args.inventory)] if args.inventory else []
+        process_args += ["--tiles"] if args.tiles else []
+        process_args += ["--animate"] if args.animate else []
+        process_args += ["--tile-zooms", *map(str, args.tile_zooms)] if args.tile_zooms else []
+        process_args += ["--product-dir", str(make_absolute(args.product_dir, root_dir))] if args.product_dir else []
+        process_args += ["--product-max-error", str(args.product_max_error)] if args.product_max_error is not None else []
         
         run_command(["python", str(script_dir / "process_data.py")] + process_args, dry_run=args.dry_run, run_anyway=True)
 
+    if args.aggregate_store and not args.merge_only and not args.text_files_only:
+        # only granules the store has not seen are read
+        aggregate_dir = make_absolute(args.aggregate_dir, root_dir) if args.aggregate_dir else merge_directory / "aggregated"
+        aggregate_args = [
+            "-d",
+            str(netcdf_data_location / SUBSET_DIRECTORY) if args.use_subset else str(netcdf_data_location),
+            "-i",
+            "*.nc",
+            "--store",
+            str(make_absolute(args.aggregate_store, root_dir)),
+            "-o",
+            str(aggregate_dir),
+        ]
+        aggregate_args += ["--debug"] if args.verbose else []
+        run_command(["python", str(script_dir / "aggregate_data.py")] + aggregate_args, dry_run=args.dry_run)
+
 
 
     if not args.skip_merge:
@@ -254,7 +311,16 @@ def main() -> None:
 
 
     if not args.skip_subset and not args.use_subset and not args.text_files_only:
-        run_command(["sh", str(script_dir / "subset_files.sh"), escape_spaces(netcdf_data_location)], args.dry_run, cwd=script_dir)
+        subset_args = [
+            "-i",
+            str(netcdf_data_location),
+            "-o",
+            str(netcdf_data_location / SUBSET_DIRECTORY),
+            "-d",
+        ]
+        subset_args += ["--workers", str(args.subset_workers)] if args.subset_workers else []
+        subset_args += ["--inventory", str(args.inventory)] if args.inventory else []
+        run_command(["python", str(script_dir / "subset_tempo_data.py")] + subset_args, args.dry_run, cwd=script_dir)
 
     if args.dry_run:
         import shutil
@@ -1,18 +1,19 @@
 import os, sys, subprocess
 import requests
-from urllib.parse import unquote
 import datetime as dt
 from datetime import datetime, timezone, timedelta
 import numpy as np
 
 from pathlib import Path
 from logger import setup_logging
+from cmr_search import CMR_DATE_FMT, CMRSearchError, search_granules
+from granule_inventory import SUBSET_DIRECTORY, GranuleInventory
+from granule_downloader import DEFAULT_WORKERS, download_files, read_download_list
 
 
 logger = setup_logging(debug = False, name = 'get_utils')
 
 TEMPO_CONCEPT_ID = "C2930763263-LARC_CLOUD"  # TEMPO NO2 V03 L# Data
-CMR_DATE_FMT = "%Y-%m-%dT%H:%M:%SZ"  # format requirement for datetime search
 
 
 def to_datetime(date_str, format = "%Y-%m-%d"):
@@ -54,60 +55,25 @@ def get_date_limits():
 def search_for_granules(
     concept_id, start_date, end_date, last_downloaded_time, verbose=False, dry_run=False
 ):
-    granule_search_url = (
-        f"https://search.earthdata.nasa.gov/search/granules?p={concept_id}"
-    )
-
-    temporal_str = (
-        start_date.strftime(CMR_DATE_FMT) + "," + end_date.strftime(CMR_DATE_FMT)
-    )
-    logger.debug(f"Temporal String: {temporal_str}")
-
-    cmr_url = "https://cmr.earthdata.nasa.gov/search/granules"
-
-    search_params = {
-        "concept_id": concept_id,
-        "temporal": temporal_str,
-        "page_size": 1000,
-    }
-
-    headers = {
-        "Accept": "application/json",
-    }
+    logger.debug(f"Temporal String: {start_date.strftime(CMR_DATE_FMT)},{end_date.strftime(CMR_DATE_FMT)}")
 
     if dry_run:
         return ["https://not.a.real.url"]
 
-    cmr_response = requests.get(cmr_url, params=search_params, headers=headers)
-    
-    if verbose:
-        encoded_url = cmr_response.url
-        decoded_url = unquote(encoded_url)
-        logger.debug(f"CMR Request URL: {decoded_url}")
-    
     try:
-        granules = cmr_response.json()["feed"]["entry"]
-    except KeyError:
-        breakpoint()
+        granules = search_granules(concept_id, start_date, end_date)
+    except (CMRSearchError, requests.RequestException) as e:
+        logger.error(f"CMR search failed: {e}")
+        sys.exit(1)
 
     granule_urls = []
 
-    logger.info(f"Found {len(granules)} granules in search")
-
     for granule in granules:
-        # item = next((item['href'] for item in granule['links'] if "opendap" in item["href"]), None)
-        item = next(
-            (
-                item["href"]
-                for item in granule["links"]
-                if "asdc-prod-protected" in item["href"]
-            ),
-            None,
-        )
+        item = granule.url
         # print(urlTimeNearOrEarlier(item, last_downloaded_time), last_downloaded_time, item)
         if last_downloaded_time is None:
             granule_urls.append(item)
-        elif item != None and not urlTimeNearOrEarlier(item, last_downloaded_time):
+        elif not urlTimeNearOrEarlier(item, last_downloaded_time):
             logger.debug("added")
             granule_urls.append(item)
 
@@ -234,21 +200,24 @@ def setup_data_folder(data_dir=None, root_dir=None):
 
 
 
-def create_download_list(granule_urls: list[str], download_list: Path, data_dir: Path):
+def create_download_list(granule_urls: list[str], download_list: Path, data_dir: Path, inventory: GranuleInventory | None = None):
     # Create a list of files to download
     with open(download_list, "w") as f:
         for url in granule_urls[:]:
             filename = url.split("/")[-1]
-            exists = os.path.exists(f"{data_dir}/{filename}") or os.path.exists(
-                f"{data_dir}/subsetted_netcdf/{filename}"
-            )
+            if inventory is not None:
+                exists = inventory.find_granule(filename, [data_dir, data_dir / SUBSET_DIRECTORY]) is not None
+            else:
+                exists = os.path.exists(f"{data_dir}/{filename}") or os.path.exists(
+                    f"{data_dir}/subsetted_netcdf/{filename}"
+                )
             if exists:
                 logger.info(f"Skipping {filename}, already in {data_dir}")
                 continue
             f.write(url + "\n")
     logger.debug(f"Download list created: {download_list}")
 
-def download_data(download_script_template, download_script, dry_run = False):
+def check_netrc():
     # check if a .netrc file is on the path
     netrc = Path("~/.netrc").expanduser()
     if not netrc.exists():
@@ -256,9 +225,29 @@ def download_data(download_script_template, download_script, dry_run = False):
         logger.error("Please create a .netrc file with your Earthdata login credentials.")
         logger.error("See https://urs.earthdata.nasa.gov/documentation/for_users/data_access/curl_and_wget")
         sys.exit(1)
+
+def download_data(download_script_template, download_script, dry_run = False):
+    check_netrc()
     run_command(['cp', str(download_script_template), str(download_script)], dry_run = dry_run, run_anyway=True)
     run_command(['sh', str(download_script.name)], cwd=download_script.parent, dry_run = dry_run)
 
+def download_granules(download_list: Path, folder: Path, workers = DEFAULT_WORKERS, dry_run = False, inventory: GranuleInventory | None = None):
+    """
+    Download everything in download_list into folder with granule_downloader,
+    exiting with an error if any file could not be fetched
+    """
+    urls = read_download_list(download_list)
+    if dry_run:
+        logger.info(f"Would download {len(urls)} files to {folder} with {workers} workers")
+        return
+    check_netrc()
+    downloaded, failed = download_files(urls, folder, workers=workers)
+    if inventory is not None:
+        inventory.add_files(downloaded)
+    if failed:
+        logger.error(f"Could not download {len(failed)} files, rerun to resume them")
+        sys.exit(1)
+
 # def download_data(download_list: Path, template: Path, download_dir: Path, dry_run = False):
 #     run_command(
 #         ["cp", str(template), str(download_dir)],
@@ -270,7 +259,7 @@ def download_data(download_script_template, download_script, dry_run = False):
 #         dry_run=dry_run,
 #     )
 
-def fetch_granule_data(start_date, end_date, folder: Path, download_list: Path, download_script_template: Path, download_script: Path, skip_download = False, verbose = False, dry_run = False, only_one_file = False, check_only = False):
+def fetch_granule_data(start_date, end_date, folder: Path, download_list: Path, download_script_template: Path, download_script: Path, skip_download = False, verbose = False, dry_run = False, only_one_file = False, check_only = False, download_workers = DEFAULT_WORKERS, use_download_script = False, inventory_path = None):
     if not skip_download:
     # Determine the date range for the data download
         if start_date and end_date:
@@ -300,14 +289,20 @@ def fetch_granule_data(start_date, end_date, folder: Path, download_list: Path,
         if only_one_file:
             granule_urls = granule_urls[:1]
 
-        create_download_list(granule_urls, download_list, folder)
+        inventory = GranuleInventory(inventory_path) if inventory_path is not None else None
+        create_download_list(granule_urls, download_list, folder, inventory)
 
         if dry_run and not skip_download:
             logger.info(" ==== Download List  ==== ")
             with open(download_list, "r") as f:
                 logger.info(f.read())
         
-        download_data(download_script_template, download_script, dry_run = dry_run)
+        if use_download_script:
+            download_data(download_script_template, download_script, dry_run = dry_run)
+        else:
+            download_granules(download_list, folder, workers = download_workers, dry_run = dry_run, inventory = inventory)
+        if inventory is not None:
+            inventory.close()
         # download_data(download_list = download_list, template = download_script_template, download_dir = folder, dry_run=dry_run)
 
 def wrap_in_quotes(string: str) -> str:
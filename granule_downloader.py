@@ -0,0 +1,249 @@
+"""
+Parallel, resumable downloader for TEMPO granules.
+
+Replaces running download_template.sh, which fetches download_list.txt one
+file at a time with curl and gives up on the first error. Here a bounded pool
+of threads shares one requests.Session, so connections (and the Earthdata
+login cookies) are reused between files. Credentials come from ~/.netrc:
+requests looks up the .netrc entry for every host it is redirected to,
+including urs.earthdata.nasa.gov.
+
+Each file is written to <name>.part and renamed into place only once it is
+complete, so a finished name is always a whole granule. An interrupted or
+failed transfer keeps its .part file and the next attempt (or the next run)
+asks the server for the remaining bytes with an HTTP Range request.
+
+    python granule_downloader.py download_list.txt --folder data_dir --workers 4
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from logger import setup_logging, set_log_level
+
+logger = setup_logging(debug=False, name="granule_downloader")
+
+DEFAULT_WORKERS = 4
+DEFAULT_RETRIES = 5
+# seconds before the first retry, doubled for every retry after it
+DEFAULT_BACKOFF = 2.0
+CHUNK_BYTES = 2**20
+# (connect, read) seconds
+TIMEOUT = (30, 300)
+PART_SUFFIX = ".part"
+
+# client errors worth retrying, everything else in 4xx is permanent
+RETRY_STATUS = (408, 425, 429)
+
+
+class PermanentDownloadError(Exception):
+    """
+    The server refused the request in a way retrying will not fix
+    """
+
+
+def url_to_filename(url: str) -> str:
+    """
+    Everything after the last '/', without any query string
+    (the same name download_template.sh saves to)
+    """
+    return url.split("/")[-1].split("?")[0]
+
+
+def read_download_list(download_list: Path | str) -> list[str]:
+    with open(download_list, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def make_session(workers: int = DEFAULT_WORKERS) -> requests.Session:
+    """
+    Session with a connection pool large enough for every worker.
+    trust_env (the default) makes requests use ~/.netrc for authentication.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _content_range_start(response: requests.Response) -> int | None:
+    # "bytes 1000-1999/5000" -> 1000
+    content_range = response.headers.get("Content-Range", "")
+    try:
+        return int(content_range.split()[1].split("-")[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def _content_range_total(response: requests.Response) -> int | None:
+    # "bytes 1000-1999/5000" or "bytes */5000" -> 5000
+    content_range = response.headers.get("Content-Range", "")
+    try:
+        return int(content_range.rsplit("/", 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _fetch_once(session: requests.Session, url: str, part: Path, chunk_bytes: int) -> int:
+    """
+    One request for the rest of the file, appended to part.
+
+    returns: number of bytes received
+    """
+    offset = part.stat().st_size if part.exists() else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+        if response.status_code == 416:
+            # nothing left to send: either part is already complete or it
+            # is longer than the file, in which case start again
+            if _content_range_total(response) == offset:
+                return 0
+            part.unlink()
+            raise IOError(f"Partial file {part.name} does not match the server's copy, restarting")
+        if 400 <= response.status_code < 500 and response.status_code not in RETRY_STATUS:
+            raise PermanentDownloadError(f"HTTP {response.status_code} for {url}")
+        response.raise_for_status()
+
+        if response.status_code == 206 and _content_range_start(response) == offset:
+            mode = "ab"
+            total = _content_range_total(response)
+        else:
+            # server ignored the Range header, the body is the whole file
+            mode, offset = "wb", 0
+            length = response.headers.get("Content-Length")
+            total = int(length) if length is not None else None
+
+        received = 0
+        with open(part, mode) as f:
+            for chunk in response.iter_content(chunk_size=chunk_bytes):
+                f.write(chunk)
+                received += len(chunk)
+
+    if total is not None and offset + received != total:
+        raise IOError(f"{part.name} ended at {offset + received} of {total} bytes")
+    return received
+
+
+def download_file(
+    session: requests.Session,
+    url: str,
+    folder: Path | str,
+    retries: int = DEFAULT_RETRIES,
+    backoff: float = DEFAULT_BACKOFF,
+    chunk_bytes: int = CHUNK_BYTES,
+) -> tuple[Path, int]:
+    """
+    Download url into folder, resuming from a .part file if there is one.
+
+    :arg session: shared session, see make_session
+    :arg url: granule URL
+    :arg folder: destination directory
+    :kwarg retries: attempts after the first one before giving up
+    :kwarg backoff: seconds to wait before the first retry, doubled each time
+    returns: (final path, bytes transferred by this call)
+    """
+    path = Path(folder) / url_to_filename(url)
+    if path.exists():
+        logger.debug(f"{path.name} already downloaded")
+        return path, 0
+    part = path.with_name(path.name + PART_SUFFIX)
+
+    resumed_from = part.stat().st_size if part.exists() else 0
+    for attempt in range(retries + 1):
+        try:
+            _fetch_once(session, url, part, chunk_bytes)
+            break
+        except PermanentDownloadError:
+            raise
+        except (requests.RequestException, OSError) as e:
+            if attempt == retries:
+                raise
+            wait = backoff * 2**attempt
+            logger.warning(f"{path.name}: {e}. Retrying in {wait:.0f}s ({attempt + 1}/{retries})")
+            time.sleep(wait)
+
+    received = part.stat().st_size - resumed_from
+    os.replace(part, path)
+    return path, received
+
+
+def download_files(
+    urls: list[str],
+    folder: Path | str,
+    workers: int = DEFAULT_WORKERS,
+    retries: int = DEFAULT_RETRIES,
+    backoff: float = DEFAULT_BACKOFF,
+    session: requests.Session | None = None,
+) -> tuple[list[Path], list[str]]:
+    """
+    Download urls into folder with at most `workers` transfers at a time.
+    A file that fails after its retries does not stop the others.
+
+    returns: (downloaded paths, urls that failed)
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    workers = max(1, min(workers, len(urls) or 1))
+    session = session or make_session(workers)
+
+    downloaded, failed = [], []
+    total_bytes = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(download_file, session, url, folder, retries, backoff): url for url in urls
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            url = futures[future]
+            try:
+                path, received = future.result()
+            except Exception as e:
+                logger.error(f"[{done}/{len(urls)}] Failed {url_to_filename(url)}: {e}")
+                failed.append(url)
+                continue
+            downloaded.append(path)
+            total_bytes += received
+            elapsed = time.perf_counter() - start
+            logger.info(
+                f"[{done}/{len(urls)}] {path.name} ({received / 2**20:.1f} MB), "
+                f"{total_bytes / 2**20 / max(elapsed, 1e-9):.1f} MB/s overall"
+            )
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"Downloaded {len(downloaded)} of {len(urls)} files, {total_bytes / 2**20:.1f} MB "
+        f"in {elapsed:.1f}s ({total_bytes / 2**20 / max(elapsed, 1e-9):.1f} MB/s, {workers} workers)"
+    )
+    if failed:
+        logger.error(f"{len(failed)} files failed, rerun to resume them")
+    return downloaded, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download the granules in a download list")
+    parser.add_argument("download_list", type=str, help="File with one URL per line")
+    parser.add_argument("--folder", type=str, default=None, help="Destination directory (default: the list's directory)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Concurrent downloads")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help="Retries per file")
+    parser.add_argument("--backoff", type=float, default=DEFAULT_BACKOFF, help="Seconds before the first retry")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    set_log_level(args.verbose)
+
+    folder = args.folder or Path(args.download_list).parent
+    _, failed = download_files(
+        read_download_list(args.download_list), folder, args.workers, args.retries, args.backoff
+    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+"""
+Persistent inventory of the granules and images we hold.
+
+Finding what is already on disk used to mean globbing the data folders
+(create_download_list, get_input_files, reorganize_tempo_folders.py) and
+listing the image folders (--skip-existing). With tens of thousands of files
+those walks dominate the bookkeeping. GranuleInventory keeps one SQLite
+table of granules (path, scan time, subset state, size, checksum) and one of
+output PNGs, so duplicate checks, backlog selection and "what is missing for
+day X" are indexed lookups.
+
+The tools that write files record them as they go (the downloader, the
+subset step and process_data.py when given --inventory). Anything added by
+other means is picked up with a scan, which only fingerprints new or changed
+files:
+
+    python granule_inventory.py scan /path/to/data
+    python granule_inventory.py missing 2024-11-26 --image-dir all_reprocessed/images
+    python granule_inventory.py backlog --image-dir all_reprocessed/images > backlog
+"""
+
+import argparse
+import fnmatch
+import os
+import re
+import sqlite3
+import sys
+from datetime import datetime
+from pathlib import Path
+
+from logger import setup_logging, set_log_level
+from processing_cache import file_fingerprint
+
+logger = setup_logging(debug=False, name="granule_inventory")
+
+INVENTORY_PATH = Path("~/.cache/tempo_processing/granule_inventory.sqlite").expanduser()
+
+SUBSET_DIRECTORY = "subsetted_netcdf"
+GRANULE_PATTERN = re.compile(r"^TEMPO_.*_(\d{8}T\d{6})Z_S\d+.*\.nc$")
+IMAGE_PATTERN = re.compile(r"^tempo_(\d{4}-\d{2}-\d{2}T\d{2}h\d{2}m).*\.png$")
+
+
+def granule_scan_time(name: str) -> str | None:
+    """
+    TEMPO_NO2_L3_V03_20240501T120000Z_S001.nc -> 2024-05-01T12:00:00
+    """
+    match = GRANULE_PATTERN.match(name)
+    if match is None:
+        return None
+    return datetime.strptime(match.group(1), "%Y%m%dT%H%M%S").strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def image_time(name: str) -> str | None:
+    """
+    tempo_2024-05-01T12h00m.png -> 2024-05-01T12:00, the minute it shows
+    """
+    match = IMAGE_PATTERN.match(name)
+    if match is None:
+        return None
+    return datetime.strptime(match.group(1), "%Y-%m-%dT%Hh%Mm").strftime("%Y-%m-%dT%H:%M")
+
+
+def data_folder(granule_directory: Path | str) -> Path:
+    """
+    The day/data folder a granule belongs to, above subsetted_netcdf if it is there
+    """
+    granule_directory = Path(granule_directory)
+    return granule_directory.parent if granule_directory.name == SUBSET_DIRECTORY else granule_directory
+
+
+class GranuleInventory:
+    """
+    SQLite index of granule files and output images, keyed by absolute path.
+
+    :kwarg path: database file, created if missing
+    """
+
+    def __init__(self, path: Path | str = INVENTORY_PATH):
+        self.path = Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS granules (
+                path TEXT PRIMARY KEY, name TEXT, directory TEXT, scan_time TEXT,
+                subset INTEGER, size INTEGER, mtime_ns INTEGER, checksum TEXT
+            );
+            CREATE INDEX IF NOT EXISTS granules_name ON granules (name);
+            CREATE INDEX IF NOT EXISTS granules_directory ON granules (directory);
+            CREATE INDEX IF NOT EXISTS granules_scan_time ON granules (scan_time);
+            CREATE TABLE IF NOT EXISTS images (
+                path TEXT PRIMARY KEY, name TEXT, directory TEXT, image_time TEXT, size INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS images_directory ON images (directory, image_time);
+            CREATE INDEX IF NOT EXISTS images_time ON images (image_time);
+            """
+        )
+
+    def __repr__(self) -> str:
+        return f"GranuleInventory({str(self.path)!r})"
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_granule(self, path: Path | str, commit: bool = True) -> bool:
+        """
+        Record a granule file. The checksum is only recomputed when the
+        size or mtime changed since it was last recorded.
+
+        returns: False if path is not a TEMPO granule or does not exist
+        """
+        path = Path(path).absolute()
+        scan_time = granule_scan_time(path.name)
+        if scan_time is None:
+            return False
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return False
+        row = self.db.execute(
+            "SELECT size, mtime_ns, checksum FROM granules WHERE path = ?", (str(path),)
+        ).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            checksum = row[2]
+        else:
+            checksum = file_fingerprint(path)
+        self.db.execute(
+            "INSERT OR REPLACE INTO granules VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                str(path),
+                path.name,
+                str(path.parent),
+                scan_time,
+                int(path.parent.name == SUBSET_DIRECTORY),
+                stat.st_size,
+                stat.st_mtime_ns,
+                checksum,
+            ),
+        )
+        if commit:
+            self.db.commit()
+        return True
+
+    def add_image(self, path: Path | str, commit: bool = True) -> bool:
+        path = Path(path).absolute()
+        time = image_time(path.name)
+        if time is None:
+            return False
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            return False
+        self.db.execute(
+            "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)",
+            (str(path), path.name, str(path.parent), time, size),
+        )
+        if commit:
+            self.db.commit()
+        return True
+
+    def add_files(self, paths) -> int:
+        """
+        Record granules and images in one transaction
+
+        returns: number of files recorded
+        """
+        count = 0
+        with self.db:
+            for path in paths:
+                name = Path(path).name
+                if name.endswith(".nc"):
+                    count += self.add_granule(path, commit=False)
+                elif name.endswith(".png"):
+                    count += self.add_image(path, commit=False)
+        return count
+
+    def remove(self, path: Path | str):
+        path = str(Path(path).absolute())
+        with self.db:
+            self.db.execute("DELETE FROM granules WHERE path = ?", (path,))
+            self.db.execute("DELETE FROM images WHERE path = ?", (path,))
+
+    def move(self, old: Path | str, new: Path | str):
+        """
+        Update the inventory after a file was moved from old to new
+        """
+        self.remove(old)
+        self.add_files([new])
+
+    def scan(self, root: Path | str) -> tuple[int, int]:
+        """
+        Walk root once, record every granule and image under it and forget
+        inventory rows under root whose file is gone.
+
+        returns: (files recorded, rows removed)
+        """
+        root = Path(root).absolute()
+        found = []
+        for dirpath, _, filenames in os.walk(root):
+            found.extend(
+                os.path.join(dirpath, name)
+                for name in filenames
+                if GRANULE_PATTERN.match(name) or IMAGE_PATTERN.match(name)
+            )
+        recorded = self.add_files(found)
+
+        found = set(found)
+        prefix = os.path.join(str(root), "")
+        removed = 0
+        with self.db:
+            for table in ("granules", "images"):
+                rows = self.db.execute(
+                    f"SELECT path FROM {table} WHERE path = ? OR substr(path, 1, ?) = ?",
+                    (str(root), len(prefix), prefix),
+                ).fetchall()
+                stale = [(path,) for (path,) in rows if path not in found]
+                self.db.executemany(f"DELETE FROM {table} WHERE path = ?", stale)
+                removed += len(stale)
+        logger.info(f"Scanned {root}: {recorded} files recorded, {removed} stale entries removed")
+        return recorded, removed
+
+    def find_granule(self, name: str, directories=None) -> Path | None:
+        """
+        Where a granule is held, optionally only looking in some directories.
+        A hit is confirmed on disk and dropped from the inventory if the file
+        has gone.
+        """
+        rows = self.db.execute("SELECT path, directory FROM granules WHERE name = ?", (name,)).fetchall()
+        if directories is not None:
+            directories = {str(Path(d).absolute()) for d in directories}
+            rows = [row for row in rows if row[1] in directories]
+        for path, _ in rows:
+            if os.path.exists(path):
+                return Path(path)
+            self.remove(path)
+        return None
+
+    def granules(self, directory: Path | str, pattern: str | None = None) -> list[str]:
+        """
+        Paths of the granules in directory (not below it), sorted by name
+        """
+        rows = self.db.execute(
+            "SELECT path, name FROM granules WHERE directory = ? ORDER BY name",
+            (str(Path(directory).absolute()),),
+        )
+        return [path for path, name in rows if pattern is None or fnmatch.fnmatch(name, pattern)]
+
+    def directories(self, subset: bool | None = None) -> list[Path]:
+        """
+        Directories holding granules, only subsetted (or only original) ones if subset is given
+        """
+        rows = self.db.execute(
+            "SELECT DISTINCT directory FROM granules WHERE ? IS NULL OR subset = ?", (subset, subset)
+        )
+        return sorted(Path(directory) for (directory,) in rows)
+
+    def image_names(self, directory: Path | str) -> set[str]:
+        rows = self.db.execute("SELECT name FROM images WHERE directory = ?", (str(Path(directory).absolute()),))
+        return {name for (name,) in rows}
+
+    def missing_images(self, day: str | None = None, image_directory: Path | str | None = None) -> list[str]:
+        """
+        Granules without an image for their scan time, in image_directory if
+        given, anywhere otherwise.
+
+        :kwarg day: only granules scanned on this UTC day, YYYY-MM-DD
+        """
+        query = (
+            "SELECT g.path FROM granules g WHERE (? IS NULL OR substr(g.scan_time, 1, 10) = ?) "
+            "AND NOT EXISTS (SELECT 1 FROM images i WHERE i.image_time = substr(g.scan_time, 1, 16) "
+            "AND (? IS NULL OR i.directory = ?)) ORDER BY g.scan_time"
+        )
+        image_directory = str(Path(image_directory).absolute()) if image_directory is not None else None
+        return [path for (path,) in self.db.execute(query, (day, day, image_directory, image_directory))]
+
+    def backlog(self, image_directory: Path | str | None = None) -> list[Path]:
+        """
+        Data folders holding at least one granule that has no image yet
+        """
+        folders = {data_folder(Path(path).parent) for path in self.missing_images(image_directory=image_directory)}
+        return sorted(folders)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inventory of TEMPO granules and images")
+    parser.add_argument("--inventory", type=str, default=str(INVENTORY_PATH), help="Inventory database")
+    parser.add_argument("--verbose", action="store_true")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    scan = commands.add_parser("scan", help="Record everything under a directory")
+    scan.add_argument("root", type=str, nargs="+")
+
+    missing = commands.add_parser("missing", help="List granules of a day without images")
+    missing.add_argument("day", type=str, help="YYYY-MM-DD (UTC)")
+    missing.add_argument("--image-dir", type=str, default=None)
+
+    backlog = commands.add_parser("backlog", help="List data folders with granules that have no images")
+    backlog.add_argument("--image-dir", type=str, default=None)
+
+    find = commands.add_parser("find", help="Where a granule is held")
+    find.add_argument("name", type=str)
+
+    args = parser.parse_args()
+    set_log_level(args.verbose)
+
+    with GranuleInventory(args.inventory) as inventory:
+        if args.command == "scan":
+            for root in args.root:
+                inventory.scan(root)
+        elif args.command == "missing":
+            for path in inventory.missing_images(args.day, args.image_dir):
+                print(path)
+        elif args.command == "backlog":
+            cwd = Path.cwd()
+            for folder in inventory.backlog(args.image_dir):
+                print(folder.relative_to(cwd) if folder.is_relative_to(cwd) else folder)
+        elif args.command == "find":
+            path = inventory.find_granule(args.name)
+            if path is None:
+                sys.exit(1)
+            print(path)
+
+
+if __name__ == "__main__":
+    main()
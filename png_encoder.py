@@ -0,0 +1,308 @@
+"""
+In-process PNG writer for the colormapped images.
+
+Replaces writing the PNG with matplotlib and then re-encoding it with
+ImageMagick's `convert`. The filter, zlib level and zlib strategy options
+follow ImageMagick's png:compression-filter, png:compression-level and
+png:compression-strategy defines, so existing settings carry over.
+
+compression_filter:
+    0 None, 1 Sub, 2 Up, 3 Average, 4 Paeth (same filter for every row)
+    5 adaptive: pick the filter with the smallest sum of absolute
+      differences for each row (the libpng heuristic)
+compression_strategy (zlib):
+    0 default, 1 filtered, 2 huffman only, 3 RLE, 4 fixed
+
+encode_apng writes several frames as one animated PNG (APNG), where every
+frame after the first can be a sub-rectangle drawn over the previous one.
+"""
+
+import struct
+import zlib
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+
+from logger import setup_logging
+
+logger = setup_logging(debug=False, name="png_encoder")
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# PNG colour types
+GRAYSCALE, RGB, INDEXED, GRAYSCALE_ALPHA, RGBA = 0, 2, 3, 4, 6
+CHANNELS_TO_COLOR_TYPE = {1: GRAYSCALE, 2: GRAYSCALE_ALPHA, 3: RGB, 4: RGBA}
+
+ADAPTIVE_FILTER = 5
+
+# APNG fcTL blend_op: replace the region, or alpha composite it over the previous frame
+BLEND_SOURCE, BLEND_OVER = 0, 1
+DISPOSE_NONE = 0
+
+
+class ApngFrame(NamedTuple):
+    """
+    One APNG frame: image is drawn at (x, y) of the canvas left by the previous frame
+    """
+
+    image: np.ndarray
+    x: int = 0
+    y: int = 0
+    blend: int = BLEND_SOURCE
+
+
+def _chunk(tag: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data))
+        + tag
+        + data
+        + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+    )
+
+
+def _paeth(a: np.ndarray, b: np.ndarray, c: np.ndarray) -> np.ndarray:
+    """
+    Paeth predictor, on int16 arrays of left (a), up (b) and up-left (c)
+    """
+    # distances from p = a + b - c, without forming p
+    db = b - c
+    da = a - c
+    pc = np.abs(da + db)
+    pa = np.abs(db, out=db)
+    pb = np.abs(da, out=da)
+    return np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+
+
+def _filter_rows(rows: np.ndarray, bpp: int, filter_type: int) -> np.ndarray:
+    """
+    Apply one PNG filter to every scanline.
+
+    :arg rows: (height, width * bpp) uint8 image bytes
+    :arg bpp: bytes per pixel, the distance to the "left" byte
+    returns: (height, width * bpp) uint8 filtered bytes (without the filter byte)
+    """
+    if filter_type == 0:
+        return rows
+    # uint8 arithmetic wraps modulo 256, which is what PNG filters specify
+    left = np.zeros_like(rows)
+    left[:, bpp:] = rows[:, :-bpp]
+    if filter_type == 1:
+        return rows - left
+    up = np.zeros_like(rows)
+    up[1:] = rows[:-1]
+    if filter_type == 2:
+        return rows - up
+    if filter_type == 3:
+        # floor((left + up) / 2) without overflowing uint8
+        return rows - ((left >> 1) + (up >> 1) + (left & up & 1))
+    if filter_type == 4:
+        up_left = np.zeros_like(rows)
+        up_left[1:, bpp:] = rows[:-1, :-bpp]
+        pred = _paeth(left.astype(np.int16), up.astype(np.int16), up_left.astype(np.int16))
+        return rows - pred.astype(np.uint8)
+    raise ValueError(f"Unknown PNG filter type {filter_type}")
+
+
+def filter_image(rows: np.ndarray, bpp: int, compression_filter: int = 4) -> bytes:
+    """
+    Filter scanlines and prefix each with its filter type byte
+    """
+    height = rows.shape[0]
+    if compression_filter == ADAPTIVE_FILTER:
+        candidates = np.stack([_filter_rows(rows, bpp, f) for f in range(5)])
+        # minimum sum of absolute differences, treating bytes as signed
+        cost = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+        choice = cost.argmin(axis=0)
+        filtered = candidates[choice, np.arange(height)]
+        types = choice.astype(np.uint8)
+    else:
+        filtered = _filter_rows(rows, bpp, compression_filter)
+        types = np.full(height, compression_filter, dtype=np.uint8)
+    return np.concatenate([types[:, None], filtered], axis=1).tobytes()
+
+
+def encode_png(
+    image: np.ndarray,
+    palette: np.ndarray | None = None,
+    compression_filter: int = 4,
+    compression_level: int = 9,
+    compression_strategy: int = 1,
+) -> bytes:
+    """
+    Encode an 8-bit image as PNG bytes.
+
+    :arg image: (height, width) grayscale or palette indices, or
+        (height, width, channels) with 2 (gray + alpha), 3 (RGB) or 4 (RGBA) channels
+    :kwarg palette: (n, 3) or (n, 4) uint8 RGB(A) palette; image is then indices into it
+    :kwarg compression_filter: 0-4 fixed filter, 5 adaptive
+    :kwarg compression_level: zlib level 0-9
+    :kwarg compression_strategy: zlib strategy 0-4
+    """
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width = image.shape[:2]
+    channels = 1 if image.ndim == 2 else image.shape[2]
+    header, compression_filter = _header_chunks(width, height, channels, palette, compression_filter)
+    data = _image_data(image, compression_filter, compression_level, compression_strategy)
+    return b"".join([PNG_SIGNATURE, *header, _chunk(b"IDAT", data), _chunk(b"IEND", b"")])
+
+
+def _header_chunks(
+    width: int, height: int, channels: int, palette: np.ndarray | None, compression_filter: int
+) -> tuple[list[bytes], int]:
+    """
+    IHDR and, for palette images, PLTE and tRNS
+
+    returns: (chunks, filter to use for the image data)
+    """
+    chunks = []
+    if palette is not None:
+        if channels != 1:
+            raise ValueError("Palette images must be 2D arrays of indices")
+        palette = np.asarray(palette, dtype=np.uint8)
+        if len(palette) > 256:
+            raise ValueError(f"Palette has {len(palette)} entries, at most 256 allowed")
+        color_type = INDEXED
+        chunks.append(_chunk(b"PLTE", palette[:, :3].tobytes()))
+        if palette.shape[1] == 4:
+            alpha = palette[:, 3]
+            # tRNS may stop after the last non-opaque entry
+            last = np.nonzero(alpha != 255)[0]
+            if len(last):
+                chunks.append(_chunk(b"tRNS", alpha[: last[-1] + 1].tobytes()))
+        # PNG filters on indices rarely help, libpng/ImageMagick use None too
+        if compression_filter == ADAPTIVE_FILTER:
+            compression_filter = 0
+    else:
+        color_type = CHANNELS_TO_COLOR_TYPE[channels]
+    header = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+    return [_chunk(b"IHDR", header), *chunks], compression_filter
+
+
+def _image_data(image: np.ndarray, compression_filter: int, compression_level: int, compression_strategy: int) -> bytes:
+    """
+    Filtered and deflated scanlines of a uint8 image, the payload of IDAT (or fdAT)
+    """
+    height, width = image.shape[:2]
+    channels = 1 if image.ndim == 2 else image.shape[2]
+    raw = filter_image(image.reshape(height, width * channels), channels, compression_filter)
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, 15, 9, compression_strategy)
+    return compressor.compress(raw) + compressor.flush()
+
+
+def encode_apng(
+    frames: list[ApngFrame],
+    palette: np.ndarray | None = None,
+    delay_ms: int = 500,
+    num_plays: int = 0,
+    compression_filter: int = 4,
+    compression_level: int = 9,
+    compression_strategy: int = 1,
+) -> tuple[bytes, list[tuple[int, int]]]:
+    """
+    Encode frames as an animated PNG. Every frame is kept (dispose_op NONE),
+    so the canvas after frame i is frame i drawn over the canvas after i - 1.
+    Decoders without APNG support show the first frame.
+
+    :arg frames: the first one covers the whole canvas at (0, 0)
+    :kwarg palette: as in encode_png, shared by every frame
+    :kwarg delay_ms: display time of each frame
+    :kwarg num_plays: 0 loops forever
+    returns: (data, spans) with spans[i] the (offset, length) of frame i's
+        fcTL and image data chunks in data
+    """
+    first = np.asarray(frames[0].image)
+    height, width = first.shape[:2]
+    if (frames[0].x, frames[0].y) != (0, 0):
+        raise ValueError("The first APNG frame must start at (0, 0)")
+    channels = 1 if first.ndim == 2 else first.shape[2]
+    header, compression_filter = _header_chunks(width, height, channels, palette, compression_filter)
+
+    parts = [PNG_SIGNATURE, *header, _chunk(b"acTL", struct.pack(">II", len(frames), num_plays))]
+    offset = sum(len(part) for part in parts)
+    spans = []
+    sequence = 0
+    for i, frame in enumerate(frames):
+        image = np.ascontiguousarray(frame.image, dtype=np.uint8)
+        frame_height, frame_width = image.shape[:2]
+        if i == 0 and (frame_height, frame_width) != (height, width):
+            raise ValueError("The first APNG frame must cover the whole canvas")
+        if frame.x + frame_width > width or frame.y + frame_height > height:
+            raise ValueError(f"Frame {i} at ({frame.x}, {frame.y}) does not fit in the {width}x{height} canvas")
+        control = struct.pack(
+            ">IIIIIHHBB",
+            sequence,
+            frame_width,
+            frame_height,
+            frame.x,
+            frame.y,
+            delay_ms,
+            1000,
+            DISPOSE_NONE,
+            frame.blend,
+        )
+        data = _image_data(image, compression_filter, compression_level, compression_strategy)
+        if i == 0:
+            # the first frame is also the default image
+            chunks = [_chunk(b"fcTL", control), _chunk(b"IDAT", data)]
+            sequence += 1
+        else:
+            chunks = [_chunk(b"fcTL", control), _chunk(b"fdAT", struct.pack(">I", sequence + 1) + data)]
+            sequence += 2
+        length = sum(len(chunk) for chunk in chunks)
+        spans.append((offset, length))
+        offset += length
+        parts.extend(chunks)
+    parts.append(_chunk(b"IEND", b""))
+    return b"".join(parts), spans
+
+
+def quantize_rgba(rgba: np.ndarray, colors: int = 256) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Convert an RGBA image to palette indices and an RGBA palette.
+    Exact when the image has at most `colors` distinct colours, otherwise
+    falls back to Pillow's fast octree quantizer.
+
+    returns: (indices (height, width) uint8, palette (n, 4) uint8)
+    """
+    packed = np.ascontiguousarray(rgba, dtype=np.uint8).view(np.uint32)[..., 0]
+    unique, inverse = np.unique(packed, return_inverse=True)
+    if len(unique) <= colors:
+        palette = unique.view(np.uint8).reshape(-1, 4)
+        return inverse.reshape(packed.shape).astype(np.uint8), palette
+
+    from PIL import Image
+
+    logger.debug(f"Image has {len(unique)} colours, quantizing to {colors}")
+    quantized = Image.fromarray(rgba, mode="RGBA").quantize(colors, method=Image.Quantize.FASTOCTREE)
+    palette = np.array(quantized.getpalette("RGBA"), dtype=np.uint8).reshape(-1, 4)[:colors]
+    return np.asarray(quantized, dtype=np.uint8), palette
+
+
+def write_png(
+    filename: Path | str,
+    image: np.ndarray,
+    palette: np.ndarray | None = None,
+    quantize=False,
+    compression_filter: int = 4,
+    compression_level: int = 9,
+    compression_strategy: int = 1,
+) -> int:
+    """
+    Encode and write a PNG in one step. RGBA images are converted to a
+    palette first when quantize is True.
+
+    returns: number of bytes written
+    """
+    if quantize and palette is None and image.ndim == 3 and image.shape[2] == 4:
+        image, palette = quantize_rgba(image)
+    data = encode_png(
+        image,
+        palette=palette,
+        compression_filter=compression_filter,
+        compression_level=compression_level,
+        compression_strategy=compression_strategy,
+    )
+    with open(filename, "wb") as f:
+        f.write(data)
+    return len(data)
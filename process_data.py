@@ -1,31 +1,48 @@
 #!/Users/jal194/anaconda3/bin/python
 import glob
+import hashlib
 import json
+import os
 import yaml
 import datetime as dt
 from pathlib import Path
 import argparse, sys
+from collections import defaultdict
 import numpy as np
 import xarray as xr
+import dask
+import dask.array
 from tempo_process_funcs import (
     process_file,
+    read_granule_arrays,
+    read_granule_coords,
+    mask_granule,
     get_bounds,
-    chunk_to_fname,
+    datetime64_to_fname,
+    fname_to_datetime64,
     chunk_time_to_jstime,
+    datetime64_to_jstime,
     svs_tempo_cmap,
     get_field_of_regards,
-    reproject_data,
+    reproject_bands,
     save_image,
     cloud_cover_mask,
 )
 import tqdm
-from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from matplotlib.colors import LinearSegmentedColormap
 
+from granule_inventory import GranuleInventory
+from xyz_tiles import TILEJSON_NAME, save_tiles
+from data_product import product_filename, write_product
+from animate_frames import animate_directory, frame_pattern
+from processing_cache import ProcessingCache, cache_key, file_fingerprint, pack_levels, unpack_levels
 from logger import setup_logging , set_log_level
 logger = setup_logging(debug = False, name = 'process_data')
 
-from typing import List, Tuple
+from typing import Iterable, Iterator, List, Tuple
 
 cloud_cmap = LinearSegmentedColormap.from_list(
     "gray_solid", ["#707070", "#707070"], N=256
@@ -64,6 +81,14 @@ def parse_arguments() -> argparse.Namespace:
     parser.add_argument("-l", "--level", type=str, help="TEMPO time", default="3")
     parser.add_argument("--suffix", type=str, help="A suffix to append to filename", default="")
     parser.add_argument("--singlethreaded", help="Create singlethreaded only", action="store_true")
+    parser.add_argument(
+        "--executor",
+        type=str,
+        choices=["threads", "processes", "serial"],
+        help="How to run the image rendering (default: threads)",
+        default=None,
+    )
+    parser.add_argument("--workers", type=int, help="Number of rendering workers (default: 10)", default=None)
     parser.add_argument(
         "--dry-run",
         help="Print the commands that would be run, but do not run them",
@@ -71,6 +96,74 @@ def parse_arguments() -> argparse.Namespace:
     )
     parser.add_argument("--no-reproject", help="Do not reproject the images", action="store_true")
     parser.add_argument("--method", type=str, help="Method to use for reprojection", default="average")
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="Keep NO2 and cloud fraction in float32 through reprojection (about half the memory)",
+    )
+    parser.add_argument("--pyramid", action="store_true", help="Reproject once and block average the lower resolutions")
+    parser.add_argument("--levels", type=int, help="Number of resolution levels to output (full, half, ...)", default=2)
+    parser.add_argument(
+        "--tiles",
+        action="store_true",
+        help="Write z/x/y slippy map tiles under <output>/tiles/<timestamp> instead of full-frame images",
+    )
+    parser.add_argument(
+        "--tile-zooms",
+        type=int,
+        nargs=2,
+        metavar=("MIN", "MAX"),
+        help="Zoom range for --tiles (default: native zoom and four overview zooms below it)",
+        default=None,
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Process one granule at a time instead of combining all files first (bounded memory)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help="Cache masked and reprojected arrays here and reuse them on later runs (implies --stream)",
+        default=None,
+    )
+    parser.add_argument(
+        "--animate",
+        action="store_true",
+        help="Also pack each day's images into a delta-encoded APNG under <output>/animations. "
+        "Only pays off for cumulative composites: per-granule images change nearly everywhere, "
+        "so their animation is about as large as the PNGs",
+    )
+    parser.add_argument(
+        "--product-dir",
+        type=str,
+        help="Also write the reprojected NO2 and cloud fraction grids as cloud-optimized GeoTIFFs here",
+        default=None,
+    )
+    parser.add_argument(
+        "--product-max-error",
+        type=float,
+        help="Store the products with LERC compression within this error (NO2 in 10^16) instead of lossless DEFLATE",
+        default=None,
+    )
+    parser.add_argument("--cache-size", type=float, help="Maximum cache size in GB (default: 20)", default=20)
+    parser.add_argument(
+        "--scratch-dir",
+        type=str,
+        help="Write the combined NO2 and cloud cubes to memory-mapped .npy files under <scratch-dir>/<name>",
+        default=None,
+    )
+    parser.add_argument(
+        "--keep-scratch",
+        action="store_true",
+        help="Leave the --scratch-dir cubes in place after rendering (reopen them with open_scratch_store)",
+    )
+    parser.add_argument(
+        "--inventory",
+        type=str,
+        help="Granule inventory database: find input files and existing images in it and record new images",
+        default=None,
+    )
     parser.add_argument("--text-files-only", help="Only process text files", action="store_true")
     parser.add_argument("--debug", help="Enable debug logging", action="store_true")
     parser.add_argument("--cloud-cmap", help="Set color map for clouds cover. Default is solid grey")
@@ -78,6 +171,11 @@ def parse_arguments() -> argparse.Namespace:
     parser.add_argument("--vmin", type=float, help="Minimum value for color map", default=1)
     parser.add_argument("--vmax", type=float, help="Maximum value for color map", default=150)
     parser.add_argument("--overwrite", action="store_true", help="Overwrite the output images if they already exist")
+    parser.add_argument(
+        "--skip-existing",
+        action="store_true",
+        help="Skip input files whose images already exist without reading them (text files then only cover the new files)",
+    )
     parser.add_argument("--config", type=str, help="Configuration file", default="process.yaml")
     return parser.parse_args()
 
@@ -135,18 +233,163 @@ def setup_directories(
 
 
 def get_input_files(
-    directory: Path, pattern: str, level: str, version: str
+    directory: Path, pattern: str, level: str, version: str, inventory: GranuleInventory | None = None
 ) -> List[str]:
     """
     Get input files based on the provided pattern.
+    inventory: look the files up in the inventory instead of globbing directory
     """
     if pattern is None:
         pattern = f"TEMPO_NO2_L{level}_V0{version}*_S*.nc"
-    files = glob.glob(f"{directory}/{pattern}")
+    if inventory is not None:
+        files = inventory.granules(directory, pattern)
+    else:
+        files = glob.glob(f"{directory}/{pattern}")
     logger.debug(f"Found {len(files)} input files with pattern {pattern}")
     return files
 
 
+def tile_directory(output: Path, time: np.datetime64, suffix: str) -> Path:
+    """
+    Directory holding the z/x/y tiles of one timestep, output/tiles/tempo_<time><suffix>
+    """
+    return output / "tiles" / Path(datetime64_to_fname(time, suffix)).stem
+
+
+def expected_outputs(time: np.datetime64, output: Path, suffix: str, levels: int, tiles=False) -> List[Path]:
+    """
+    Image paths process_and_save_arrays writes for one timestep, one per level,
+    or with tiles the TileJSON file that is written once all tiles are done
+    """
+    if tiles:
+        return [tile_directory(output, time, suffix) / TILEJSON_NAME]
+    fname = datetime64_to_fname(time, suffix)
+    return [level_directory(output, level) / fname for level in range(levels)]
+
+
+def skip_finished_granules(
+    input_files: List[str],
+    output: Path,
+    cloud_output: Path | None,
+    suffix: str,
+    levels: int,
+    inventory: GranuleInventory | None = None,
+    tiles=False,
+    product_output: Path | None = None,
+) -> List[str]:
+    """
+    Drop input files whose images already exist, before any NetCDF is opened.
+
+    The timestep is taken from the file name, so this only lists the output
+    directories. Files without a timestamp in their name are always kept.
+    cloud_output: also require the cloud images when given
+    inventory: take the existing images from the inventory instead of listing the directories
+        (the inventory only holds the PNGs, tiles and products are looked for on disk)
+    product_output: also require the data products in this directory
+    """
+    listings = {}
+
+    def exists(path: Path) -> bool:
+        if path.parent not in listings:
+            if inventory is not None and path.suffix == ".png":
+                listings[path.parent] = inventory.image_names(path.parent)
+            else:
+                listings[path.parent] = set(os.listdir(path.parent)) if path.parent.is_dir() else set()
+        return path.name in listings[path.parent]
+
+    remaining = []
+    for input_file in input_files:
+        time = fname_to_datetime64(input_file)
+        if time is None:
+            remaining.append(input_file)
+            continue
+        outputs = expected_outputs(time, output, suffix, levels, tiles)
+        if cloud_output is not None:
+            outputs += expected_outputs(time, cloud_output, suffix, levels, tiles)
+        if product_output is not None:
+            outputs.append(Path(product_output) / product_filename(time, suffix))
+        if not all(exists(path) for path in outputs):
+            remaining.append(input_file)
+    logger.info(f"Skipping {len(input_files) - len(remaining)} of {len(input_files)} files with existing images")
+    return remaining
+
+
+def granule_text_data(input_files: List[str]) -> Tuple[List[tuple], List[int], List[str]]:
+    """
+    What the text files need from granules that are not rendered (those
+    --skip-existing drops), read from their coordinates and attributes only.
+
+    returns: (extents, times, geospatial_bounds), one extent (as get_bounds
+        returns it) and JS time per timestep and one geospatial_bounds per file
+    """
+    extents, times, geospatial_bounds = [], [], []
+    for input_file in input_files:
+        coords = read_granule_coords(input_file)
+        # get_bounds only looks at the coordinates, so the data is a zero-stride view
+        grid = xr.DataArray(
+            np.broadcast_to(np.float32(np.nan), (coords.sizes["latitude"], coords.sizes["longitude"])),
+            dims=("latitude", "longitude"),
+            coords={"latitude": coords["latitude"], "longitude": coords["longitude"]},
+        )
+        extent = get_bounds(grid)
+        for time in coords["time"].values:
+            extents.append(extent)
+            times.append(datetime64_to_jstime(time))
+        geospatial_bounds.append(coords.attrs["geospatial_bounds"])
+    logger.debug(f"Read text data of {len(input_files)} skipped files")
+    return extents, times, geospatial_bounds
+
+
+def union_bounds(extents: List[tuple]) -> Tuple[float, float, float, float]:
+    """
+    Bounds covering every (lon_min, lon_max, lat_min, lat_max) extent
+    """
+    lonmin, lonmax, latmin, latmax = np.array(extents).T
+    return lonmin.min(), lonmax.max(), latmin.min(), latmax.max()
+
+
+def record_outputs(
+    inventory: GranuleInventory, input_files: List[str], output: Path, cloud_output: Path | None, suffix: str, levels: int
+) -> None:
+    """
+    Add the images written for input_files to the inventory
+    """
+    paths = []
+    for input_file in input_files:
+        time = fname_to_datetime64(input_file)
+        if time is None:
+            continue
+        paths += expected_outputs(time, output, suffix, levels)
+        if cloud_output is not None:
+            paths += expected_outputs(time, cloud_output, suffix, levels)
+    recorded = inventory.add_files(paths)
+    logger.debug(f"Recorded {recorded} images in {inventory}")
+
+
+def animate_outputs(
+    times: List[np.datetime64],
+    output: Path,
+    cloud_output: Path | None,
+    suffix: str,
+    levels: int,
+    overwrite=False,
+) -> None:
+    """
+    Pack the images of every day the rendered times fall on into one
+    animation per day and level, including the frames of that day from
+    earlier runs. The days are read from the image names, so a scan that
+    crosses midnight repacks the day its frame is filed under.
+    """
+    pattern = frame_pattern(suffix)
+    days = defaultdict(set)
+    for directory in [output] + ([cloud_output] if cloud_output is not None else []):
+        for time in times:
+            for path in expected_outputs(time, directory, suffix, levels):
+                days[path.parent].add(pattern.match(path.name).group(1))
+    for directory, dates in days.items():
+        animate_directory(directory, suffix=suffix, days=sorted(dates), overwrite=overwrite)
+
+
 def process_files(
     input_files: List[str], quality_flag: str, sample: bool
 ) -> Tuple[List[xr.Dataset], List[str], List[dict], List[xr.Dataset]]:
@@ -167,24 +410,152 @@ def process_files(
 
 
 def combine_data(
-    input_data: List[xr.Dataset], support: List[xr.Dataset]
+    input_data: List[xr.Dataset],
+    support: List[xr.Dataset],
+    scratch_dir: Path | None = None,
+    start_times: List[dt.datetime] | None = None,
 ) -> Tuple[xr.DataArray | xr.Dataset, xr.DataArray | xr.Dataset]:
     """
     Combine input data and support data into single datasets.
+
+    Granules that share one lat/lon grid (the normal case for TEMPO L3) are
+    stacked directly along time in start time order, holding only
+    vertical_column_troposphere and eff_cloud_fraction. Otherwise this falls
+    back to xr.combine_by_coords.
+
+    scratch_dir: write the NO2 and cloud fraction cubes there as time-major
+        .npy memmaps (see stack_granules) and return datasets backed by them
+    start_times: time_coverage_start of each granule (from process_files),
+        used to order them. Defaults to each granule's first time value
     """
-    # Align coordinates of support datasets with input_data
-    aligned_support = []
-    for i, s in enumerate(support):
-        aligned_support.append(s.assign_coords(input_data[i].coords))
+    if start_times is None:
+        start_times = [ds["time"].values[0] for ds in input_data]
+    order = sorted(range(len(input_data)), key=lambda i: start_times[i])
+    times = np.concatenate([input_data[i]["time"].values for i in order]) if order else []
 
-    final_data = xr.combine_by_coords(input_data)
-    support_data = xr.combine_by_coords(aligned_support)
+    if len({grid_hash(ds) for ds in input_data}) == 1 and np.all(np.diff(times) > np.timedelta64(0)):
+        scratch = (lambda name: None) if scratch_dir is None else (lambda name: Path(scratch_dir) / f"{name}.npy")
+        name, cloud_name = "vertical_column_troposphere", "eff_cloud_fraction"
+        final_data = stack_granules([input_data[i][name] for i in order], scratch(name)).to_dataset()
+        support_data = stack_granules(
+            [support[i][cloud_name].assign_coords(input_data[i].coords) for i in order], scratch(cloud_name)
+        ).to_dataset()
+    else:
+        logger.info("Granules are not on one grid with distinct times, combining by coordinates")
+        # Align coordinates of support datasets with input_data
+        aligned_support = []
+        for i, s in enumerate(support):
+            aligned_support.append(s.assign_coords(input_data[i].coords))
+
+        final_data = xr.combine_by_coords(input_data)
+        support_data = xr.combine_by_coords(aligned_support)
+        if scratch_dir is not None:
+            final_data = stack_granules(
+                [final_data["vertical_column_troposphere"]], Path(scratch_dir) / "vertical_column_troposphere.npy"
+            ).to_dataset()
+            support_data = stack_granules(
+                [support_data["eff_cloud_fraction"]], Path(scratch_dir) / "eff_cloud_fraction.npy"
+            ).to_dataset()
     _ = final_data.rio.write_crs("epsg:4326", inplace=True)
     _ = support_data.rio.write_crs("epsg:4326", inplace=True)
     logger.debug("Combined input data and support data")
     return final_data, support_data
 
 
+SCRATCH_DIMS = ("time", "latitude", "longitude")
+
+
+def grid_hash(ds: xr.Dataset) -> str:
+    """
+    Cheap identity of a granule's lat/lon grid
+    """
+    digest = hashlib.sha1()
+    for dim in ("latitude", "longitude"):
+        values = np.ascontiguousarray(ds[dim].values)
+        digest.update(str(values.dtype).encode() + str(values.shape).encode() + values.tobytes())
+    return digest.hexdigest()
+
+
+def stack_granules(arrays: List[xr.DataArray], path: Path | None = None) -> xr.DataArray:
+    """
+    Concatenate (time, latitude, longitude) arrays on one grid along time,
+    in the order given, without any coordinate inference.
+
+    path None: a lazy dask concatenation, nothing is read
+    path: preallocate a .npy file, fill it one time slice at a time (so the
+        cube is never held in memory) and return it reopened as a memmap
+        (open_scratch_store). The coordinates are saved in <name>.coords.npz.
+        Delete both with remove_scratch_store.
+    """
+    arrays = [array.transpose(*SCRATCH_DIMS) for array in arrays]
+    first = arrays[0]
+    time = np.concatenate([array["time"].values for array in arrays])
+    coords = {
+        "time": ("time", time, first["time"].attrs),
+        "latitude": first["latitude"].variable,
+        "longitude": first["longitude"].variable,
+    }
+    if path is None:
+        data = dask.array.concatenate([dask.array.asarray(array.data) for array in arrays], axis=0)
+        return xr.DataArray(data, dims=SCRATCH_DIMS, coords=coords, name=first.name, attrs=first.attrs)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    dtype = np.result_type(*[array.dtype for array in arrays])
+    shape = (len(time),) + first.shape[1:]
+    store = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+    i = 0
+    with tqdm.tqdm(total=shape[0], desc=f"Writing {path.name}") as progress:
+        for array in arrays:
+            for j in range(array.sizes["time"]):
+                store[i] = array.isel(time=j).to_numpy()
+                i += 1
+                progress.update(1)
+    store.flush()
+    del store
+    np.savez(
+        path.with_suffix(".coords.npz"),
+        time=time,
+        latitude=first["latitude"].values,
+        longitude=first["longitude"].values,
+    )
+    logger.info(f"Wrote {dtype} cube {shape} to {path}")
+    return open_scratch_store(path, name=first.name, attrs=first.attrs)
+
+
+def remove_scratch_store(path: Path | str) -> None:
+    """
+    Delete a cube written by stack_granules and its coordinates file
+    """
+    path = Path(path)
+    for part in (path, path.with_suffix(".coords.npz")):
+        part.unlink(missing_ok=True)
+    logger.debug(f"Removed scratch cube {path}")
+
+
+def _read_scratch_slice(path: str, i: int) -> np.ndarray:
+    return np.load(path, mmap_mode="r")[i : i + 1]
+
+
+def open_scratch_store(path: Path | str, name: str | None = None, attrs: dict | None = None) -> xr.DataArray:
+    """
+    Reopen a cube written by stack_granules as a read-only memmap,
+    one dask chunk per time slice. Each chunk is a view of the file, so only
+    the pages that are used get read. (xarray's .chunk() and dask's
+    from_array copy a numpy memmap into memory up front.)
+    """
+    path = Path(path)
+    header = np.load(path, mmap_mode="r")
+    shape, dtype = header.shape, header.dtype
+    del header
+    slices = [
+        dask.array.from_delayed(dask.delayed(_read_scratch_slice)(str(path), i), (1,) + shape[1:], dtype)
+        for i in range(shape[0])
+    ]
+    array = dask.array.concatenate(slices) if slices else dask.array.empty(shape, dtype=dtype)
+    with np.load(path.with_suffix(".coords.npz")) as coords:
+        coords = {dim: coords[dim] for dim in SCRATCH_DIMS}
+    return xr.DataArray(array, dims=SCRATCH_DIMS, coords=coords, name=name or path.stem, attrs=attrs or {})
+
 
 def output_text_data(
     rechunk: xr.DataArray,
@@ -193,21 +564,48 @@ def output_text_data(
     output: Path,
     suffix: str,
     no_output: bool,
+    skipped: Tuple[List[tuple], List[int], List[str]] | None = None,
 ) -> None:
     """
     Output the bounds data to files.
+
+    skipped: granule_text_data of the granules that were not rendered,
+        so the files still cover every granule
     """
     if no_output:
         logger.info("No output flag is set. Skipping text data output.")
         return
-    
+
+    logger.debug("Bounds of the data:")
+    bounds = get_bounds(rechunk)
+    times = [chunk_time_to_jstime(ch) for ch in rechunk]
+    if skipped is not None:
+        extents, skipped_times, skipped_bounds = skipped
+        bounds = union_bounds([bounds, *extents])
+        times = times + skipped_times
+        geospatial_bounds = geospatial_bounds + skipped_bounds
+    write_text_data(bounds, times, geospatial_bounds, name, output, suffix)
+
+
+def write_text_data(
+    bounds: Tuple[float, float, float, float],
+    times: List[int],
+    geospatial_bounds: List[dict],
+    name: str,
+    output: Path,
+    suffix: str,
+) -> None:
+    """
+    Write the bounds, field of regard and times files.
+
+    bounds: (lon_min, lon_max, lat_min, lat_max) as returned by get_bounds
+    times: JS timestamps (ms) of each timestep
+    """
     if '/' in name:
         name = name.split('/')[-1]
     
     logger.info(f"Outputting text data to {output} with name {name} and suffix {suffix}")
 
-    logger.debug("Bounds of the data:")
-    bounds = get_bounds(rechunk)
     if not output.exists():
         raise FileNotFoundError(f"Output directory {output} does not exist")
     # create uuid from timestamp
@@ -237,7 +635,7 @@ def output_text_data(
         json.dump(fors, f)
 
     logger.debug(f"Saving times to {output} as times_{name}_{uuid}.npy")
-    times = list(sorted([chunk_time_to_jstime(ch) for ch in rechunk]))
+    times = list(sorted(times))
     
     
     
@@ -246,6 +644,19 @@ def output_text_data(
     logger.debug(f"Output text data to {output}")
 
 
+def level_directory(output: Path, level: int) -> Path:
+    """
+    Directory for images at a given resolution level.
+    Level 0 (full) goes in output, level 1 (half) in output/resized_images and
+    each further halving in output/resized_images_<factor>
+    """
+    if level == 0:
+        return output
+    if level == 1:
+        return output / "resized_images"
+    return output / f"resized_images_{2**level}"
+
+
 def process_and_save_chunk(
     chunk: xr.DataArray,
     cloud_data: xr.DataArray,
@@ -260,7 +671,14 @@ def process_and_save_chunk(
     cloud_threshold: float = 0.5,
     cloud_output=False,
     no_output=False,
-    overwrite=False
+    overwrite=False,
+    pyramid=False,
+    levels: int = 2,
+    dtype=np.float64,
+    tiles=False,
+    tile_zooms: Tuple[int, int] | None = None,
+    product_output: Path | None = None,
+    product_max_error: float | None = None,
 ) -> None:
     if no_output:
         logger.info("No output flag is set. Skipping image saving.")
@@ -268,37 +686,303 @@ def process_and_save_chunk(
 
     logger.debug(f"Processing chunk with time {chunk.time.values}")
 
-    # Reproject data without applying cloud mask
-    full_res, half_res = reproject_data(chunk, bounds, reproject, method)
+    process_and_save_arrays(
+        chunk.to_numpy(),
+        cloud_data.to_numpy(),
+        chunk.time.values,
+        cmap,
+        vmin,
+        vmax,
+        output,
+        suffix,
+        bounds,
+        reproject,
+        method,
+        cloud_threshold,
+        cloud_output=cloud_output,
+        overwrite=overwrite,
+        pyramid=pyramid,
+        levels=levels,
+        dtype=dtype,
+        tiles=tiles,
+        tile_zooms=tile_zooms,
+        product_output=product_output,
+        product_max_error=product_max_error,
+    )
+
 
-    # Reproject cloud data
-    full_res_cloud, half_res_cloud = reproject_data(
-        cloud_data, bounds, reproject, method
+def process_and_save_arrays(
+    data: np.ndarray,
+    cloud_data: np.ndarray,
+    time: np.datetime64,
+    cmap: LinearSegmentedColormap | str,
+    vmin: float,
+    vmax: float,
+    output: Path,
+    suffix: str,
+    bounds,
+    reproject=True,
+    method="average",
+    cloud_threshold: float = 0.5,
+    cloud_output=False,
+    overwrite=False,
+    pyramid=False,
+    levels: int = 2,
+    cache: ProcessingCache | None = None,
+    source_key: str | None = None,
+    dtype=np.float64,
+    tiles=False,
+    tile_zooms: Tuple[int, int] | None = None,
+    product_output: Path | None = None,
+    product_max_error: float | None = None,
+    cloud_images: dict | None = None,
+) -> None:
+    """
+    Reproject, cloud mask and save one timestep given as plain numpy arrays,
+    so it can run in a worker process without any xarray/dask objects.
+
+    cache, source_key: reuse the reprojected grids stored under source_key
+        (the key of the masked input arrays) and these projection settings
+    dtype: dtype used for reprojection, float32 halves the memory
+    tiles: cut the full resolution frame into z/x/y tiles over tile_zooms
+        instead of saving one image per level
+    product_output: also write the full resolution NO2 and cloud fraction
+        grids as a cloud-optimized GeoTIFF in this directory
+    product_max_error: LERC error bound for the product, None for lossless DEFLATE
+    cloud_images: also save the cloud fraction images from the same grids,
+        given the cmap, vmin, vmax and output for them
+    """
+    if tiles:
+        # the tiles of every zoom are resampled from the full resolution frame
+        pyramid, levels = False, 1
+    key = None
+    projected = None
+    if cache is not None and source_key is not None:
+        key = cache_key("projected", source_key, str(time), reproject, method, pyramid, levels, np.dtype(dtype).name)
+        arrays = cache.load(key)
+        projected = unpack_levels(arrays) if arrays is not None else None
+
+    if projected is None:
+        # Reproject data and cloud data together, without applying cloud mask
+        projected = reproject_bands(
+            {"data": data, "cloud": cloud_data},
+            bounds,
+            reproject,
+            method,
+            pyramid=pyramid,
+            levels=levels,
+            dtype=dtype,
+        )
+        if key is not None:
+            cache.store(key, pack_levels(projected))
+
+    if product_output is not None and not cloud_output:
+        # one product per timestep holds both grids, written from the NO2 pass
+        write_product(
+            Path(product_output) / product_filename(time, suffix),
+            projected["data"][0],
+            projected["cloud"][0],
+            time,
+            bounds,
+            reproject,
+            cloud_threshold,
+            overwrite=overwrite,
+            max_error=product_max_error,
+        )
+
+    save_projected(
+        projected,
+        time,
+        cmap,
+        vmin,
+        vmax,
+        output,
+        suffix,
+        bounds,
+        cloud_threshold,
+        cloud_output=cloud_output,
+        overwrite=overwrite,
+        tiles=tiles,
+        tile_zooms=tile_zooms,
     )
+    if cloud_images is not None:
+        save_projected(
+            {"data": projected["cloud"], "cloud": projected["cloud"]},
+            time,
+            suffix=suffix,
+            bounds=bounds,
+            cloud_threshold=cloud_threshold,
+            cloud_output=True,
+            overwrite=overwrite,
+            tiles=tiles,
+            tile_zooms=tile_zooms,
+            **cloud_images,
+        )
 
-    # Generate cloud masks for full and half resolution
-    full_cloud_mask = full_res_cloud > cloud_threshold
-    half_cloud_mask = half_res_cloud > cloud_threshold
 
-    # Apply cloud mask after reprojection
-    if not cloud_output:
-        full_res_masked = np.where(~full_cloud_mask, full_res, np.nan)
-        half_res_masked = np.where(~half_cloud_mask, half_res, np.nan)
-    else:
-        full_res_masked = np.where(full_cloud_mask, full_res, np.nan)
-        half_res_masked = np.where(half_cloud_mask, half_res, np.nan)
+def save_projected(
+    projected: dict[str, Tuple[np.ndarray, ...]],
+    time: np.datetime64,
+    cmap: LinearSegmentedColormap | str,
+    vmin: float,
+    vmax: float,
+    output: Path,
+    suffix: str,
+    bounds,
+    cloud_threshold: float = 0.5,
+    cloud_output=False,
+    overwrite=False,
+    tiles=False,
+    tile_zooms: Tuple[int, int] | None = None,
+) -> None:
+    """
+    Cloud mask and save reprojected levels as returned by reproject_bands
+    with "data" and "cloud" bands, one image per level or tiles from level 0
+    """
+    for level, (data, cloud) in enumerate(zip(projected["data"], projected["cloud"])):
+        # Generate cloud mask for this resolution
+        cloud_mask = cloud > cloud_threshold
+
+        # Apply cloud mask after reprojection
+        if not cloud_output:
+            masked = np.where(~cloud_mask, data, np.nan)
+        else:
+            masked = np.where(cloud_mask, data, np.nan)
 
-    # Save full resolution image
-    full_filename = output / chunk_to_fname(chunk, suffix)
-    save_image(full_res_masked, cmap, vmin, vmax, full_filename, overwrite=overwrite)
-    logger.debug(f"Saved full resolution image to {full_filename}")
+        if tiles:
+            directory = tile_directory(output, time, suffix)
+            count, size = save_tiles(masked, bounds, cmap, vmin, vmax, directory, tile_zooms, overwrite=overwrite)
+            logger.debug(f"Saved {count} tiles ({size / 2**20:.1f} MB) to {directory}")
+            break
 
-    # Save half resolution image
-    half_filename = output / "resized_images" / chunk_to_fname(chunk, suffix)
-    if not half_filename.parent.exists():
-        half_filename.parent.mkdir(parents=True, exist_ok=False)
-    save_image(half_res_masked, cmap, vmin, vmax, half_filename,overwrite=overwrite)
-    logger.debug(f"Saved half resolution image to {half_filename}")
+        # Save image, level 0 is full resolution and level 1 is half resolution
+        filename = level_directory(output, level) / datetime64_to_fname(time, suffix)
+        if not filename.parent.exists():
+            filename.parent.mkdir(parents=True, exist_ok=True)
+        # masked stays in the frame's dtype, but the colormap arithmetic runs
+        # in float64 (a strip at a time), so float32 only changes storage and
+        # the warp, not the normalisation
+        save_image(masked, cmap, vmin, vmax, filename, overwrite=overwrite, dtype=np.float64)
+        logger.debug(f"Saved level {level} image to {filename}")
+
+
+def _to_shared_memory(array: np.ndarray) -> Tuple[SharedMemory, dict]:
+    """
+    Copy an array into a new shared memory block.
+    returns: (block, spec) where spec is what a worker needs to attach to it
+    """
+    array = np.ascontiguousarray(array)
+    block = SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, {"name": block.name, "shape": array.shape, "dtype": array.dtype.str}
+
+
+def _render_shared(data_spec: dict, cloud_spec: dict, time: np.datetime64, kwargs: dict) -> None:
+    """
+    Worker process entry point: attach to the shared arrays and render them
+    """
+    blocks = [SharedMemory(name=spec["name"]) for spec in (data_spec, cloud_spec)]
+    try:
+        data, cloud = [
+            np.ndarray(spec["shape"], dtype=np.dtype(spec["dtype"]), buffer=block.buf)
+            for spec, block in zip((data_spec, cloud_spec), blocks)
+        ]
+        process_and_save_arrays(data, cloud, time, **kwargs)
+        # drop the views before closing the blocks
+        del data, cloud
+    finally:
+        for block in blocks:
+            block.close()
+
+
+def iter_timesteps(
+    rechunk: xr.DataArray, cloud_data: xr.DataArray, kwargs: dict
+) -> Iterator[Tuple[np.ndarray, np.ndarray, np.datetime64, dict]]:
+    """
+    Load one time slice at a time as (data, cloud, time, kwargs) render tasks
+    """
+    for time in rechunk.time.values:
+        chunk = rechunk.sel(time=time)
+        bounds = get_bounds(chunk, pairs=True)
+        yield chunk.to_numpy(), cloud_data.sel(time=time).to_numpy(), time, {**kwargs, "bounds": bounds}
+
+
+def run_tasks(
+    tasks: Iterable[Tuple[np.ndarray, np.ndarray, np.datetime64, dict]],
+    executor_kind: str,
+    workers: int,
+    total: int | None = None,
+) -> None:
+    """
+    Run process_and_save_arrays over (data, cloud, time, kwargs) tasks.
+
+    Tasks are pulled from the iterable only as workers free up (at most
+    2 * workers in flight), so a generator that reads data lazily keeps memory
+    bounded however many timesteps there are. With processes the arrays are
+    handed over through shared memory.
+    """
+    with tqdm.tqdm(total=total, desc="Processing chunks") as progress:
+        if executor_kind == "serial":
+            for data, cloud, time, kwargs in tasks:
+                process_and_save_arrays(data, cloud, time, **kwargs)
+                progress.update(1)
+            return
+
+        if executor_kind == "processes":
+            executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers)
+
+        def submit(data, cloud, time, kwargs):
+            if executor_kind != "processes":
+                return executor.submit(process_and_save_arrays, data, cloud, time, **kwargs), ()
+            blocks = []
+            try:
+                data_block, data_spec = _to_shared_memory(data)
+                blocks.append(data_block)
+                cloud_block, cloud_spec = _to_shared_memory(cloud)
+                blocks.append(cloud_block)
+                future = executor.submit(_render_shared, data_spec, cloud_spec, time, kwargs)
+            except BaseException:
+                release(blocks)
+                raise
+            return future, tuple(blocks)
+
+        def release(blocks):
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+        pending = {}
+
+        def collect(futures):
+            for future in futures:
+                blocks = pending.pop(future)
+                try:
+                    future.result()
+                finally:
+                    # only free the inputs once the worker is finished with them
+                    release(blocks)
+                progress.update(1)
+
+        with executor:
+            try:
+                for task in tasks:
+                    future, blocks = submit(*task)
+                    pending[future] = blocks
+                    if len(pending) >= 2 * workers:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                collect(list(pending))
+            finally:
+                # after a failure the other tasks may still be reading their
+                # blocks, let them finish before unlinking what is left
+                wait(pending)
+                for blocks in pending.values():
+                    release(blocks)
+                pending.clear()
 
 
 def process_new_data(
@@ -316,18 +1000,46 @@ def process_new_data(
     method="average",
     cloud_threshold: float = 0.5,
     cloud_output=False,
-    overwrite=False
+    overwrite=False,
+    skipped: Tuple[List[tuple], List[int], List[str]] | None = None,
 ) -> None:
 
     logger.debug("Rechunking data")
     rechunk = dataarray.chunk(chunks={"longitude": 188, "latitude": 373, "time": 1})
-    output_text_data(rechunk, geospatial_bounds, name, output, suffix, args.no_output)
+    output_text_data(rechunk, geospatial_bounds, name, output, suffix, args.no_output, skipped)
 
     if args.text_files_only:
         return
 
     logger.info(f"Processing {name} data")
 
+    executor_kind = get_executor_kind(args, len(rechunk.time))
+    workers = args.workers
+
+    if executor_kind == "processes" and not args.no_output:
+        logger.debug(f"Using ProcessPool with {workers} workers")
+        kwargs = dict(
+            cmap=cmap,
+            vmin=vmin,
+            vmax=vmax,
+            output=output,
+            suffix=suffix,
+            reproject=reproject,
+            method=method,
+            cloud_threshold=cloud_threshold,
+            cloud_output=cloud_output,
+            overwrite=overwrite,
+            pyramid=args.pyramid,
+            levels=args.levels,
+            dtype=get_dtype(args),
+            tiles=args.tiles,
+            tile_zooms=args.tile_zooms,
+            product_output=args.product_dir,
+            product_max_error=args.product_max_error,
+        )
+        run_tasks(iter_timesteps(rechunk, cloud_data, kwargs), "processes", workers, len(rechunk.time))
+        return
+
     def process_chunk(time):
         chunk = rechunk.sel(time=time)
         cloud_chunk = cloud_data.sel(time=time)
@@ -345,12 +1057,19 @@ def process_new_data(
             cloud_threshold,
             cloud_output=cloud_output,
             no_output=args.no_output,
-            overwrite=overwrite
+            overwrite=overwrite,
+            pyramid=args.pyramid,
+            levels=args.levels,
+            dtype=get_dtype(args),
+            tiles=args.tiles,
+            tile_zooms=args.tile_zooms,
+            product_output=args.product_dir,
+            product_max_error=args.product_max_error,
         )
 
-    if not args.singlethreaded and len(rechunk.time) >= 3:
-        logger.debug("Using ThreadPool")
-        with ThreadPoolExecutor(max_workers=10) as executor:
+    if executor_kind == "threads":
+        logger.debug(f"Using ThreadPool with {workers} workers")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
             list(
                 tqdm.tqdm(
                     executor.map(process_chunk, rechunk.time.values),
@@ -363,16 +1082,188 @@ def process_new_data(
             process_chunk(time)
 
 
+def read_granule(
+    input_file: str, quality_flag: str, dtype=np.float64
+) -> Tuple[xr.DataArray, xr.DataArray, dict]:
+    """
+    Read one granule and scale it the same way main() scales the combined cube.
+
+    returns: (no2, cloud, geospatial_bounds) with no2 in units of 10^16
+    """
+    coords, product, geoloc, support = read_granule_arrays(input_file)
+    no2, cloud = mask_granule(
+        product["vertical_column_troposphere"].values,
+        product["main_data_quality_flag"].values,
+        geoloc["solar_zenith_angle"].values,
+        support["eff_cloud_fraction"].values,
+        quality_flag,
+        dtype=dtype,
+    )
+    dims = product["vertical_column_troposphere"].dims
+    no2 = xr.DataArray(no2, dims=dims, coords=coords.coords)
+    cloud = xr.DataArray(cloud, dims=dims, coords=coords.coords)
+    return no2, cloud, coords.geospatial_bounds
+
+
+def load_granule(
+    input_file: str, quality_flag: str, cache: ProcessingCache | None = None, dtype=np.float64
+) -> Tuple[str | None, dict]:
+    """
+    Masked arrays and metadata of one granule, from the cache when possible.
+
+    returns: (key, granule) where granule has
+        no2, cloud: (time, lat, lon) arrays
+        time: (time,) datetime64
+        extents: (time, 4) bounds as returned by get_bounds
+        geospatial_bounds: the file's geospatial_bounds attribute
+    """
+    key = None
+    if cache is not None:
+        key = cache_key("masked", file_fingerprint(input_file), quality_flag, np.dtype(dtype).name)
+        granule = cache.load(key)
+        if granule is not None:
+            granule["geospatial_bounds"] = str(granule["geospatial_bounds"])
+            return key, granule
+
+    no2, cloud, geo = read_granule(input_file, quality_flag, dtype)
+    granule = {
+        "no2": no2.to_numpy(),
+        "cloud": cloud.to_numpy(),
+        "time": no2.time.values,
+        "extents": np.array([get_bounds(no2.sel(time=time)) for time in no2.time.values]),
+        "geospatial_bounds": geo,
+    }
+    if cache is not None:
+        cache.store(key, granule)
+    return key, granule
+
+
+def stream_new_data(
+    input_files: List[str],
+    args: argparse.Namespace,
+    output: Path,
+    cloud_output: Path,
+    cloud_threshold: float,
+    cache: ProcessingCache | None = None,
+    skipped: Tuple[List[tuple], List[int], List[str]] | None = None,
+) -> List[np.datetime64]:
+    """
+    Render one granule at a time instead of combining every granule first.
+
+    Each granule is read, reprojected and saved (NO2 and, with --do-clouds,
+    the cloud layer from the same reprojected grids) before the next one is
+    read, so at most a few granules are held in memory regardless of how many
+    files there are. The text files are written from the bounds and times
+    gathered on the way through and match the ones process_new_data writes.
+
+    With a cache, the masked arrays and the reprojected grids of each granule
+    are reused across runs, so only the colormap and encoding are redone.
+
+    skipped: granule_text_data of the granules that are not rendered, added
+        to the text files
+
+    returns: the time of every timestep rendered
+    """
+    if args.sample:
+        input_files = input_files[0:10]
+
+    kwargs = dict(
+        reproject=not args.no_reproject,
+        method=args.method,
+        cloud_threshold=cloud_threshold,
+        overwrite=args.overwrite,
+        pyramid=args.pyramid,
+        levels=args.levels,
+        cache=cache,
+        dtype=get_dtype(args),
+        tiles=args.tiles,
+        tile_zooms=args.tile_zooms,
+        product_output=args.product_dir,
+        product_max_error=args.product_max_error,
+    )
+    if args.do_clouds:
+        kwargs["cloud_images"] = dict(
+            cmap=cloud_cmap if args.cloud_cmap is None else args.cloud_cmap, vmin=0.5, vmax=1, output=cloud_output
+        )
+    no2_kwargs = dict(
+        kwargs, cmap=svs_tempo_cmap, vmin=args.vmin / 100, vmax=args.vmax / 100,
+        output=output, suffix=args.suffix, cloud_output=False,
+    )
+
+    extents, times, geospatial_bounds, rendered = [], [], [], []
+
+    def tasks():
+        for input_file in input_files:
+            key, granule = load_granule(input_file, args.quality, cache, get_dtype(args))
+            geospatial_bounds.append(granule["geospatial_bounds"])
+            for i, time in enumerate(granule["time"]):
+                extents.append(granule["extents"][i])
+                times.append(datetime64_to_jstime(time))
+                rendered.append(time)
+                left, right, bottom, top = granule["extents"][i]
+                bounds = [(bottom, left), (top, right)]
+                data, cloud_array = granule["no2"][i], granule["cloud"][i]
+                yield data, cloud_array, time, {**no2_kwargs, "bounds": bounds, "source_key": key}
+
+    if args.text_files_only or args.no_output:
+        # still read every granule for the bounds and times, without rendering
+        for _ in tasks():
+            pass
+    else:
+        executor_kind = get_executor_kind(args, len(input_files))
+        logger.info(f"Streaming {len(input_files)} files with executor {executor_kind}")
+        run_tasks(tasks(), executor_kind, args.workers, len(input_files))
+
+    if skipped is not None:
+        extents += skipped[0]
+        times += skipped[1]
+        geospatial_bounds += skipped[2]
+    if args.no_output or not extents:
+        return rendered
+    bounds = union_bounds(extents)
+    write_text_data(bounds, times, geospatial_bounds, args.name, output, args.suffix)
+    if args.do_clouds:
+        write_text_data(bounds, times, geospatial_bounds, args.name, cloud_output, args.suffix)
+    return rendered
+
+
+def get_dtype(args: argparse.Namespace):
+    """
+    Floating point type used from reading through reprojection
+    """
+    return np.float32 if args.float32 else np.float64
+
+
+def get_executor_kind(args: argparse.Namespace, ntimes: int | None = None) -> str:
+    """
+    Resolve --executor / --singlethreaded into threads, processes or serial.
+    A pool is not worth starting for fewer than 3 timesteps.
+    """
+    if args.singlethreaded or (ntimes is not None and ntimes < 3):
+        return "serial"
+    return args.executor
+
+
 def main() -> None:
     """
     Main function to process TEMPO data.
     """
     args = parse_arguments()
     set_log_level(args.debug)
+    if Path(args.config).exists():
+        load_config(args)
+    if args.executor is None:
+        args.executor = "threads"
+    if args.workers is None:
+        args.workers = 10
     if args.dry_run:
         logger.info("Dry run")
+    if args.tiles and args.no_reproject:
+        logger.error("--tiles needs Web Mercator frames, it cannot be used with --no-reproject")
+        sys.exit(1)
     directory, output, cloud_output = setup_directories(args, args.dry_run)
-    input_files = get_input_files(directory, args.input, args.level, args.version)
+    inventory = GranuleInventory(args.inventory) if args.inventory is not None else None
+    input_files = get_input_files(directory, args.input, args.level, args.version, inventory)
     
     if args.overwrite:
         print("**WARNING** THIS WILL OVERWRITE EXISTING DATA**")
@@ -401,27 +1292,113 @@ def main() -> None:
         if not args.dry_run:
             sys.exit(1)
 
+    skipped_files = []
+    if args.skip_existing and not (args.overwrite or args.text_files_only or args.no_output):
+        remaining = skip_finished_granules(
+            input_files,
+            output,
+            cloud_output if args.do_clouds else None,
+            args.suffix,
+            args.levels,
+            inventory,
+            tiles=args.tiles,
+            product_output=args.product_dir,
+        )
+        if len(remaining) == 0:
+            logger.info("All files already have images, nothing to do")
+            return
+        skipped_files = sorted(set(input_files) - set(remaining))
+        input_files = remaining
+
     if args.dry_run:
         logger.info("Dry run: Skipping actual processing steps.")
         return
 
+    cloud_threshold = cloud_cover_mask(args.quality)
+    # the text files list every granule, including those rendered by an earlier run
+    skipped = granule_text_data(skipped_files) if skipped_files else None
+
+    if args.stream or args.cache_dir is not None:
+        cache = None
+        if args.cache_dir is not None:
+            cache = ProcessingCache(args.cache_dir, max_bytes=int(args.cache_size * 2**30))
+            logger.info(f"Using cache {cache}")
+        rendered = stream_new_data(input_files, args, output, cloud_output, cloud_threshold, cache, skipped)
+    else:
+        rendered = process_combined_data(input_files, args, output, cloud_output, cloud_threshold, skipped)
+
+    if args.animate and not (args.text_files_only or args.no_output or args.tiles):
+        animate_outputs(
+            rendered, output, cloud_output if args.do_clouds else None, args.suffix, args.levels, args.overwrite
+        )
+
+    if inventory is not None:
+        if not (args.text_files_only or args.no_output or args.tiles):
+            record_outputs(
+                inventory, input_files, output, cloud_output if args.do_clouds else None, args.suffix, args.levels
+            )
+        inventory.close()
+
+
+def process_combined_data(
+    input_files: List[str],
+    args: argparse.Namespace,
+    output: Path,
+    cloud_output: Path,
+    cloud_threshold,
+    skipped: Tuple[List[tuple], List[int], List[str]] | None = None,
+) -> List[np.datetime64]:
+    """
+    Combine every granule into one cube, then render it with process_new_data
+
+    skipped: granule_text_data of the granules that are not rendered, added
+        to the text files
+    returns: the time of every timestep rendered
+    """
     input_data, datetimes, geospatial_bounds, support = process_files(
         input_files, args.quality, args.sample
     )
 
-    final_data, support_data = combine_data(input_data, support)
+    scratch_dir = None if args.scratch_dir is None else Path(args.scratch_dir) / args.name
+    final_data, support_data = combine_data(input_data, support, scratch_dir, datetimes)
+    try:
+        return render_combined_data(
+            final_data, support_data, geospatial_bounds, args, output, cloud_output, cloud_threshold, skipped
+        )
+    finally:
+        if scratch_dir is not None and not args.keep_scratch:
+            for name in ("vertical_column_troposphere", "eff_cloud_fraction"):
+                remove_scratch_store(scratch_dir / f"{name}.npy")
+            if scratch_dir.is_dir() and not any(scratch_dir.iterdir()):
+                scratch_dir.rmdir()
+
+
+def render_combined_data(
+    final_data: xr.Dataset,
+    support_data: xr.Dataset,
+    geospatial_bounds: List[dict],
+    args: argparse.Namespace,
+    output: Path,
+    cloud_output: Path,
+    cloud_threshold,
+    skipped: Tuple[List[tuple], List[int], List[str]] | None = None,
+) -> List[np.datetime64]:
+    """
+    Render the cubes from combine_data with process_new_data
+
+    returns: the time of every timestep rendered
+    """
     final_data["vertical_column_troposphere"].name = "NO2"
     support_data["eff_cloud_fraction"].name = "Clouds"
 
     no2_data = final_data["vertical_column_troposphere"]
     no2_data = no2_data.rio.write_nodata(np.nan, encoded=True)
-    no2_data.data = no2_data.data / 10**16
+    # astype is a no-op for the default float64, and keeps float32 from
+    # ever materialising a float64 cube (cloud fraction is float32 already)
+    no2_data.data = (no2_data.data / 10**16).astype(get_dtype(args), copy=False)
 
     cloud_data = support_data["eff_cloud_fraction"]
     cloud_data = cloud_data.rio.write_nodata(np.nan, encoded=True)
-    cloud_data.data = cloud_data.data / 1
-
-    cloud_threshold = cloud_cover_mask(args.quality)
 
     process_new_data(
         no2_data,
@@ -437,7 +1414,8 @@ def main() -> None:
         not args.no_reproject,
         args.method,
         cloud_threshold,
-        args.overwrite
+        overwrite=args.overwrite,
+        skipped=skipped,
     )
 
     if args.do_clouds:
@@ -461,8 +1439,10 @@ def main() -> None:
             args.method,
             cloud_threshold,
             cloud_output=True,
-            overwrite=args.overwrite
+            overwrite=args.overwrite,
+            skipped=skipped,
         )
+    return list(no2_data.time.values)
 
 
 if __name__ == "__main__":
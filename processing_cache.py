@@ -0,0 +1,173 @@
+"""
+On-disk cache of intermediate processing products.
+
+Re-rendering the same granules with a different colour range repeats the
+slow steps (reading and masking the NetCDF, reprojecting to each resolution)
+even though their results only depend on the source file, the quality flag
+and the projection settings. ProcessingCache stores those intermediates as
+.npz files named by a hash of exactly those inputs, so a re-render can go
+straight to the colormap and PNG encoding.
+
+Keys are content addressed: the source file is identified by its size and a
+hash of its first and last MiB, not by its path, so moved or copied granules
+still hit. The cache is kept under max_bytes by deleting the least recently
+used entries (loading an entry refreshes its mtime).
+"""
+
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from logger import setup_logging
+
+logger = setup_logging(debug=False, name="processing_cache")
+
+CACHE_DIR = Path("~/.cache/tempo_processing/intermediates").expanduser()
+DEFAULT_MAX_BYTES = 20 * 2**30
+
+# bytes read from each end of a file for its fingerprint
+FINGERPRINT_BYTES = 2**20
+
+_fingerprints: dict[tuple, str] = {}
+
+
+def file_fingerprint(path: Path | str) -> str:
+    """
+    Hash of a file's size and its first and last FINGERPRINT_BYTES
+    """
+    path = Path(path)
+    stat = path.stat()
+    memo = (str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+    if memo in _fingerprints:
+        return _fingerprints[memo]
+    digest = hashlib.sha1(str(stat.st_size).encode())
+    with open(path, "rb") as f:
+        digest.update(f.read(FINGERPRINT_BYTES))
+        if stat.st_size > FINGERPRINT_BYTES:
+            f.seek(max(FINGERPRINT_BYTES, stat.st_size - FINGERPRINT_BYTES))
+            digest.update(f.read())
+    _fingerprints[memo] = digest.hexdigest()
+    return _fingerprints[memo]
+
+
+def cache_key(*parts) -> str:
+    """
+    Hash any repr-able parts (fingerprints, flags, parameters) into a key
+    """
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def pack_levels(bands: dict[str, tuple]) -> dict[str, np.ndarray]:
+    """
+    {"data": (full, half, ...)} -> {"data_0": full, "data_1": half, ...}
+    """
+    return {f"{name}_{level}": array for name, levels in bands.items() for level, array in enumerate(levels)}
+
+
+def unpack_levels(arrays: dict[str, np.ndarray]) -> dict[str, tuple]:
+    """
+    Inverse of pack_levels
+    """
+    bands: dict[str, list] = {}
+    for key in sorted(arrays, key=lambda k: int(k.rsplit("_", 1)[1])):
+        name, _ = key.rsplit("_", 1)
+        bands.setdefault(name, []).append(arrays[key])
+    return {name: tuple(levels) for name, levels in bands.items()}
+
+
+class ProcessingCache:
+    """
+    Directory of .npz entries with size-based LRU eviction.
+    Safe to share between threads and worker processes: entries are written
+    to a temporary file and renamed into place.
+
+    :kwarg cache_dir: where entries are stored
+    :kwarg max_bytes: total size to evict down to after each store
+    """
+
+    def __init__(self, cache_dir: Path | str = CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.max_bytes = int(max_bytes)
+
+    def __repr__(self) -> str:
+        return f"ProcessingCache({str(self.cache_dir)!r}, max_bytes={self.max_bytes})"
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.npz"
+
+    def load(self, key: str) -> dict[str, np.ndarray] | None:
+        """
+        returns: the stored arrays, or None on a miss
+        """
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as f:
+                arrays = {k: f[k] for k in f.files}
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Could not read cache entry {path}: {e}")
+            return None
+        try:
+            # mark as recently used
+            os.utime(path)
+        except OSError:
+            pass
+        logger.debug(f"Cache hit {path}")
+        return arrays
+
+    def store(self, key: str, arrays: dict[str, np.ndarray]) -> None:
+        path = self.path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f"{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp.npz")
+            np.savez(tmp, **arrays)
+            tmp.replace(path)
+        except OSError as e:
+            logger.warning(f"Could not write cache entry {path}: {e}")
+            return
+        logger.debug(f"Cached {path}")
+        self.evict()
+
+    def entries(self) -> list[tuple[float, int, Path]]:
+        """
+        returns: (mtime, size, path) of every entry
+        """
+        found = []
+        if not self.cache_dir.is_dir():
+            return found
+        for subdir in os.scandir(self.cache_dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith(".npz") and ".tmp." not in entry.name:
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    found.append((stat.st_mtime, stat.st_size, Path(entry.path)))
+        return found
+
+    def evict(self) -> int:
+        """
+        Delete least recently used entries until the cache fits in max_bytes.
+
+        returns: number of bytes freed
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        freed = 0
+        for _, size, path in sorted(entries):
+            if total - freed <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            freed += size
+        if freed:
+            logger.debug(f"Evicted {freed / 2**20:.1f} MB from {self.cache_dir}")
+        return freed
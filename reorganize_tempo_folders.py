@@ -1,15 +1,19 @@
 # To add a new cell, type ''
 # To add a new markdown cell, type ' [markdown]'
 
+import argparse
 import os
 import sys
 import shutil
+import fnmatch
 from pathlib import Path, PosixPath
 from datetime import datetime, timedelta
 
 # setup logging to file reorg_log.txt
 import logging
 
+from granule_inventory import INVENTORY_PATH, GranuleInventory
+
 
 # create logger with 'spam_application'
 # logger = logging.getLogger('reorg')
@@ -30,6 +34,20 @@ import logging
 RUN = True
 TEST = False
 
+parser = argparse.ArgumentParser(description="Move subsetted granules and images into day folders")
+# opt-in like process_data.py --inventory: the inventory only knows the files
+# written with it, anything else (shell script downloads, runs without
+# --inventory) would be skipped. Refresh it first with granule_inventory.py scan
+parser.add_argument(
+    "--inventory",
+    nargs="?",
+    const=str(INVENTORY_PATH),
+    default=None,
+    help=f"Look files up in this granule inventory instead of globbing every folder (default path: {INVENTORY_PATH})",
+)
+INVENTORY = parser.parse_args().inventory
+inventory = GranuleInventory(INVENTORY) if INVENTORY is not None else None
+
 def create_directory_structure(base_dir: Path, date: str) -> Path:
     """
     Create the directory structure for the given date.
@@ -52,13 +70,28 @@ def create_directory_structure(base_dir: Path, date: str) -> Path:
     
     return day_dir
 
+def find_files(data_dir: Path, file_pattern: str) -> list[Path]:
+    """
+    Files in data_dir matching file_pattern, from the inventory when there is one.
+    Paths are returned relative like Path.glob does.
+    """
+    if inventory is None:
+        return list(data_dir.glob(file_pattern))
+    directory, pattern = os.path.split(file_pattern)
+    found = inventory.granules(data_dir / directory, pattern) if pattern.endswith(".nc") else [
+        str(Path(data_dir / directory).absolute() / name)
+        for name in sorted(inventory.image_names(data_dir / directory))
+        if fnmatch.fnmatch(name, pattern)
+    ]
+    return [Path(os.path.relpath(path)) for path in found]
+
 def move_files_to_day_directory(base_dir: Path, in_dirs: list[Path], file_pattern: str, parser) -> None:
     """
     Move files matching the file_pattern to their respective day directories.
     """
     count = 0
     for data_dir in in_dirs:
-        for file_path in data_dir.glob(file_pattern):
+        for file_path in find_files(data_dir, file_pattern):
             if file_path.is_file():
                 date = parser(file_path.name)
                 day_dir = create_directory_structure(base_dir, date)
@@ -70,6 +103,8 @@ def move_files_to_day_directory(base_dir: Path, in_dirs: list[Path], file_patter
                         # print(f"Moving {file_path} to {new_path}")
                         if RUN:
                             shutil.move(str(file_path), str(new_path))
+                            if inventory is not None:
+                                inventory.move(file_path, new_path)
                             count += 1
                     else:
                         if RUN:
@@ -92,7 +127,21 @@ exclude_dirs = []
 
 
 
-valid_directories =  list(set(d.parent.parent for d in  Path("./").glob('*_*/subsetted_netcdf/*.nc')) - set(exclude_dirs))
+def subset_directories() -> set[Path]:
+    """
+    Top level *_* folders that hold subsetted granules
+    """
+    if inventory is None:
+        return set(d.parent.parent for d in Path("./").glob('*_*/subsetted_netcdf/*.nc'))
+    cwd = Path.cwd()
+    folders = set()
+    for directory in inventory.directories(subset=True):
+        folder = directory.parent
+        if folder.parent == cwd and fnmatch.fnmatch(folder.name, '*_*'):
+            folders.add(Path(folder.name))
+    return folders
+
+valid_directories =  list(subset_directories() - set(exclude_dirs))
 print("Moving: ", list(valid_directories))
 
 
@@ -104,7 +153,7 @@ image_pattern = "./images/*.png"
 image_resized_pattern = "./images/resized_images/*.png"
 cloud_image_pattern = "./cloud_images/*.png"
 cloud_image_resized_pattern = "./cloud_images/resized_images/*.png"
-valid_directories = list(set(d.parent.parent for d in  Path("./").glob('*_*/subsetted_netcdf/*.nc')) - set(exclude_dirs))
+valid_directories = list(subset_directories() - set(exclude_dirs))
 # valid_directories = [Path("may_01_onward")]
 
 if TEST:
@@ -0,0 +1,315 @@
+"""
+Cached reprojection plans for the fixed TEMPO L3 grid.
+
+Every TEMPO L3 granule is delivered on the same regular lat/lon grid, so the
+mapping from source pixels to Web Mercator pixels is identical for every scan.
+A ReprojectionPlan works that mapping out once and then applies it to each new
+2D array with sparse matrix products (average) or a gather (nearest), instead
+of running a full GDAL warp per image.
+
+Both EPSG:4326 -> EPSG:3857 and EPSG:4326 -> EPSG:4326 are separable (x only
+depends on longitude and y only depends on latitude), so a plan is just a pair
+of 1D weight tables, one per axis.
+"""
+
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+
+from rasterio import Affine as A
+from rasterio.warp import calculate_default_transform, transform
+
+from logger import setup_logging
+
+logger = setup_logging(debug=False, name="reprojection_plan")
+
+# projections whose axes are independent of each other, i.e. where a plan is exact
+SEPARABLE_PROJECTIONS = ("EPSG:3857", "EPSG:4326")
+PLAN_METHODS = ("average", "nearest")
+# rows / columns per sparse product in ReprojectionPlan.apply
+APPLY_STRIP = 512
+
+# part of every plan key, bump it when the tables a plan builds change so
+# plans cached on disk by an older version are rebuilt
+PLAN_VERSION = 2
+
+# set to None to disable the on-disk cache
+PLAN_CACHE_DIR: Path | None = Path("~/.cache/tempo_processing/reprojection_plans").expanduser()
+
+_plans: dict[tuple, "ReprojectionPlan"] = {}
+_plans_lock = threading.Lock()
+
+
+def plan_key(bounds, shape, refinement=1, projection="EPSG:3857", method="average") -> tuple:
+    """
+    Normalise the arguments that define a plan into a hashable key.
+    """
+    (lat_min, lon_min), (lat_max, lon_max) = bounds
+    bounds = tuple(round(float(b), 10) for b in (lat_min, lon_min, lat_max, lon_max))
+    return (bounds, tuple(int(s) for s in shape), float(refinement), projection, method, PLAN_VERSION)
+
+
+def _cache_path(key: tuple, cache_dir: Path) -> Path:
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    return Path(cache_dir) / f"plan_{key[4]}_{digest}.npz"
+
+
+def supports_plan(projection: str, method: str, refinement: float = 1) -> bool:
+    """
+    Whether a plan reproduces GDAL exactly for these settings. Nearest onto
+    a coarser lat/lon grid puts destination pixel centres exactly on source
+    pixel edges, where GDAL's pick depends on its own rounding.
+    """
+    if projection == "EPSG:4326" and method == "nearest" and refinement != 1:
+        return False
+    return projection in SEPARABLE_PROJECTIONS and method in PLAN_METHODS
+
+
+def _destination_grid(bounds, shape, refinement, projection):
+    """
+    Use the same transform project_array would give GDAL
+    """
+    (lat_min, lon_min), (lat_max, lon_max) = bounds
+    nlat, nlon = shape
+    src_crs = {"init": "EPSG:4326"}
+    dst_crs = {"init": projection}
+    dst_transform, width, height = calculate_default_transform(
+        src_crs,
+        dst_crs,
+        nlon,
+        nlat,
+        lon_min,
+        lat_min,
+        lon_max,
+        lat_max,
+        dst_width=int(nlon * refinement),
+        dst_height=int(nlat * refinement),
+    )
+    return dst_transform, height, width
+
+
+def _to_source_pixels(bounds, shape, dst_transform: A, height, width, projection, offset):
+    """
+    Map destination pixel positions (offset=0 for edges, 0.5 for centres) back to
+    fractional source column/row coordinates
+    """
+    (lat_min, lon_min), (lat_max, lon_max) = bounds
+    nlat, nlon = shape
+    dlat = (lat_max - lat_min) / nlat
+    dlon = (lon_max - lon_min) / nlon
+
+    ncol = width + 1 if offset == 0 else width
+    nrow = height + 1 if offset == 0 else height
+    cols = np.arange(ncol) + offset
+    rows = np.arange(nrow) + offset
+    xs = dst_transform.c + dst_transform.a * cols
+    ys = dst_transform.f + dst_transform.e * rows
+    x_mid = dst_transform.c + dst_transform.a * width / 2
+    y_mid = dst_transform.f + dst_transform.e * height / 2
+
+    lons, _ = transform(projection, "EPSG:4326", xs, np.full_like(xs, y_mid))
+    _, lats = transform(projection, "EPSG:4326", np.full_like(ys, x_mid), ys)
+
+    src_cols = (np.asarray(lons) - lon_min) / dlon
+    src_rows = (np.asarray(lats) - lat_min) / dlat
+    return src_cols, src_rows
+
+
+def _coverage_weights(edges: np.ndarray, n_src: int, extend_edges=False):
+    """
+    Fractional overlap of each destination interval with each source pixel,
+    the same weighting GDAL uses for Resampling.average.
+
+    :kwarg extend_edges: count the part of an interval that lies beyond the
+        source grid towards the edge pixel, as GDAL does. That happens when
+        the destination size is rounded down, e.g. 1937 columns at
+        refinement 0.5 become 968 pixels 2.0015 source pixels wide, so the
+        last one ends 0.4 pixels past the grid.
+    returns: (dst_index, src_index, weight) arrays
+    """
+    lo = np.minimum(edges[:-1], edges[1:])
+    hi = np.maximum(edges[:-1], edges[1:])
+    first = np.clip(np.floor(lo).astype(int), 0, n_src)
+    last = np.clip(np.ceil(hi).astype(int), 0, n_src)
+    dst_idx, src_idx, weight = [], [], []
+    for i, (a, b, u0, u1) in enumerate(zip(first, last, lo, hi)):
+        k = np.arange(a, b)
+        w = np.minimum(u1, k + 1) - np.maximum(u0, k)
+        if extend_edges and len(k):
+            if k[0] == 0 and u0 < 0:
+                w[0] -= u0
+            if k[-1] == n_src - 1 and u1 > n_src:
+                w[-1] += u1 - n_src
+        keep = w > 1e-10
+        dst_idx.append(np.full(keep.sum(), i))
+        src_idx.append(k[keep])
+        weight.append(w[keep])
+    return np.concatenate(dst_idx), np.concatenate(src_idx), np.concatenate(weight)
+
+
+def _nearest_index(centres: np.ndarray, n_src: int) -> np.ndarray:
+    """
+    Source pixel containing each destination pixel centre, -1 if outside
+    """
+    idx = np.floor(centres).astype(int)
+    idx[(idx < 0) | (idx >= n_src)] = -1
+    return idx
+
+
+class ReprojectionPlan:
+    """
+    Precomputed resampling tables that reproduce project_array for one grid.
+
+    :arg bounds: Image latitude, longitude bounds, [(lat_min, lon_min), (lat_max, lon_max)]
+    :arg shape: (nlat, nlon) of the source arrays
+    :kwarg refinement: Scaling factor for output array resolution
+    :kwarg projection: Destination projection, one of SEPARABLE_PROJECTIONS
+    :kwarg method: average or nearest
+    """
+
+    def __init__(self, bounds, shape, refinement=1, projection="EPSG:3857", method="average", tables=None):
+        if not supports_plan(projection, method, refinement):
+            raise ValueError(
+                f"No reprojection plan for projection={projection}, method={method}, refinement={refinement}"
+            )
+        self.key = plan_key(bounds, shape, refinement, projection, method)
+        self.bounds = bounds
+        self.src_shape = tuple(int(s) for s in shape)
+        self.refinement = refinement
+        self.projection = projection
+        self.method = method
+        self.tables = tables if tables is not None else self._build_tables()
+        self.dst_shape = tuple(int(s) for s in self.tables["dst_shape"])
+        self._prepare()
+
+    def _build_tables(self) -> dict:
+        logger.debug(f"Building reprojection plan for {self.key}")
+        nlat, nlon = self.src_shape
+        dst_transform, height, width = _destination_grid(
+            self.bounds, self.src_shape, self.refinement, self.projection
+        )
+        tables = {
+            "dst_shape": np.array([height, width]),
+            "dst_transform": np.array(dst_transform[:6]),
+        }
+        if self.method == "average":
+            col_edges, row_edges = _to_source_pixels(
+                self.bounds, self.src_shape, dst_transform, height, width, self.projection, 0
+            )
+            for axis, edges, n in (("x", col_edges, nlon), ("y", row_edges, nlat)):
+                dst_idx, src_idx, weight = _coverage_weights(edges, n, extend_edges=True)
+                tables[f"{axis}_dst"] = dst_idx
+                tables[f"{axis}_src"] = src_idx
+                tables[f"{axis}_weight"] = weight
+        else:
+            col_centres, row_centres = _to_source_pixels(
+                self.bounds, self.src_shape, dst_transform, height, width, self.projection, 0.5
+            )
+            tables["x_index"] = _nearest_index(col_centres, nlon)
+            tables["y_index"] = _nearest_index(row_centres, nlat)
+        return tables
+
+    def _prepare(self):
+        nlat, nlon = self.src_shape
+        height, width = self.dst_shape
+        if self.method == "average":
+            t = self.tables
+            wx = sparse.csr_matrix((t["x_weight"], (t["x_dst"], t["x_src"])), shape=(width, nlon))
+            wy = sparse.csr_matrix((t["y_weight"], (t["y_dst"], t["y_src"])), shape=(height, nlat))
+            # normalise so each destination pixel is a weighted mean of the
+            # source pixels it covers; pixels that cover nothing stay 0 like GDAL
+            wx_sum = np.asarray(wx.sum(axis=1)).ravel()
+            wy_sum = np.asarray(wy.sum(axis=1)).ravel()
+            self._wx = (sparse.diags(np.divide(1, wx_sum, out=np.zeros_like(wx_sum), where=wx_sum > 0)) @ wx).tocsr()
+            self._wy = (sparse.diags(np.divide(1, wy_sum, out=np.zeros_like(wy_sum), where=wy_sum > 0)) @ wy).tocsr()
+        else:
+            x_index = self.tables["x_index"]
+            y_index = self.tables["y_index"]
+            self._x_take = np.where(x_index < 0, 0, x_index)
+            self._y_take = np.where(y_index < 0, 0, y_index)
+            self._outside = (y_index < 0)[:, None] | (x_index < 0)[None, :]
+
+    def apply(self, array: np.ndarray, dtype=np.float64) -> np.ndarray:
+        """
+        Reproject a 2D (lat, lon) or 3D (bands, lat, lon) array defined on the
+        plan's source grid. All bands go through the same two sparse products.
+        """
+        if array.shape[-2:] != self.src_shape:
+            raise ValueError(f"Array shape {array.shape} does not match plan shape {self.src_shape}")
+        array = np.asarray(array, dtype=dtype)
+        nlat, nlon = self.src_shape
+        height, width = self.dst_shape
+        bands = array.shape[:-2]
+        nband = int(np.prod(bands))
+        if self.method == "average":
+            # sparse products only touch stored weights, so a NaN poisons
+            # exactly the destination pixels it contributes to, as in GDAL.
+            # The products run in the weights' float64 whatever dtype is, so
+            # they go one band and one strip at a time to keep that small
+            flat = array.reshape(nband, nlat, nlon)
+            out = np.empty((nband, height, width), dtype=dtype)
+            rows = np.empty((nlat, width), dtype=np.result_type(self._wx.dtype, dtype))
+            for band in range(nband):
+                for start in range(0, nlat, APPLY_STRIP):
+                    rows[start : start + APPLY_STRIP] = (self._wx @ flat[band, start : start + APPLY_STRIP].T).T
+                for start in range(0, width, APPLY_STRIP):
+                    out[band, :, start : start + APPLY_STRIP] = self._wy @ rows[:, start : start + APPLY_STRIP]
+            return out.reshape(bands + (height, width))
+        out = array[..., self._y_take[:, None], self._x_take[None, :]]
+        out[..., self._outside] = 0
+        return out
+
+    def save(self, cache_dir: Path) -> Path:
+        path = _cache_path(self.key, cache_dir)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # unique name so concurrent workers never write the same temporary file
+        tmp = path.with_name(f"{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp.npz")
+        np.savez(tmp, key=np.array(repr(self.key)), **self.tables)
+        tmp.replace(path)
+        logger.debug(f"Saved reprojection plan to {path}")
+        return path
+
+    @classmethod
+    def load(cls, path: Path, bounds, shape, refinement=1, projection="EPSG:3857", method="average"):
+        with np.load(path) as f:
+            if str(f["key"]) != repr(plan_key(bounds, shape, refinement, projection, method)):
+                raise ValueError(f"Plan in {path} does not match the requested grid")
+            tables = {k: f[k] for k in f.files if k != "key"}
+        return cls(bounds, shape, refinement, projection, method, tables=tables)
+
+
+def get_plan(
+    bounds, shape, refinement=1, projection="EPSG:3857", method="average", cache_dir=None
+) -> ReprojectionPlan:
+    """
+    Return the plan for this grid, from memory, then disk, building it if needed.
+    cache_dir defaults to PLAN_CACHE_DIR
+    """
+    key = plan_key(bounds, shape, refinement, projection, method)
+    with _plans_lock:
+        plan = _plans.get(key)
+        if plan is not None:
+            return plan
+
+        if cache_dir is None:
+            cache_dir = PLAN_CACHE_DIR
+        path = _cache_path(key, cache_dir) if cache_dir is not None else None
+        if path is not None and path.exists():
+            try:
+                plan = ReprojectionPlan.load(path, bounds, shape, refinement, projection, method)
+                logger.debug(f"Loaded reprojection plan from {path}")
+            except Exception as e:
+                logger.warning(f"Could not load reprojection plan {path}: {e}")
+        if plan is None:
+            plan = ReprojectionPlan(bounds, shape, refinement, projection, method)
+            if path is not None:
+                try:
+                    plan.save(cache_dir)
+                except OSError as e:
+                    logger.warning(f"Could not save reprojection plan to {path}: {e}")
+        _plans[key] = plan
+        return plan
@@ -1,12 +1,25 @@
-
 #!/bin/bash
 
 
 # Read the list of folders from the backlog file
 backlog_file="backlog"
+# without a backlog file, ask the granule inventory which folders still
+# have granules without images (see granule_inventory.py). The list goes to
+# a temporary file, so a hand-written backlog is never confused with it
+inventory_args=()
+if [ ! -f "$backlog_file" ]; then
+    inventory="$HOME/.cache/tempo_processing/granule_inventory.sqlite"
+    backlog_file=$(mktemp)
+    trap 'rm -f "$backlog_file"' EXIT
+    if ! python granule_inventory.py --inventory "$inventory" backlog --image-dir "all_reprocessed/images" > "$backlog_file"; then
+        echo "granule_inventory.py backlog failed" >&2
+        exit 1
+    fi
+    inventory_args=(--inventory "$inventory")
+fi
 while IFS= read -r folder; do
     echo "Processing folder: $folder"
-    python get_new_tempo_data.py --data-dir "$folder" --use-subset --skip-download --output-dir "all_reprocessed" --name "$folder"
+    python get_new_tempo_data.py --data-dir "$folder" --use-subset --skip-download --output-dir "all_reprocessed" --name "$folder" --skip-existing "${inventory_args[@]}"
     # break the loop
     # break
-done < "$backlog_file"
\ No newline at end of file
+done < "$backlog_file"
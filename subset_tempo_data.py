@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 from pathlib import Path
-import argparse, sys
+import argparse, itertools, os, sys, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import netCDF4 as nc
 from netCDF4 import Dataset # type: ignore
+import numpy as np
 
 from logger import setup_logging, set_log_level
 
@@ -52,20 +54,324 @@ class TimedContext(object):
         pass
         # self.timer.stop()
 
-def subset_files(filein, fileout, show_time = True):
-    
+VARIABLES_TO_KEEP = [
+    "geolocation/solar_zenith_angle",
+    "latitude",
+    "longitude",
+    "product/vertical_column_troposphere",
+    "product/vertical_column_troposphere_uncertainty",
+    "product/main_data_quality_flag",
+    "support_data/eff_cloud_fraction",
+    # "suppord_data/snow_ice_fraction",
+    "time",
+]
+
+PART_SUFFIX = ".part"
+
+# zlib level for the subset, 0 to write it uncompressed
+DEFAULT_COMPLEVEL = 4
+# upper bound on the bytes held in memory per copy step
+COPY_BLOCK_BYTES = 32 * 2**20
+# filters whose compressed chunks can be copied without decoding them
+PASSTHROUGH_FILTERS = ("zlib", "shuffle", "fletcher32", "complevel")
+
+# named bounding boxes for --region, (lon_min, lat_min, lon_max, lat_max)
+REGIONS = {
+    "conus": (-125.0, 24.0, -66.0, 50.0),
+}
+
+
+def output_chunksizes(variable):
+    """
+    Keep the source chunking. Compressed variables have to be chunked, so
+    contiguous 1D variables get chunks of 1 and larger ones the library default
+    """
+    chunksizes = variable.chunking()
+    if chunksizes == "contiguous":
+        return (1,) if variable.ndim == 1 else None
+    return chunksizes
+
+
+def crop_slices(src, bbox) -> dict[str, slice]:
+    """
+    Index ranges of the latitude and longitude dimensions whose cell
+    centers fall inside bbox.
+
+    :arg src: open granule
+    :arg bbox: (lon_min, lat_min, lon_max, lat_max) in degrees
+    returns: {"latitude": slice, "longitude": slice}
+    """
+    lon_min, lat_min, lon_max, lat_max = bbox
+    crop = {}
+    for dim, low, high in (("latitude", lat_min, lat_max), ("longitude", lon_min, lon_max)):
+        values = src[dim][:]
+        inside = np.flatnonzero((values >= low) & (values <= high))
+        if inside.size == 0:
+            raise ValueError(f"{dim} {values.min():.2f} to {values.max():.2f} does not overlap {low} to {high}")
+        crop[dim] = slice(int(inside[0]), int(inside[-1]) + 1)
+    return crop
+
+
+def crop_shape(dimensions, shape, crop) -> tuple:
+    """
+    Shape of a variable over dimensions after applying crop
+    """
+    return tuple(
+        len(range(*crop[dim].indices(n))) if dim in crop else n for dim, n in zip(dimensions, shape)
+    )
+
+
+def crop_attributes(src, crop) -> dict:
+    """
+    Global bounds attributes describing the cropped grid: the extent of its
+    cells, with geospatial_bounds as a lat/lon polygon like the granule's own
+    (see get_field_of_regards)
+    """
+    edges = {}
+    for dim in ("latitude", "longitude"):
+        values = np.asarray(src[dim][:], dtype=float)
+        half = abs(values[1] - values[0]) / 2 if values.size > 1 else 0.0
+        kept = values[crop[dim]]
+        edges[dim] = (round(float(kept.min() - half), 6), round(float(kept.max() + half), 6))
+    (lat_min, lat_max), (lon_min, lon_max) = edges["latitude"], edges["longitude"]
+    corners = [(lat_min, lon_min), (lat_min, lon_max), (lat_max, lon_max), (lat_max, lon_min), (lat_min, lon_min)]
+    return {
+        "geospatial_bounds": "POLYGON((" + ",".join(f"{lat:g} {lon:g}" for lat, lon in corners) + "))",
+        "geospatial_lat_min": lat_min,
+        "geospatial_lat_max": lat_max,
+        "geospatial_lon_min": lon_min,
+        "geospatial_lon_max": lon_max,
+    }
+
+
+def can_passthrough(variable) -> bool:
+    """
+    True if variable is chunked and only uses filters netCDF4 can recreate,
+    so its compressed chunks are valid in a copy made with the same settings
+    """
+    filters = variable.filters() or {}
+    used = [name for name, value in filters.items() if value]
+    return variable.chunking() != "contiguous" and all(name in PASSTHROUGH_FILTERS for name in used)
+
+
+def create_variable(dst, name, variable, complevel=DEFAULT_COMPLEVEL, shuffle=True, passthrough=False, shape=None):
+    """
+    Create name in dst like variable.
+    With passthrough (and a variable that allows it) the chunking and filters
+    are copied from the source instead of using complevel and shuffle.
+
+    :kwarg shape: shape of the copy if it is cropped, chunks are clipped to it
+
+    returns: True if the variable's compressed chunks can be copied as they are
+    """
+    raw = passthrough and can_passthrough(variable)
+    if raw:
+        filters = variable.filters()
+        settings = dict(
+            chunksizes=variable.chunking(),
+            compression="zlib" if filters["zlib"] else None,
+            complevel=filters["complevel"],
+            shuffle=filters["shuffle"],
+            fletcher32=filters["fletcher32"],
+        )
+    elif complevel > 0:
+        settings = dict(
+            chunksizes=output_chunksizes(variable),
+            compression="zlib",
+            complevel=complevel,
+            shuffle=shuffle,
+        )
+    else:
+        chunking = variable.chunking()
+        contiguous = chunking == "contiguous"
+        settings = dict(chunksizes=None if contiguous else chunking, contiguous=contiguous)
+    if shape is not None and settings["chunksizes"] is not None:
+        settings["chunksizes"] = tuple(min(c, max(n, 1)) for c, n in zip(settings["chunksizes"], shape))
+    x = dst.createVariable(
+        name,
+        variable.datatype,
+        variable.dimensions,
+        **settings,
+    )
+    # x.set_var_chunk_cache(variable.get_var_chunk_cache())
+    dst[name].setncatts(variable.__dict__)
+    return raw
+
+
+def copy_blocks(shape, chunks, itemsize, max_bytes=COPY_BLOCK_BYTES):
+    """
+    Chunk-aligned slices covering an array, each at most max_bytes (or a
+    single chunk, if one chunk is larger). Blocks grow along the trailing
+    axes first, whole chunks at a time.
+    """
+    block = list(chunks)
+    for axis in reversed(range(len(shape))):
+        others = itemsize * int(np.prod(block[:axis] + block[axis + 1:]))
+        fit = max_bytes // others // chunks[axis] * chunks[axis]
+        block[axis] = min(shape[axis], max(chunks[axis], fit))
+        if block[axis] < shape[axis]:
+            break
+    for starts in itertools.product(*(range(0, n, b) for n, b in zip(shape, block))):
+        yield tuple(slice(start, min(start + b, n)) for start, b, n in zip(starts, block, shape))
+
+
+def copy_data(src_var, dst_var, max_bytes=COPY_BLOCK_BYTES, region=None):
+    """
+    Copy the raw (unmasked, unscaled) values block by block, so at most
+    about max_bytes of the variable are in memory at once
+
+    :kwarg region: slice of src_var per dimension to copy (all of it if None)
+    """
+    src_var.set_auto_maskandscale(False)
+    dst_var.set_auto_maskandscale(False)
+    # every chunk is read and written exactly once, in full, so HDF5's
+    # per-variable chunk cache would only hold on to finished chunks
+    src_var.set_var_chunk_cache(size=0)
+    dst_var.set_var_chunk_cache(size=0)
+    if src_var.ndim == 0:
+        dst_var.assignValue(src_var.getValue())
+        return
+    chunks = dst_var.chunking()
+    if chunks == "contiguous":
+        chunks = src_var.chunking()
+    if chunks == "contiguous":
+        chunks = (1,) * src_var.ndim
+    if region is None:
+        region = (slice(None),) * src_var.ndim
+    starts = [r.indices(n)[0] for r, n in zip(region, src_var.shape)]
+    chunks = tuple(min(c, max(n, 1)) for c, n in zip(chunks, dst_var.shape))
+    for block in copy_blocks(dst_var.shape, chunks, src_var.dtype.itemsize, max_bytes):
+        source = tuple(slice(start + b.start, start + b.stop) for start, b in zip(starts, block))
+        dst_var[block] = src_var[source]
+
+
+def filter_pipeline(dataset) -> list:
+    plist = dataset.id.get_create_plist()
+    return [plist.get_filter(i)[:3] for i in range(plist.get_nfilters())]
+
+
+def copy_raw_chunks(filein, fileout, names) -> list[str]:
+    """
+    Copy the stored (still compressed) chunks of each variable in names
+    from filein to fileout with h5py, skipping decompression and
+    recompression entirely.
+
+    returns: the names that could not be copied this way
+    """
+    import h5py
+
+    left = []
+    with h5py.File(filein, "r") as src, h5py.File(fileout, "r+") as dst:
+        for name in names:
+            s, d = src[name], dst[name]
+            if s.chunks != d.chunks or filter_pipeline(s) != filter_pipeline(d):
+                left.append(name)
+                continue
+            for i in range(s.id.get_num_chunks()):
+                offset = s.id.get_chunk_info(i).chunk_offset
+                filter_mask, chunk = s.id.read_direct_chunk(offset)
+                d.id.write_direct_chunk(offset, chunk, filter_mask)
+    return left
+
+
+def copy_variables(
+    src, dst, variables_to_keep, complevel=DEFAULT_COMPLEVEL, shuffle=True, passthrough=False, bbox=None
+):
+    """
+    :kwarg bbox: (lon_min, lat_min, lon_max, lat_max) to crop the latitude
+        and longitude dimensions to, None to keep the full field of regard
+    returns: names of the variables left for copy_raw_chunks
+    """
+    crop = crop_slices(src, bbox) if bbox is not None else {}
+    # adapted from https://stackoverflow.com/a/49592545/11594175
+    dst.setncatts(src.__dict__)
+    if crop:
+        dst.setncatts(crop_attributes(src, crop))
+    for name, dimension in src.dimensions.items():
+        dst.createDimension(
+            name, (crop_shape([name], [len(dimension)], crop)[0] if not dimension.isunlimited() else None)
+        )
+    # need to copy groups and variables in the list. groups have a / in their name
+    selected = [(name, variable) for name, variable in src.variables.items() if name in variables_to_keep]
+
+    groups_to_keep = [g.split("/")[0] for g in variables_to_keep if "/" in g]
+    vars_to_keep = [v.split("/")[1] for v in variables_to_keep if "/" in v]
+    for group_name, group in src.groups.items():
+        if group_name in groups_to_keep:
+            dst.createGroup(group_name)
+            for name, variable in group.variables.items():
+                if name in vars_to_keep:
+                    selected.append((group_name + "/" + name, variable))
+
+    raw = []
+    for name, variable in selected:
+        if crop:
+            # cropped chunks do not line up with the stored ones
+            shape = crop_shape(variable.dimensions, variable.shape, crop)
+            region = tuple(crop.get(dim, slice(None)) for dim in variable.dimensions)
+            create_variable(dst, name, variable, complevel, shuffle, shape=shape)
+            copy_data(variable, dst[name], region=region)
+        elif create_variable(dst, name, variable, complevel, shuffle, passthrough):
+            raw.append(name)
+        else:
+            copy_data(variable, dst[name])
+    return raw
+
 
-    variables_to_keep = [
-        "geolocation/solar_zenith_angle",
-        "latitude",
-        "longitude",
-        "product/vertical_column_troposphere",
-        "product/vertical_column_troposphere_uncertainty",
-        "product/main_data_quality_flag",
-        "support_data/eff_cloud_fraction",
-        # "suppord_data/snow_ice_fraction",
-        "time",
-    ]
+def is_complete_subset(filein: Path, fileout: Path, variables_to_keep=VARIABLES_TO_KEEP, bbox=None) -> bool:
+    """
+    Check fileout opens and has every kept variable of filein with the same
+    shape, or the shape cropped to bbox
+    """
+    try:
+        with Dataset(filein) as src, Dataset(fileout) as dst:
+            crop = crop_slices(src, bbox) if bbox is not None else {}
+            for name in variables_to_keep:
+                try:
+                    expected = crop_shape(src[name].dimensions, src[name].shape, crop)
+                except IndexError:
+                    # not in this granule, so not in the subset either
+                    continue
+                if dst[name].shape != expected:
+                    return False
+    except (OSError, IndexError, RuntimeError, ValueError):
+        return False
+    return True
+
+
+def subset_files(
+    filein,
+    fileout,
+    show_time = True,
+    dry_run = False,
+    delete = False,
+    complevel = DEFAULT_COMPLEVEL,
+    shuffle = True,
+    passthrough = False,
+    bbox = None,
+) -> str:
+    """
+    Copy the variables in VARIABLES_TO_KEEP from filein to fileout, a block
+    of chunks at a time.
+
+    The subset is written to fileout.part and renamed into place once it
+    checks out, so fileout is always a complete file. With delete, filein is
+    only removed after that check, never when the subset failed.
+
+    :arg filein: TEMPO granule
+    :arg fileout: subset file to write
+    :kwarg dry_run: log what would be done without writing or deleting
+    :kwarg delete: delete filein after a successful subset
+    :kwarg complevel: zlib level of the subset, 0 for no compression
+    :kwarg shuffle: apply the shuffle filter before zlib
+    :kwarg passthrough: copy compressed chunks unchanged when the source
+        chunking and filters allow it, ignoring complevel and shuffle
+    :kwarg bbox: (lon_min, lat_min, lon_max, lat_max), keep only the grid
+        cells inside it. The bounds attributes are rewritten to match and
+        passthrough does not apply.
+    returns: "subset", "exists" (a complete fileout was already there) or "dry-run"
+    """
+    filein, fileout = Path(filein), Path(fileout)
 
     # print(" ======== Subsetting file ========= ")
     # print(f"\t Input file: {filein}")
@@ -73,84 +379,172 @@ def subset_files(filein, fileout, show_time = True):
     # print(" ================================== ")
     logger.info(f"Subsetting file: {filein} to {fileout}")
 
-    if fileout.exists():
-        logger.error(f"\nOutput file {fileout} already exists\n")
-        sys.exit(1)
-
+    if filein.resolve() == fileout.resolve():
+        raise ValueError(f"Refusing to subset {filein} onto itself")
 
-    if args.dry_run:
+    if dry_run:
         logger.info("Dry run: Subsetting file")
+        status = "dry-run"
+    elif fileout.exists():
+        if not is_complete_subset(filein, fileout, bbox=bbox):
+            raise FileExistsError(f"Output file {fileout} already exists and is not a complete subset of {filein}")
+        logger.info(f"Output file {fileout} already exists")
+        status = "exists"
     else:
-        with TimedContext(use_timer = show_time) as timer:
-            # adapted from https://stackoverflow.com/a/49592545/11594175
-            with Dataset(filein) as src, Dataset(fileout, "w") as dst:
-                dst.setncatts(src.__dict__)
-                for name, dimension in src.dimensions.items():
-                    dst.createDimension(
-                        name, (len(dimension) if not dimension.isunlimited() else None)
-                    )
-                # need to copy groups and variables in the list. groups have a / in their name
-                for name, variable in src.variables.items():
-                    if name in variables_to_keep:
-                        chunksizes = variable.chunking()
-                        if chunksizes == "contiguous":
-                            chunksizes = (1,)
-                        x = dst.createVariable(
-                            name,
-                            variable.datatype,
-                            variable.dimensions,
-                            chunksizes=chunksizes,
-                            compression="zlib",
-                        )
-                        # x.set_var_chunk_cache(variable.get_var_chunk_cache())
-                        dst[name].setncatts(src[name].__dict__)
-                        dst[name][:] = src[name][:]
-
-                groups_to_keep = [g.split("/")[0] for g in variables_to_keep if "/" in g]
-                vars_to_keep = [v.split("/")[1] for v in variables_to_keep if "/" in v]
-                for group_name, group in src.groups.items():
-                    if group_name in groups_to_keep:
-                        dst.createGroup(group_name)
-                        for name, variable in group.variables.items():
-                            if name in vars_to_keep:
-                                name = group_name + "/" + name
-                                chunksizes = variable.chunking()
-                                if chunksizes == "contiguous":
-                                    chunksizes = (1,)
-                                x = dst.createVariable(
-                                    name,
-                                    variable.datatype,
-                                    variable.dimensions,
-                                    chunksizes=chunksizes,
-                                    compression="zlib",
-                                )
-                                # x.set_var_chunk_cache(variable.get_var_chunk_cache())
-                                dst[name].setncatts(src[name].__dict__)
-                                dst[name][:] = src[name][:]
-
-    if args.delete:
-        if args.dry_run:
+        part = fileout.with_name(fileout.name + PART_SUFFIX)
+        try:
+            with TimedContext(use_timer = show_time) as timer:
+                with Dataset(filein) as src, Dataset(part, "w") as dst:
+                    raw = copy_variables(src, dst, VARIABLES_TO_KEEP, complevel, shuffle, passthrough, bbox)
+                if raw:
+                    left = copy_raw_chunks(filein, part, raw)
+                    if left:
+                        # filters were not reproduced exactly, decode these instead
+                        with Dataset(filein) as src, Dataset(part, "a") as dst:
+                            for name in left:
+                                copy_data(src[name], dst[name])
+            if not is_complete_subset(filein, part, bbox=bbox):
+                raise RuntimeError(f"Subset of {filein} is incomplete")
+            os.replace(part, fileout)
+        except BaseException:
+            part.unlink(missing_ok=True)
+            raise
+        status = "subset"
+
+    if delete:
+        if dry_run:
             logger.info(f"Dry run: Deleted {filein}")
         else:
-            if fileout.exists():
-                filein.unlink()
-                logger.debug(f"\nDeleted {filein}")
+            filein.unlink()
+            logger.debug(f"\nDeleted {filein}")
+    return status
+
+
+def _subset_one(filein: Path, fileout: Path, dry_run: bool, delete: bool, options: dict) -> tuple[Path, str, int, float]:
+    """
+    Worker for subset_batch.
+
+    returns: (filein, status, input bytes, seconds), status is "failed: <error>" on failure
+    """
+    size = filein.stat().st_size
+    start = time.perf_counter()
+    try:
+        status = subset_files(filein, fileout, show_time=False, dry_run=dry_run, delete=delete, **options)
+    except Exception as e:
+        status = f"failed: {e}"
+    return filein, status, size, time.perf_counter() - start
+
+
+def subset_batch(
+    inputs,
+    output_dir: Path,
+    workers: int | None = None,
+    dry_run = False,
+    delete = False,
+    inventory = None,
+    complevel = DEFAULT_COMPLEVEL,
+    shuffle = True,
+    passthrough = False,
+    bbox = None,
+) -> tuple[list[Path], list[Path]]:
+    """
+    Subset many granules in one pool of worker processes.
+
+    :arg inputs: a directory (its *.nc files are used) or a list of files
+    :arg output_dir: where the subsets go, under the input file names
+    :kwarg workers: number of processes, default os.cpu_count()
+    :kwarg delete: delete each input once its subset is complete
+    :kwarg inventory: GranuleInventory to record the subsets (and deletions) in
+    :kwarg complevel, shuffle, passthrough: compression, see subset_files
+    :kwarg bbox: crop every subset to this box, see subset_files
+    returns: (subset files written or already present, input files that failed)
+    """
+    if isinstance(inputs, (str, Path)) and Path(inputs).is_dir():
+        inputs = sorted(Path(inputs).glob("*.nc"))
+    inputs = [Path(f) for f in inputs]
+    output_dir = Path(output_dir)
+    if not dry_run:
+        output_dir.mkdir(parents=True, exist_ok=True)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(inputs) or 1))
+
+    done, failed = [], []
+    total_bytes = 0
+    start = time.perf_counter()
+    # HDF5 is not thread safe, so each file gets a process
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        options = dict(complevel=complevel, shuffle=shuffle, passthrough=passthrough, bbox=bbox)
+        futures = [pool.submit(_subset_one, f, output_dir / f.name, dry_run, delete, options) for f in inputs]
+        for i, future in enumerate(as_completed(futures), start=1):
+            filein, status, size, seconds = future.result()
+            if status.startswith("failed"):
+                logger.error(f"[{i}/{len(inputs)}] {filein.name} {status}")
+                failed.append(filein)
+                continue
+            done.append(output_dir / filein.name)
+            if status == "subset":
+                total_bytes += size
+                logger.info(
+                    f"[{i}/{len(inputs)}] {filein.name}: {size / 2**20:.1f} MB in {seconds:.2f}s "
+                    f"({size / 2**20 / max(seconds, 1e-9):.1f} MB/s)"
+                )
+            else:
+                logger.info(f"[{i}/{len(inputs)}] {filein.name}: {status}")
+            if inventory is not None and not dry_run:
+                inventory.add_files([output_dir / filein.name])
+                if delete:
+                    inventory.remove(filein)
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"Subset {len(done)} of {len(inputs)} files, read {total_bytes / 2**20:.1f} MB in {elapsed:.1f}s "
+        f"({total_bytes / 2**20 / max(elapsed, 1e-9):.1f} MB/s, {workers} workers)"
+    )
+    return done, failed
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Subset TEMPO data")
 
-    # The file we want to subset
-    parser.add_argument("-f", "--file", type=str, help="File to subset", required=True)
+    # The files we want to subset
+    parser.add_argument("-f", "--file", type=str, nargs="+", help="File(s) to subset")
+
+    # or every .nc file in a directory
+    parser.add_argument("-i", "--input-dir", type=str, help="Subset every .nc file in this directory", default=None)
 
     # The output file name
-    parser.add_argument("-o", "--output", type=str, help="Output file name", default="")
+    parser.add_argument("-o", "--output", type=str, help="Output file name (or directory)", default="")
 
     # delete original after subsetting
     parser.add_argument(
         "-d", "--delete", action="store_true", help="Delete original file after subsetting"
     )
-    
+
+    # number of worker processes for several files
+    parser.add_argument("-j", "--workers", type=int, help="Worker processes when subsetting several files", default=None)
+
+    parser.add_argument("--inventory", type=str, help="Granule inventory to record the subsets in", default=None)
+
+    # compression of the subset files
+    parser.add_argument("--complevel", type=int, help="zlib level, 0 for none (default: 4)", default=DEFAULT_COMPLEVEL)
+    parser.add_argument("--no-shuffle", action="store_true", help="Do not apply the shuffle filter")
+    parser.add_argument(
+        "--passthrough",
+        action="store_true",
+        help="Copy compressed chunks unchanged where the source chunking allows, ignoring --complevel",
+    )
+
+    # spatial crop
+    region = parser.add_mutually_exclusive_group()
+    region.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=("LON_MIN", "LAT_MIN", "LON_MAX", "LAT_MAX"),
+        help="Keep only the grid cells inside this box",
+        default=None,
+    )
+    region.add_argument("--region", type=str, choices=sorted(REGIONS), help="Named bounding box", default=None)
+
     # add debug flag
     parser.add_argument("-v", "--debug", action="store_true", help="Verbose output")
 
@@ -159,11 +553,37 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
     # terminate and show help if no arguments are given
-    if len(sys.argv) == 1:
+    if len(sys.argv) == 1 or not (args.file or args.input_dir):
         parser.print_help(sys.stderr)
         sys.exit(1)
-        
-    filein = Path(args.file)
+
+    if args.debug  or args.dry_run:
+        set_log_level(debug = True)
+
+    bbox = tuple(args.bbox) if args.bbox is not None else REGIONS.get(args.region)
+    if bbox is not None and not (bbox[0] < bbox[2] and bbox[1] < bbox[3]):
+        parser.error("--bbox needs LON_MIN < LON_MAX and LAT_MIN < LAT_MAX")
+
+    if args.input_dir is not None or len(args.file) > 1:
+        # batch: the output is a directory, subsetted_netcdf next to the inputs by default
+        inputs = Path(args.input_dir) if args.input_dir is not None else [Path(f) for f in args.file]
+        if args.output:
+            output_dir = Path(args.output)
+        elif args.input_dir is not None:
+            output_dir = Path(args.input_dir) / "subsetted_netcdf"
+        else:
+            output_dir = Path(args.file[0]).parent / "subsetted_netcdf"
+        inventory = None
+        if args.inventory is not None:
+            from granule_inventory import GranuleInventory
+            inventory = GranuleInventory(args.inventory)
+        _, failed = subset_batch(
+            inputs, output_dir, args.workers, args.dry_run, args.delete, inventory,
+            complevel=args.complevel, shuffle=not args.no_shuffle, passthrough=args.passthrough, bbox=bbox,
+        )
+        sys.exit(1 if failed else 0)
+
+    filein = Path(args.file[0])
 
     if not filein.exists():
         logger.error(f"File {filein} does not exist")
@@ -185,7 +605,18 @@ if __name__ == "__main__":
     else:
         fileout = Path(args.output)
 
-    if args.debug  or args.dry_run:
-        set_log_level(debug = True)
-    
-    subset_files(filein = filein, fileout = fileout)
\ No newline at end of file
+    try:
+        subset_files(
+            filein = filein, fileout = fileout, dry_run = args.dry_run, delete = args.delete,
+            complevel = args.complevel, shuffle = not args.no_shuffle, passthrough = args.passthrough,
+            bbox = bbox,
+        )
+    except (OSError, ValueError, RuntimeError) as e:
+        logger.error(str(e))
+        sys.exit(1)
+    if args.inventory is not None and not args.dry_run:
+        from granule_inventory import GranuleInventory
+        with GranuleInventory(args.inventory) as inventory:
+            inventory.add_files([fileout])
+            if args.delete:
+                inventory.remove(filein)
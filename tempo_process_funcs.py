@@ -5,21 +5,27 @@ Adapted from code orignially by Jonathan Foster (@jfoster17 on github)
 from datetime import datetime, timezone
 import numpy as np
 import xarray as xr
+import h5netcdf
 import glob
+import re
 
 import matplotlib.pyplot as plt
 import matplotlib.colors as mc
 from matplotlib.colors import LinearSegmentedColormap
 
 # set datetime to default to UTC
-from colormap import svs_tempo_cmap
+from colormap import svs_tempo_cmap, colormap_palette
 from typing import Tuple
 import io
 
 import matplotlib.image as mimg
+import matplotlib.cm as mcm
 import tqdm.notebook as tqdm
 
 import rasterio
+# registers the .rio accessor (get_bounds, combine_data); xr.open_dataset used
+# to import it as a side effect, granules are now read with h5netcdf directly
+import rioxarray  # noqa: F401
 from rasterio import Affine as A
 from rasterio.warp import reproject, Resampling, calculate_default_transform
 
@@ -34,6 +40,8 @@ import shapely
 from shapely import Polygon
 from shapely.ops import transform
 from get_tempo_data_utils import run_command
+from reprojection_plan import get_plan, supports_plan
+from png_encoder import write_png, encode_png
 
 from logger import setup_logging
 
@@ -75,6 +83,65 @@ def quality_mask(
     return high_quality
 
 
+# quality_mask as (solar zenith angle limit, limit inclusive, max quality flag)
+QUALITY_LIMITS = {
+    "high": (80, False, 0),
+    "medium": (80, False, 0),
+    "low": (80, False, 0),
+    "svs": (80, True, 1),
+    "all": (None, False, 1),
+}
+
+
+def mask_granule(
+    vertical_column: np.ndarray,
+    main_data_quality_flag: np.ndarray,
+    solar_zenith_angle: np.ndarray,
+    eff_cloud_fraction: np.ndarray,
+    quality_flag: str = "svs",
+    scale: float = 10**16,
+    cloud_threshold: float | None = None,
+    dtype=np.float32,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    quality_mask + where + scaling on plain arrays, in one pass per output.
+
+    Builds the quality/SZA mask in place in a single boolean buffer, writes
+    vertical_column / scale and eff_cloud_fraction straight into the outputs
+    and NaNs the masked pixels, so no masked Dataset copies are made. NaN quality flags or
+    zenith angles are masked, as in quality_mask. An unknown quality_flag
+    masks everything, like Dataset.where(None).
+
+    :kwarg cloud_threshold: also mask NO2 where eff_cloud_fraction > threshold,
+        at the native resolution. The rendering path thresholds after
+        reprojection instead, so it leaves this None.
+    :kwarg dtype: dtype of both outputs
+    returns: (no2, cloud) masked arrays
+    """
+    limits = QUALITY_LIMITS.get(quality_flag)
+    mask = np.zeros(vertical_column.shape, dtype=bool)
+    if limits is None:
+        logger.warning(f"Unknown quality flag {quality_flag}, masking all data")
+    else:
+        sza_limit, inclusive, max_flag = limits
+        np.less_equal(main_data_quality_flag, max_flag, out=mask)
+        if sza_limit is not None:
+            compare = np.less_equal if inclusive else np.less
+            mask &= compare(solar_zenith_angle, sza_limit)
+        if cloud_threshold is not None:
+            # NaN cloud fractions are kept, as np.where(~(cloud > t)) would
+            mask &= ~(eff_cloud_fraction > cloud_threshold)
+
+    # a masked ufunc (where=) is much slower than a full pass plus a putmask
+    invalid = np.logical_not(mask, out=mask)
+    no2 = np.empty(vertical_column.shape, dtype=dtype)
+    np.divide(vertical_column, scale, out=no2, casting="unsafe")
+    np.putmask(no2, invalid, np.nan)
+    cloud = np.array(eff_cloud_fraction, dtype=dtype)
+    np.putmask(cloud, invalid, np.nan)
+    return no2, cloud
+
+
 def cloud_cover_mask(quality_flag):
     logger.debug(f"Getting cloud threshold for quality flag: {quality_flag}")
     if quality_flag == "high":
@@ -87,24 +154,113 @@ def cloud_cover_mask(quality_flag):
         return 0.0
 
 
+# the variables the pipeline uses from each group of a granule
+GRANULE_VARIABLES = {
+    "product": ["vertical_column_troposphere", "main_data_quality_flag"],
+    "geolocation": ["solar_zenith_angle"],
+    "support_data": ["eff_cloud_fraction"],
+}
+
+
+def _mask_and_scale(data: np.ndarray, attrs) -> np.ndarray:
+    """
+    CF decoding as xarray does it: fill/missing values to NaN, then
+    scale_factor and add_offset. Masked integers become float32 (<= 2 bytes)
+    or float64.
+    """
+    fills = [np.asarray(attrs[k]).ravel() for k in ("_FillValue", "missing_value") if k in attrs]
+    scale = attrs.get("scale_factor")
+    offset = attrs.get("add_offset")
+    if not fills and scale is None and offset is None:
+        return data
+    if data.dtype.kind in "iu":
+        dtype = np.float32 if data.dtype.itemsize <= 2 else np.float64
+    else:
+        dtype = data.dtype
+    if scale is not None or offset is not None:
+        dtype = np.result_type(dtype, *[np.asarray(v).dtype for v in (scale, offset) if v is not None])
+    out = data.astype(dtype)
+    for fill in np.concatenate(fills) if fills else []:
+        out[np.isnan(data) if np.isnan(fill) else data == fill] = np.nan
+    if scale is not None:
+        out *= scale
+    if offset is not None:
+        out += offset
+    return out
+
+
+def _read_coords(f: h5netcdf.File) -> xr.Dataset:
+    coord_vars = {}
+    for name in ("time", "latitude", "longitude"):
+        var = f.variables[name]
+        attrs = dict(var.attrs)
+        values = var[()]
+        if name == "time":
+            values = xr.coding.times.decode_cf_datetime(values, attrs.pop("units"), attrs.pop("calendar", None))
+        coord_vars[name] = xr.Variable((name,), values, attrs)
+    return xr.Dataset(coords=coord_vars, attrs=dict(f.attrs))
+
+
+def read_granule_coords(input_file: str | Path) -> xr.Dataset:
+    """
+    Only the time, latitude and longitude coordinates and the global
+    attributes of a granule, decoded as read_granule_arrays decodes them.
+    No data variable is read.
+    """
+    with h5netcdf.File(input_file, "r") as f:
+        return _read_coords(f)
+
+
+def read_granule_arrays(
+    input_file: str | Path, variables: dict[str, list[str]] = GRANULE_VARIABLES
+) -> tuple[xr.Dataset, xr.Dataset, xr.Dataset, xr.Dataset]:
+    """
+    Read a granule through a single h5netcdf handle, loading only `variables`.
+
+    returns: (coords, product, geolocation, support_data) datasets backed by
+    numpy arrays, decoded the same way xr.open_dataset decodes them
+    """
+    with h5netcdf.File(input_file, "r") as f:
+        coords = _read_coords(f)
+        groups = []
+        for group, names in variables.items():
+            data_vars = {}
+            for name in names:
+                var = f.groups[group].variables[name]
+                attrs = {k: v for k, v in var.attrs.items() if k not in ("_FillValue", "missing_value", "scale_factor", "add_offset")}
+                data_vars[name] = xr.Variable(var.dimensions, _mask_and_scale(var[()], var.attrs), attrs)
+            groups.append(xr.Dataset(data_vars))
+    return (coords, *groups)
+
+
 def process_file(
-    input_file: str, quality_flag: str = "svs"
+    input_file: str, quality_flag: str = "svs", lazy: bool = True
 ) -> tuple[xr.Dataset, datetime, xr.Dataset, xr.Dataset]:
+    """
+    Read a granule and apply the quality mask.
+
+    lazy True: open each group as dask arrays (every variable, nothing read
+        until computed), for combining many granules
+    lazy False: read only GRANULE_VARIABLES into memory through one file handle
+    """
     logger.debug(f"Processing file: {input_file}")
 
     if not Path(input_file).exists():
         logger.error(f"File {input_file} does not exist")
         raise FileNotFoundError(f"File {input_file} does not exist")
-    coords = xr.open_dataset(input_file, engine="h5netcdf", chunks="auto")
-    product = xr.open_dataset(
-        input_file, engine="h5netcdf", chunks="auto", group="product"
-    )
-    geoloc = xr.open_dataset(
-        input_file, engine="h5netcdf", chunks="auto", group="geolocation"
-    )
-    support = xr.open_dataset(
-        input_file, engine="h5netcdf", chunks="auto", group="support_data"
-    )
+    if lazy:
+        coords = xr.open_dataset(input_file, engine="h5netcdf", chunks="auto")
+        product = xr.open_dataset(
+            input_file, engine="h5netcdf", chunks="auto", group="product"
+        )
+        geoloc = xr.open_dataset(
+            input_file, engine="h5netcdf", chunks="auto", group="geolocation"
+        )
+        support = xr.open_dataset(
+            input_file, engine="h5netcdf", chunks="auto", group="support_data"
+        )
+    else:
+        coords, product, geoloc, support = read_granule_arrays(input_file)
     product = product.assign_coords(coords.coords)
 
     try:
@@ -164,7 +320,13 @@ def get_bounds(chunk: xr.DataArray, pairs=False, bbox=False):
 
 
 def project_array(
-    array, bounds, refinement: float = 1, projection="EPSG:3857", method="nearest"
+    array,
+    bounds,
+    refinement: float = 1,
+    projection="EPSG:3857",
+    method="nearest",
+    use_plan=True,
+    dtype=np.float64,
 ):
     logger.debug(f"Projecting array with method: {method}")
     """
@@ -174,16 +336,25 @@ def project_array(
     Web Mercator is EPSG:3857
     
     ipyleaflets use the Mercator Web coordinate system.
-    :arg array: Data in 2D numpy array
+    :arg array: Data in 2D numpy array, or 3D (bands, lat, lon) to project
+        several fields on the same grid in one call
     :arg bounds: Image latitude, longitude bounds, [(lat_min, lon_min), (lat_max, lon_max)]
     :kwarg int refinement: Scaling factor for output array resolution.
         refinement=1 implies that output array has the same size as the input.
     :method nearest, average, bilinear, cubic, med, sum: Resampling method
+    :kwarg use_plan: Use a cached ReprojectionPlan when one exists for the
+        projection and method instead of running a GDAL warp.
+    :kwarg dtype: dtype of the projected array (float32 halves the memory)
     """
+    if use_plan and supports_plan(projection, method, refinement):
+        plan = get_plan(bounds, array.shape[-2:], refinement, projection, method)
+        logger.debug("Projection completed (cached plan)")
+        return plan.apply(array, dtype=dtype)
+
     with rasterio.Env():
 
         (lat_min, lon_min), (lat_max, lon_max) = bounds
-        nlat, nlon = array.shape
+        nlat, nlon = array.shape[-2:]
         dlat = (lat_max - lat_min) / nlat
         dlon = (lon_max - lon_min) / nlon
         src_transform = A.translation(lon_min, lat_min) * A.scale(dlon, dlat)
@@ -197,8 +368,8 @@ def project_array(
         dst_transform, width, height = calculate_default_transform(
             src_crs, dst_crs, nlon, nlat, *bbox, dst_width=nlon2, dst_height=nlat2
         )
-        dst_shape = height, width
-        destination = np.zeros(dst_shape) # type: ignore
+        dst_shape = array.shape[:-2] + (height, width)
+        destination = np.zeros(dst_shape, dtype=dtype) # type: ignore
 
         if method == "average":
             method = Resampling.average
@@ -262,27 +433,103 @@ def save_grayscale_with_transparency(data, filename, vmin=None, vmax=None):
     return rgba_img
 
 
+def block_average(array: np.ndarray, factor: int = 2, skipna=False) -> np.ndarray:
+    """
+    Downsample the last two axes of an array by averaging factor x factor blocks.
+    Trailing rows/columns that do not fill a block are dropped, the same
+    size project_array gives for refinement = 1 / factor.
+
+    With skipna=False a NaN anywhere in a block makes the block NaN, which is
+    what GDAL's average resampling does with our (nodata-less) arrays.
+    """
+    nrow, ncol = array.shape[-2] // factor, array.shape[-1] // factor
+    array = array[..., : nrow * factor, : ncol * factor]
+    # strided slices are much faster than reshape(...).mean(axis=(1, 3))
+    offsets = [(i, j) for i in range(factor) for j in range(factor)]
+    if not skipna:
+        total = sum(array[..., i::factor, j::factor] for i, j in offsets)
+        return total / factor**2
+    valid = ~np.isnan(array)
+    filled = np.where(valid, array, 0)
+    total = sum(filled[..., i::factor, j::factor] for i, j in offsets)
+    count = sum(valid[..., i::factor, j::factor].astype(np.int8) for i, j in offsets)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, total / count, np.nan)
+
+
 def reproject_data(
-    xarray: xr.DataArray, bounds, reproject=True, method="average"
-) -> Tuple[np.ndarray, np.ndarray]:
+    xarray: xr.DataArray | np.ndarray,
+    bounds,
+    reproject=True,
+    method="average",
+    use_plan=True,
+    pyramid=False,
+    levels: int = 2,
+    dtype=np.float64,
+) -> Tuple[np.ndarray, ...]:
+    """
+    Reproject data to full resolution and successively halved resolutions.
+
+    returns: tuple of `levels` arrays, (full_res, half_res, quarter_res, ...)
+    pyramid True: warp once at full resolution and build the lower levels by
+        block averaging, instead of warping from the original data for each
+    dtype: dtype of the input handed to the warp and of every level
+    """
     logger.debug("Reprojecting data")
-    og_data = xarray.to_numpy()
+    og_data = xarray.to_numpy() if isinstance(xarray, xr.DataArray) else np.asarray(xarray)
+    og_data = og_data.astype(dtype, copy=False)
 
     if reproject:
         projection = "EPSG:3857"  # Web Mercator
     else:
         projection = "EPSG:4326"  # WGS84 / Equirectangular
 
-    # Always do both refinements
     full_res = project_array(
-        og_data, bounds, refinement=1, projection=projection, method=method
-    )
-    half_res = project_array(
-        og_data, bounds, refinement=0.5, projection=projection, method=method
+        og_data, bounds, refinement=1, projection=projection, method=method, use_plan=use_plan, dtype=dtype
     )
+    out = [full_res]
+    for level in range(1, levels):
+        if pyramid:
+            out.append(block_average(out[-1], 2))
+        else:
+            out.append(
+                project_array(
+                    og_data,
+                    bounds,
+                    refinement=0.5**level,
+                    projection=projection,
+                    method=method,
+                    use_plan=use_plan,
+                    dtype=dtype,
+                )
+            )
 
     logger.debug("Reprojection completed")
-    return full_res, half_res
+    return tuple(out)
+
+
+def reproject_bands(
+    bands: dict[str, xr.DataArray | np.ndarray],
+    bounds,
+    reproject=True,
+    method="average",
+    use_plan=True,
+    pyramid=False,
+    levels: int = 2,
+    dtype=np.float64,
+) -> dict[str, Tuple[np.ndarray, ...]]:
+    """
+    Reproject several fields that share a grid (e.g. NO2 and cloud fraction)
+    with one multi-band warp per resolution instead of one warp per field.
+
+    returns: dict of name -> (full_res, half_res, ...) like reproject_data
+    """
+    names = list(bands)
+    stack = np.stack([np.asarray(bands[name], dtype=dtype) for name in names])
+    stacked_levels = reproject_data(stack, bounds, reproject, method, use_plan, pyramid, levels, dtype)
+    return {
+        name: tuple(level[i] for level in stacked_levels) for i, name in enumerate(names)
+    }
 
 
 # def save_image(
@@ -309,9 +556,22 @@ def save_image(
     vmin: float,
     vmax: float,
     filename: Path | str,
-    overwrite=False
+    overwrite=False,
+    dtype=None,
 ) -> None:
-    save_image_compressed_command(projected_data, cmap, vmin, vmax, filename, overwrite = overwrite)
+    """
+    dtype: normalisation arithmetic type (e.g. float64 for float32 frames,
+        to render the same images as the float64 data path)
+    """
+    try:
+        colormap_palette(cmap)
+    except ValueError:
+        # more colours than an indexed PNG can hold
+        if dtype is not None:
+            projected_data = projected_data.astype(dtype, copy=False)
+        save_image_compressed_native(projected_data, cmap, vmin, vmax, filename, overwrite = overwrite)
+        return
+    save_image_lut(projected_data, cmap, vmin, vmax, filename, overwrite = overwrite, dtype = dtype)
 
 
 def save_image_compressed_buffer(
@@ -357,19 +617,20 @@ def save_image_compressed_command(
     logger.debug(f"Saving image to: {filename}")
 
     if (not overwrite) and Path(filename).exists():
+        # already written (and compressed) by an earlier run
         logger.debug(f"File {filename} already exists. Skipping creation.")
-    else:
-        if Path(filename).exists() and overwrite:
-            logger.info(f"WARNING: Overwrote file {filename}")
-        mimg.imsave(
-            fname=filename,
-            arr=projected_data,
-            cmap=cmap,
-            vmin=vmin,
-            vmax=vmax,
-            origin="upper",
-            format="png"
-        )
+        return
+    if Path(filename).exists() and overwrite:
+        logger.info(f"WARNING: Overwrote file {filename}")
+    mimg.imsave(
+        fname=filename,
+        arr=projected_data,
+        cmap=cmap,
+        vmin=vmin,
+        vmax=vmax,
+        origin="upper",
+        format="png"
+    )
     # use the imagemagick command line tool to compress the image
     # convert "$file" -define png:compression-filter=5 -define png:compression-level=1 -define png:compression-strategy=3 "$file"
     outfilename = str(filename)
@@ -394,6 +655,143 @@ def save_image_compressed_command(
     logger.debug("Image saved")
 
 
+def colormap_rgba(
+    projected_data: np.ndarray,
+    cmap: LinearSegmentedColormap | str,
+    vmin: float,
+    vmax: float,
+) -> np.ndarray:
+    """
+    Colormap data to (height, width, 4) uint8 RGBA exactly as mimg.imsave does,
+    NaNs become the colormap's "bad" colour (transparent by default)
+    """
+    sm = mcm.ScalarMappable(cmap=cmap)
+    sm.set_clim(vmin, vmax)
+    return sm.to_rgba(projected_data, bytes=True)
+
+
+# rows normalised at a time by colormap_indices
+COLORMAP_ROWS = 256
+
+
+def colormap_indices(
+    projected_data: np.ndarray,
+    vmin: float,
+    vmax: float,
+    N: int = 256,
+    dtype=None,
+) -> np.ndarray:
+    """
+    Colormap lookup-table level for each pixel, using the same arithmetic as
+    matplotlib's Normalize and Colormap so the result matches mimg.imsave.
+    Works through COLORMAP_ROWS rows at a time, so the floating point
+    temporaries stay small next to the image.
+
+    dtype: arithmetic type, default the one Normalize uses (float32 stays
+        float32, everything else is promoted to float64)
+    returns: int16 array of levels 0..N-1, N (under), N + 1 (over), N + 2 (NaN)
+    """
+    if dtype is None:
+        dtype = np.promote_types(projected_data.dtype, np.float32)
+    vmin, vmax = np.float64(vmin), np.float64(vmax)
+    levels = np.empty(projected_data.shape, dtype=np.int16)
+    for start in range(0, len(projected_data), COLORMAP_ROWS):
+        rows = slice(start, start + COLORMAP_ROWS)
+        data = np.array(projected_data[rows], dtype=dtype)
+        if vmin == vmax:
+            data.fill(0)
+        else:
+            data -= vmin
+            data /= vmax - vmin
+        data *= N
+        data[data == N] = N - 1
+        strip = levels[rows]
+        with np.errstate(invalid="ignore"):
+            strip[...] = data.astype(np.int16)
+        strip[data < 0] = N
+        strip[data >= N] = N + 1
+        strip[np.isnan(data)] = N + 2
+    return levels
+
+
+def save_image_lut(
+    projected_data: np.ndarray,
+    cmap: LinearSegmentedColormap | str,
+    vmin: float,
+    vmax: float,
+    filename: Path | str,
+    compression_filter: int = 0,
+    compression_level: int = 9,
+    compression_strategy: int = 1,
+    overwrite=False,
+    dtype=None,
+) -> None:
+    """
+    Render through the colormap's precomputed 8-bit palette and write an
+    indexed PNG: one byte per pixel instead of four, with NaN as the
+    transparent palette entry. Decodes to the same pixels as mimg.imsave.
+
+    dtype: normalisation arithmetic type, see colormap_indices
+    """
+    logger.debug(f"Saving image to: {filename}")
+
+    if (not overwrite) and Path(filename).exists():
+        logger.debug(f"File {filename} already exists. Skipping creation.")
+        return
+    if Path(filename).exists() and overwrite:
+        logger.info(f"WARNING: Overwrote file {filename}")
+
+    palette, level_to_index = colormap_palette(cmap)
+    indices = level_to_index[colormap_indices(projected_data, vmin, vmax, len(level_to_index) - 3, dtype)]
+    data = encode_png(
+        indices,
+        palette=palette,
+        compression_filter=compression_filter,
+        compression_level=compression_level,
+        compression_strategy=compression_strategy,
+    )
+    with open(filename, "wb") as f:
+        f.write(data)
+    logger.debug("Image saved")
+
+
+def save_image_compressed_native(
+    projected_data: np.ndarray,
+    cmap: LinearSegmentedColormap | str,
+    vmin: float,
+    vmax: float,
+    filename: Path | str,
+    compression_filter: int = 4,
+    compression_level: int = 9,
+    compression_strategy: int = 1,
+    quantize=False,
+    overwrite=False
+) -> None:
+    """
+    Same output options as save_image_compressed_command, but colormaps and
+    encodes the PNG in-process in a single pass (no temporary file, no
+    ImageMagick subprocess). quantize=True writes an indexed-palette PNG.
+    """
+    logger.debug(f"Saving image to: {filename}")
+
+    if (not overwrite) and Path(filename).exists():
+        logger.debug(f"File {filename} already exists. Skipping creation.")
+        return
+    if Path(filename).exists() and overwrite:
+        logger.info(f"WARNING: Overwrote file {filename}")
+
+    rgba = colormap_rgba(projected_data, cmap, vmin, vmax)
+    write_png(
+        filename,
+        rgba,
+        quantize=quantize,
+        compression_filter=compression_filter,
+        compression_level=compression_level,
+        compression_strategy=compression_strategy,
+    )
+    logger.debug("Image saved")
+
+
 # Modify the existing plot_image function if needed
 def plot_image(
     projected_data: np.ndarray,
@@ -417,11 +815,27 @@ def plot_image(
 # file name format is tempo_2024-03-28T12h24m.png
 def chunk_to_fname(chunck: xr.DataArray, suffix="") -> str:
     logger.debug("Generating filename from chunk time")
-    time = chunck.time.values
-    time_str = time.astype("datetime64[s]").astype(datetime).strftime("%Y-%m-%dT%Hh%Mm")
+    return datetime64_to_fname(chunck.time.values, suffix)
+
+
+def datetime64_to_fname(time: np.datetime64, suffix="") -> str:
+    time_str = np.datetime64(time).astype("datetime64[s]").astype(datetime).strftime("%Y-%m-%dT%Hh%Mm")
     return f"tempo_{time_str}{suffix}.png"
 
 
+def fname_to_datetime64(input_file: str | Path) -> np.datetime64 | None:
+    """
+    Scan start time from a TEMPO file name, e.g.
+    TEMPO_NO2_L3_V03_20240501T120000Z_S001.nc -> 2024-05-01T12:00:00
+
+    returns: None if the name has no timestamp
+    """
+    match = re.search(r"_(\d{8}T\d{6})Z_", Path(input_file).name)
+    if match is None:
+        return None
+    return np.datetime64(datetime.strptime(match.group(1), "%Y%m%dT%H%M%S"), "s")
+
+
 def time_to_fname(time: datetime, suffix="", format="%Y-%m-%dT%H:%M:%SZ") -> str:
     logger.debug("Generating filename from chunk time")
     time_str = time.replace(tzinfo=timezone.utc).strftime(format)
@@ -430,9 +844,12 @@ def time_to_fname(time: datetime, suffix="", format="%Y-%m-%dT%H:%M:%SZ") -> str
 
 def chunk_time_to_jstime(chunck: xr.DataArray) -> int:
     logger.debug("Converting chunk time to JS timestamp")
-    time = chunck.time.values
+    return datetime64_to_jstime(chunck.time.values)
+
+
+def datetime64_to_jstime(time: np.datetime64) -> int:
     # get the number of seconds since the epoch
-    time_str = time.astype("datetime64[s]").astype(datetime).strftime("%Y-%m-%dT%Hh%Mm")
+    time_str = np.datetime64(time).astype("datetime64[s]").astype(datetime).strftime("%Y-%m-%dT%Hh%Mm")
     # convert the time string to datetime
     d = datetime.strptime(time_str, "%Y-%m-%dT%Hh%Mm")
     # need to convert timezone to utc https://www.phind.com/search?cache=bywp7qy3dytgxu48phlmlg7e
@@ -0,0 +1,55 @@
+"""
+AggregateStore folded in parts, including a granule that arrives late,
+gives the same means as aggregate_files over every granule at once
+"""
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from aggregate_data import AGGREGATIONS, FORMATS, aggregate_files, update_store
+from benchmarks import write_synthetic_file
+
+TIMES = ["2024-05-01T12:00:00", "2024-05-01T18:00:00", "2024-05-02T12:00:00", "2024-05-06T13:00:00"]
+# folded first, the rest (with LATE, after its day) in a second update
+FIRST = [0, 2]
+LATE = "2024-05-01T15:00:00"
+
+
+def granule_name(time: str) -> str:
+    return f"TEMPO_NO2_L3_V03_{time.replace('-', '').replace(':', '')}Z_S001.nc"
+
+
+@pytest.fixture
+def granules(tmp_path):
+    paths = []
+    for seed, time in enumerate(TIMES + [LATE]):
+        path = tmp_path / "data" / granule_name(time)
+        path.parent.mkdir(exist_ok=True)
+        write_synthetic_file(str(path), scale=16, seed=seed, time=time)
+        paths.append(str(path))
+    return paths
+
+
+@pytest.mark.parametrize("fmt", list(FORMATS))
+def test_fold_in_parts_matches_one_pass(tmp_path, granules, fmt):
+    expected = aggregate_files(granules, tmp_path / "one_pass", fmt=fmt, variance=True)
+
+    store, output = tmp_path / "store", tmp_path / "store_output"
+    touched = update_store([granules[i] for i in FIRST], store, output, fmt=fmt, variance=True)
+    assert touched["daily"] == {np.datetime64("2024-05-01"), np.datetime64("2024-05-02")}
+    touched = update_store(granules, store, output, fmt=fmt, variance=True)
+    # only the windows of the new granules change, the late one's included
+    assert touched["daily"] == {np.datetime64("2024-05-01"), np.datetime64("2024-05-06")}
+    assert touched["hourly"] == {13, 15, 18}
+    # everything is folded, nothing is added twice
+    assert not any(update_store(granules, store, output, fmt=fmt, variance=True).values())
+
+    assert sorted(expected) == sorted(AGGREGATIONS)
+    for name, path in expected.items():
+        engine = "zarr" if fmt == "zarr" else "h5netcdf"
+        with xr.open_dataset(path, engine=engine) as a, xr.open_dataset(output / path.name, engine=engine) as b:
+            assert list(a.data_vars) == list(b.data_vars)
+            for var in a.data_vars:
+                np.testing.assert_array_equal(a[var][a[var].dims[0]], b[var][b[var].dims[0]])
+                np.testing.assert_allclose(a[var].values, b[var].values, rtol=1e-10, err_msg=f"{name} {var}")
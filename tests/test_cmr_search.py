@@ -0,0 +1,159 @@
+"""
+cmr_search against a local stand-in for the CMR granule search
+"""
+
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from cmr_search import DATA_LINK, SETTLE_TIME, format_cmr_time, parse_cmr_time, search_granules
+
+CONCEPT_ID = "C0000000001-LARC_CLOUD"
+PAGE_SIZE = 5
+DAYS = 5
+
+
+def make_granules(first_day: datetime) -> list[dict]:
+    """
+    12 one-hour scans a day starting at 01:30; the 23:30 scan runs into the
+    next day, so it belongs to two day windows
+    """
+    granules = []
+    for i in range(DAYS * 12):
+        start = first_day + timedelta(hours=1.5 + 2 * i)
+        name = f"TEMPO_NO2_L3_V03_{start:%Y%m%dT%H%M%S}Z_S{i % 12 + 1:03d}.nc"
+        granules.append(
+            {
+                "time_start": start.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                "time_end": (start + timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                "granule_size": "1.5",
+                "links": [
+                    {"href": f"https://data.asdc.earthdata.nasa.gov/{DATA_LINK}/TEMPO/{name}"},
+                    {"href": f"https://opendap.earthdata.nasa.gov/{name}.html"},
+                ],
+            }
+        )
+    return granules
+
+
+class CMRServer(ThreadingHTTPServer):
+    """
+    Answers temporal granule searches from `granules`, paged by page_size
+    with an opaque CMR-Search-After token, and records every request
+    """
+
+    def __init__(self, granules):
+        super().__init__(("127.0.0.1", 0), CMRHandler)
+        self.granules = granules
+        self.requests = []
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/search/granules"
+
+
+class CMRHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        start, end = map(parse_cmr_time, params["temporal"][0].split(","))
+        page_size = int(params["page_size"][0])
+        after = self.headers.get("CMR-Search-After")
+        self.server.requests.append((start, end, after))
+
+        matches = [
+            g
+            for g in sorted(self.server.granules, key=lambda g: g["time_start"])
+            if parse_cmr_time(g["time_start"]) <= end and parse_cmr_time(g["time_end"]) >= start
+        ]
+        offset = int(json.loads(after)[0]) if after else 0
+        page = matches[offset : offset + page_size]
+        body = json.dumps({"feed": {"entry": page}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if page:
+            self.send_header("CMR-Search-After", json.dumps([str(offset + len(page)), "TEMPO"]))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def cmr():
+    now = datetime.now(tz=timezone.utc)
+    first_day = now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=DAYS - 1)
+    server = CMRServer(make_granules(first_day))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server, first_day, now
+    server.shutdown()
+    server.server_close()
+
+
+def expected_urls(server, start, end):
+    return sorted(
+        g["links"][0]["href"]
+        for g in server.granules
+        if g["time_start"] <= format_cmr_time(end) and parse_cmr_time(g["time_end"]) >= start
+    )
+
+
+def test_pages_through_every_day(cmr):
+    server, first_day, _ = cmr
+    start, end = first_day + timedelta(hours=6), first_day + timedelta(days=DAYS, seconds=-1)
+    granules = search_granules(CONCEPT_ID, start, end, index_path=None, cmr_url=server.url, page_size=PAGE_SIZE)
+
+    urls = [g.url for g in granules]
+    assert len(urls) == len(set(urls))
+    assert sorted(urls) == expected_urls(server, start, end)
+    assert [g.time_start for g in granules] == sorted(g.time_start for g in granules)
+    assert all(g.size_mb == 1.5 for g in granules)
+
+    # one query per whole day, each following the search-after token past the first page
+    days = [s for s, _, after in server.requests if after is None]
+    assert sorted(days) == [first_day + timedelta(days=i) for i in range(DAYS)]
+    assert any(after is not None for _, _, after in server.requests)
+
+
+def test_second_run_only_queries_unsettled_days(cmr, tmp_path):
+    server, first_day, now = cmr
+    start, end = first_day, first_day + timedelta(days=DAYS, seconds=-1)
+    index = tmp_path / "cmr_index.sqlite"
+
+    first = search_granules(CONCEPT_ID, start, end, index_path=index, cmr_url=server.url, page_size=PAGE_SIZE)
+    assert sorted(g.url for g in first) == expected_urls(server, start, end)
+
+    server.requests.clear()
+    second = search_granules(CONCEPT_ID, start, end, index_path=index, cmr_url=server.url, page_size=PAGE_SIZE)
+    assert second == first
+
+    unsettled = [
+        first_day + timedelta(days=i) for i in range(DAYS) if first_day + timedelta(days=i + 1) + SETTLE_TIME >= now
+    ]
+    assert 0 < len(unsettled) < DAYS
+    queried = {s.replace(hour=0, minute=0, second=0) for s, _, after in server.requests if after is None}
+    assert queried == set(unsettled)
+    # and only from the newest granule already stored for the day
+    for query_start, _, after in server.requests:
+        if after is None:
+            assert query_start == query_start.replace(hour=23, minute=30)
+
+
+def test_new_granules_are_picked_up(cmr, tmp_path):
+    server, first_day, _ = cmr
+    start, end = first_day, first_day + timedelta(days=DAYS, seconds=-1)
+    index = tmp_path / "cmr_index.sqlite"
+    late = server.granules.pop()
+
+    first = search_granules(CONCEPT_ID, start, end, index_path=index, cmr_url=server.url, page_size=PAGE_SIZE)
+    server.granules.append(late)
+    second = search_granules(CONCEPT_ID, start, end, index_path=index, cmr_url=server.url, page_size=PAGE_SIZE)
+
+    assert len(second) == len(first) + 1
+    assert second[-1].url == late["links"][0]["href"]
+    assert len({g.url for g in second}) == len(second)
@@ -0,0 +1,45 @@
+"""
+--float32 renders the same images as the float64 data path
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from benchmarks import write_synthetic_file
+from process_data import level_directory, process_and_save_arrays, read_granule
+from tempo_process_funcs import datetime64_to_fname, get_bounds, svs_tempo_cmap
+
+NAME = "TEMPO_NO2_L3_V03_20240501T120000Z_S001.nc"
+
+
+def render(granule: Path, output: Path, dtype, pyramid: bool) -> list[bytes]:
+    no2, cloud, _ = read_granule(str(granule), "svs", dtype)
+    left, right, bottom, top = get_bounds(no2.isel(time=0))
+    time = no2.time.values[0]
+    process_and_save_arrays(
+        no2.values[0],
+        cloud.values[0],
+        time,
+        svs_tempo_cmap,
+        0.01,
+        1.5,
+        output,
+        "",
+        [(bottom, left), (top, right)],
+        pyramid=pyramid,
+        levels=2,
+        dtype=dtype,
+    )
+    return [(level_directory(output, level) / datetime64_to_fname(time)).read_bytes() for level in range(2)]
+
+
+@pytest.mark.parametrize("pyramid", [False, True])
+def test_float32_images_unchanged(tmp_path, pyramid):
+    granule = tmp_path / NAME
+    write_synthetic_file(str(granule), scale=8)
+    expected = render(granule, tmp_path / "float64", np.float64, pyramid)
+    result = render(granule, tmp_path / "float32", np.float32, pyramid)
+    for level, (a, b) in enumerate(zip(expected, result)):
+        assert a == b, f"level {level} differs"
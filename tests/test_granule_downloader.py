@@ -0,0 +1,169 @@
+"""
+granule_downloader against a local stand-in for the data server
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import granule_downloader
+from granule_downloader import PART_SUFFIX, PermanentDownloadError, download_file, make_session
+
+PAYLOAD = bytes(range(256)) * 4096  # 1 MiB
+NAME = "TEMPO_NO2_L3_V03_20240501T120000Z_S001.nc"
+# a dropped connection loses the chunk being read, keep them smaller than the drops
+CHUNK = 2**14
+
+
+class FlakyServer(ThreadingHTTPServer):
+    """
+    Serves PAYLOAD at /<NAME>, honouring Range requests. The first `drops`
+    responses announce the whole body but close the connection halfway.
+    """
+
+    def __init__(self, drops=0, status=None, ignore_range=False):
+        super().__init__(("127.0.0.1", 0), FlakyHandler)
+        self.drops = drops
+        self.status = status
+        self.ignore_range = ignore_range
+        self.ranges = []
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/data/{NAME}"
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        header = self.headers.get("Range")
+        server.ranges.append(header)
+        if server.status is not None:
+            self.send_error(server.status)
+            return
+        start = 0
+        if header is not None and not server.ignore_range:
+            start = int(header.split("=")[1].split("-")[0])
+            if start >= len(PAYLOAD):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(PAYLOAD)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(PAYLOAD) - 1}/{len(PAYLOAD)}")
+        else:
+            self.send_response(200)
+        body = PAYLOAD[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if server.drops > 0:
+            server.drops -= 1
+            self.wfile.write(body[: len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(**kwargs):
+        server = FlakyServer(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    waits = []
+    monkeypatch.setattr(granule_downloader.time, "sleep", waits.append)
+    return waits
+
+
+def test_resumes_after_dropped_connection(serve, sleeps, tmp_path):
+    server = serve(drops=2)
+    path, received = download_file(make_session(1), server.url, tmp_path, retries=3, backoff=1.5, chunk_bytes=CHUNK)
+
+    assert path == tmp_path / NAME
+    assert path.read_bytes() == PAYLOAD
+    assert received == len(PAYLOAD)
+    assert not (tmp_path / (NAME + PART_SUFFIX)).exists()
+    # each retry asks only for what is still missing
+    half, quarter = len(PAYLOAD) // 2, len(PAYLOAD) // 4
+    assert server.ranges == [None, f"bytes={half}-", f"bytes={half + quarter}-"]
+    assert sleeps == [1.5, 3.0]
+
+
+def test_resumes_part_file_from_earlier_run(serve, sleeps, tmp_path):
+    server = serve()
+    (tmp_path / (NAME + PART_SUFFIX)).write_bytes(PAYLOAD[:1000])
+    path, received = download_file(make_session(1), server.url, tmp_path)
+
+    assert path.read_bytes() == PAYLOAD
+    assert received == len(PAYLOAD) - 1000
+    assert server.ranges == ["bytes=1000-"]
+    assert not (tmp_path / (NAME + PART_SUFFIX)).exists()
+
+
+def test_complete_part_file_is_finished_on_416(serve, sleeps, tmp_path):
+    server = serve()
+    (tmp_path / (NAME + PART_SUFFIX)).write_bytes(PAYLOAD)
+    path, received = download_file(make_session(1), server.url, tmp_path)
+
+    assert path.read_bytes() == PAYLOAD
+    assert received == 0
+    assert server.ranges == [f"bytes={len(PAYLOAD)}-"]
+    assert not (tmp_path / (NAME + PART_SUFFIX)).exists()
+    assert sleeps == []
+
+
+def test_part_file_longer_than_the_file_restarts(serve, sleeps, tmp_path):
+    server = serve()
+    (tmp_path / (NAME + PART_SUFFIX)).write_bytes(PAYLOAD + b"stale")
+    path, _ = download_file(make_session(1), server.url, tmp_path, backoff=0)
+
+    assert path.read_bytes() == PAYLOAD
+    assert server.ranges == [f"bytes={len(PAYLOAD) + 5}-", None]
+
+
+def test_server_ignoring_range_rewrites_the_file(serve, sleeps, tmp_path):
+    server = serve(ignore_range=True)
+    (tmp_path / (NAME + PART_SUFFIX)).write_bytes(b"x" * 1000)
+    path, _ = download_file(make_session(1), server.url, tmp_path)
+
+    assert path.read_bytes() == PAYLOAD
+
+
+def test_permanent_error_is_not_retried(serve, sleeps, tmp_path):
+    server = serve(status=404)
+    with pytest.raises(PermanentDownloadError):
+        download_file(make_session(1), server.url, tmp_path, retries=3)
+
+    assert server.ranges == [None]
+    assert sleeps == []
+    assert not (tmp_path / NAME).exists()
+
+
+def test_gives_up_after_retries_and_keeps_part_file(serve, sleeps, tmp_path):
+    server = serve(drops=10)
+    with pytest.raises(Exception):
+        download_file(make_session(1), server.url, tmp_path, retries=2, backoff=1, chunk_bytes=CHUNK)
+
+    assert len(server.ranges) == 3
+    assert sleeps == [1, 2]
+    assert not (tmp_path / NAME).exists()
+    # the next run picks up from here
+    assert (tmp_path / (NAME + PART_SUFFIX)).stat().st_size > 0
@@ -0,0 +1,77 @@
+"""
+granule_inventory scan, missing and backlog on a temporary data tree
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+import granule_inventory
+from granule_inventory import SUBSET_DIRECTORY, GranuleInventory
+
+
+def touch(path: Path, content: bytes = b"granule") -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return path
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """
+    Two data folders, one subsetted, and an image folder with the first scan's image
+    """
+    day1 = tmp_path / "2024.05.01"
+    day2 = tmp_path / "2024.05.02"
+    files = {
+        "early": touch(day1 / SUBSET_DIRECTORY / "TEMPO_NO2_L3_V03_20240501T120000Z_S001.nc"),
+        "late": touch(day1 / SUBSET_DIRECTORY / "TEMPO_NO2_L3_V03_20240501T130530Z_S002.nc"),
+        "next_day": touch(day2 / "TEMPO_NO2_L3_V03_20240502T120000Z_S001.nc"),
+        "image": touch(tmp_path / "images" / "tempo_2024-05-01T12h00m.png", b"png"),
+    }
+    touch(day1 / "notes.txt", b"not a granule")
+    return tmp_path, files
+
+
+def test_scan_missing_backlog(tree):
+    root, files = tree
+    images = root / "images"
+    with GranuleInventory(root / "inventory.sqlite") as inventory:
+        assert inventory.scan(root) == (4, 0)
+        assert inventory.missing_images("2024-05-01", images) == [str(files["late"])]
+        assert inventory.missing_images("2024-05-02", images) == [str(files["next_day"])]
+        # the subsetted granules belong to the day folder above subsetted_netcdf
+        assert inventory.backlog(images) == [root / "2024.05.01", root / "2024.05.02"]
+        assert inventory.granules(files["late"].parent, "*_S002.nc") == [str(files["late"])]
+
+        # an image for the scan's minute clears it, one elsewhere does not
+        touch(images / "tempo_2024-05-01T13h05m.png", b"png")
+        touch(root / "other" / "tempo_2024-05-02T12h00m.png", b"png")
+        files["next_day"].unlink()
+        assert inventory.scan(root) == (5, 1)
+        assert inventory.missing_images(image_directory=images) == []
+        assert inventory.backlog(images) == []
+        assert inventory.find_granule(files["next_day"].name) is None
+
+
+def test_rescan_keeps_checksums(tree, monkeypatch):
+    root, files = tree
+    with GranuleInventory(root / "inventory.sqlite") as inventory:
+        inventory.scan(root)
+        # unchanged files are not fingerprinted again
+        monkeypatch.setattr(granule_inventory, "file_fingerprint", lambda path: pytest.fail(f"rehashed {path}"))
+        inventory.scan(root)
+
+
+def test_backlog_command(tree, monkeypatch, capsys):
+    root, _ = tree
+    monkeypatch.chdir(root)
+    database = str(root / "inventory.sqlite")
+    for argv in (["scan", str(root)], ["backlog", "--image-dir", "images"]):
+        monkeypatch.setattr(sys, "argv", ["granule_inventory.py", "--inventory", database, *argv])
+        granule_inventory.main()
+    # folders under the working directory are printed relative to it, and
+    # nothing is written besides the database
+    assert capsys.readouterr().out.split() == ["2024.05.01", "2024.05.02"]
+    assert not (root / "backlog").exists()
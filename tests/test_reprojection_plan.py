@@ -0,0 +1,64 @@
+"""
+Reprojection plans against a GDAL warp on grids other than the full TEMPO grid
+"""
+
+import numpy as np
+import pytest
+
+import reprojection_plan
+from benchmarks import TEMPO_STEP, synthetic_granule
+from tempo_process_funcs import project_array
+
+
+@pytest.fixture(autouse=True)
+def no_plan_cache(monkeypatch):
+    monkeypatch.setattr(reprojection_plan, "PLAN_CACHE_DIR", None)
+    monkeypatch.setattr(reprojection_plan, "_plans", {})
+
+
+def crop(scale, rows, cols):
+    """
+    A window of the synthetic granule, like subset_tempo_data --bbox gives
+    """
+    array, [(lat_min, lon_min), _] = synthetic_granule(scale, seed=scale)
+    step = TEMPO_STEP * scale
+    bounds = [
+        (lat_min + rows.start * step, lon_min + cols.start * step),
+        (lat_min + rows.stop * step, lon_min + cols.stop * step),
+    ]
+    return array[rows, cols], bounds
+
+
+GRIDS = {
+    # sizes that do not divide evenly, so the last destination pixel runs past the grid
+    "scale 4 half level": (4, slice(0, 737), slice(0, 1937), 0.5),
+    "scale 8": (8, slice(0, 368), slice(0, 968), 1),
+    "scale 8 half level": (8, slice(0, 368), slice(0, 968), 0.5),
+    "crop": (4, slice(101, 398), slice(333, 1021), 1),
+    "crop half level": (4, slice(101, 398), slice(333, 1021), 0.5),
+}
+
+
+@pytest.mark.parametrize("method", ["average", "nearest"])
+@pytest.mark.parametrize("projection", ["EPSG:3857", "EPSG:4326"])
+@pytest.mark.parametrize("grid", list(GRIDS))
+def test_plan_matches_gdal(grid, projection, method):
+    scale, rows, cols, refinement = GRIDS[grid]
+    array, bounds = crop(scale, rows, cols)
+    expected = project_array(array, bounds, refinement, projection, method, use_plan=False)
+    result = project_array(array, bounds, refinement, projection, method, use_plan=True)
+
+    assert result.shape == expected.shape
+    np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+    valid = ~np.isnan(expected)
+    np.testing.assert_allclose(result[valid], expected[valid], rtol=0, atol=1e-9)
+
+
+def test_plan_tables_match_gdal_at_the_edges():
+    # each column holds its index, so the last destination column is the
+    # weighted mean of the source columns under it
+    array, bounds = crop(4, slice(0, 737), slice(0, 1937))
+    index = np.broadcast_to(np.arange(array.shape[1], dtype=float), array.shape).copy()
+    expected = project_array(index, bounds, 0.5, method="average", use_plan=False)
+    result = project_array(index, bounds, 0.5, method="average", use_plan=True)
+    np.testing.assert_allclose(result[:, -1], expected[:, -1], rtol=0, atol=1e-9)
@@ -0,0 +1,51 @@
+"""
+--skip-existing still writes text files covering every granule
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+import process_data
+from benchmarks import write_synthetic_file
+from tempo_process_funcs import datetime64_to_fname, fname_to_datetime64
+
+NAMES = [f"TEMPO_NO2_L3_V03_20240501T{hour:02d}0000Z_S001.nc" for hour in (12, 13, 14)]
+
+
+def run(monkeypatch, data: Path, output: Path, *extra: str) -> dict[str, str]:
+    """
+    Run process_data.py and return the text files it wrote, by kind
+    """
+    for path in output.rglob("*_t_*"):
+        path.unlink()
+    argv = ["process_data.py", "-d", str(data), "-v", "3", "-n", "t", "--levels", "1", "--executor", "serial"]
+    argv += ["-o", str(output / "no2"), "--do-clouds", "--cloud-dir", str(output / "clouds"), *extra]
+    monkeypatch.setattr(sys, "argv", argv + ["--config", str(data / "none.yaml")])
+    process_data.main()
+    texts = {}
+    for layer in ("no2", "clouds"):
+        for kind, pattern in [("times", "times_t_*"), ("bounds", "bounds_t_[0-9]*"), ("fors", "bounds_t_geojson_*")]:
+            (path,) = (output / layer).glob(pattern)
+            texts[f"{layer}/{kind}"] = path.read_text()
+    return texts
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_skip_existing_text_files_complete(tmp_path, monkeypatch, stream):
+    data = tmp_path / "data"
+    data.mkdir()
+    for i, name in enumerate(NAMES):
+        write_synthetic_file(str(data / name), scale=8, seed=i, time=str(fname_to_datetime64(name)))
+    extra = ["--stream"] if stream else []
+    expected = run(monkeypatch, data, tmp_path / "out", *extra)
+
+    # the last granule's images are missing, so only it is rendered again
+    missing = datetime64_to_fname(fname_to_datetime64(NAMES[-1]))
+    for layer in ("no2", "clouds"):
+        (tmp_path / "out" / layer / missing).unlink()
+    result = run(monkeypatch, data, tmp_path / "out", "--skip-existing", *extra)
+
+    assert (tmp_path / "out" / "no2" / missing).exists()
+    assert result == expected
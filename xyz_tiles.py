@@ -0,0 +1,262 @@
+"""
+Cut reprojected frames into XYZ (slippy map) tiles.
+
+A full-frame PNG covers the whole TEMPO field of regard, so a viewer zoomed
+into one city still downloads the entire multi-megabyte image. Here a Web
+Mercator frame is resampled onto the standard 256 px tile grid of every zoom
+in a range and written as {z}/{x}/{y}.png, so a client only fetches the tiles
+in view. Tiles with no data at all (outside the scan, or fully clouded) are
+not written and map clients show nothing for a missing tile.
+
+The frame and the tile grid are both Web Mercator and axis-aligned, so like a
+ReprojectionPlan the resampling is one sparse weight table per axis, built
+once per zoom and frame geometry. Each tile pixel is the coverage weighted
+mean of the valid frame pixels under it, and is left transparent when less
+than half of it is covered by valid data.
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+from scipy import sparse
+
+from colormap import colormap_palette
+from logger import setup_logging
+from png_encoder import encode_png
+from reprojection_plan import _coverage_weights, _destination_grid
+from tempo_process_funcs import colormap_indices, colormap_rgba
+
+logger = setup_logging(debug=False, name="xyz_tiles")
+
+TILE_SIZE = 256
+EARTH_RADIUS = 6378137.0
+# half the width of the Web Mercator world, in metres
+ORIGIN = np.pi * EARTH_RADIUS
+DEFAULT_WORKERS = 4
+# a tile pixel needs at least this fraction of valid data under it
+MIN_COVERAGE = 0.5
+TILEJSON_NAME = "tiles.json"
+# zlib level 9 takes ten times as long as 6 on a tile for about 10% fewer bytes
+TILE_COMPRESSION_LEVEL = 6
+
+
+class ZoomGrid(NamedTuple):
+    """
+    Resampling of one frame onto the tiles of one zoom that it touches
+
+    wx, wy: (tile pixels, frame pixels) normalised coverage weights
+    x0, y0: first tile column and row
+    ncols, nrows: number of tile columns and rows
+    """
+
+    wx: sparse.csr_matrix
+    wy: sparse.csr_matrix
+    x0: int
+    y0: int
+    ncols: int
+    nrows: int
+
+
+def frame_extent(bounds, shape) -> tuple[float, float, float, float]:
+    """
+    Web Mercator extent of a full resolution frame from reproject_bands, taken
+    from the same transform project_array gives GDAL
+
+    :arg bounds: [(lat_min, lon_min), (lat_max, lon_max)] the frame was reprojected from
+    :arg shape: (height, width) of the frame
+    returns: (x_min, y_min, x_max, y_max) in metres
+    """
+    transform, height, width = _destination_grid(bounds, shape, 1, "EPSG:3857")
+    x_min, y_max = transform * (0, 0)
+    x_max, y_min = transform * (width, height)
+    return float(x_min), float(y_min), float(x_max), float(y_max)
+
+
+def native_zoom(extent, shape) -> int:
+    """
+    Zoom whose tile pixels are closest in size to the frame's pixels
+    """
+    x_min, _, x_max, _ = extent
+    resolution = (x_max - x_min) / shape[1]
+    return max(0, int(round(np.log2(2 * ORIGIN / (TILE_SIZE * resolution)))))
+
+
+def default_zooms(extent, shape) -> tuple[int, int]:
+    """
+    Four zooms of overview below the native zoom, plus the native zoom
+    """
+    zoom = native_zoom(extent, shape)
+    return max(0, zoom - 4), zoom
+
+
+def _axis_weights(start: float, stop: float, n_frame: int, pixel: float, n_world: int):
+    """
+    Weights from frame pixels to the tile pixels covering [start, stop], all
+    in world pixel units of the zoom (0 at the left / top of the map).
+
+    returns: (weights csr (tile pixels, n_frame), first tile index, number of tiles)
+    """
+    first = max(0, int(np.floor(start / TILE_SIZE)))
+    last = min(n_world // TILE_SIZE, int(np.ceil(stop / TILE_SIZE)))
+    n_tiles = max(0, last - first)
+    # tile pixel edges in frame pixel coordinates
+    edges = (first * TILE_SIZE + np.arange(n_tiles * TILE_SIZE + 1) - start) / pixel
+    dst, src, weight = _coverage_weights(edges, n_frame)
+    weights = sparse.csr_matrix((weight, (dst, src)), shape=(n_tiles * TILE_SIZE, n_frame))
+    # each tile pixel becomes the mean over the part of it the frame covers
+    total = np.asarray(weights.sum(axis=1)).ravel()
+    norm = np.divide(1, total, out=np.zeros_like(total), where=total > 0)
+    return (sparse.diags(norm) @ weights).tocsr(), first, n_tiles
+
+
+@lru_cache(maxsize=64)
+def zoom_grid(extent: tuple, shape: tuple, zoom: int) -> ZoomGrid:
+    """
+    Weight tables mapping a frame with this extent and shape onto the tiles of zoom
+    """
+    x_min, y_min, x_max, y_max = extent
+    height, width = shape
+    n_world = TILE_SIZE * 2**zoom
+    metres = 2 * ORIGIN / n_world
+    wx, x0, ncols = _axis_weights(
+        (x_min + ORIGIN) / metres, (x_max + ORIGIN) / metres, width, (x_max - x_min) / metres / width, n_world
+    )
+    # rows count down from the top of the map and of the frame
+    wy, y0, nrows = _axis_weights(
+        (ORIGIN - y_max) / metres, (ORIGIN - y_min) / metres, height, (y_max - y_min) / metres / height, n_world
+    )
+    logger.debug(f"Zoom {zoom}: {ncols} x {nrows} tiles from x={x0}, y={y0}")
+    return ZoomGrid(wx, wy, x0, y0, ncols, nrows)
+
+
+def encode_tile(
+    tile: np.ndarray, cmap, vmin: float, vmax: float, compression_level: int = TILE_COMPRESSION_LEVEL
+) -> bytes:
+    """
+    Colormap one tile and encode it the way save_image does the full frame:
+    an indexed PNG when the colormap fits in a palette, RGBA otherwise
+    """
+    try:
+        palette, level_to_index = colormap_palette(cmap)
+    except ValueError:
+        return encode_png(colormap_rgba(tile, cmap, vmin, vmax), compression_level=compression_level)
+    indices = level_to_index[colormap_indices(tile, vmin, vmax, len(level_to_index) - 3)]
+    return encode_png(indices, palette=palette, compression_filter=0, compression_level=compression_level)
+
+
+def stack_valid(frame: np.ndarray) -> np.ndarray:
+    """
+    (height, 2 * width) frame with NaN set to 0 next to its valid pixel mask,
+    so values and valid fraction go through the same products side by side
+    """
+    valid = np.isfinite(frame)
+    return np.hstack([np.where(valid, frame, 0), valid]).astype(np.float64)
+
+
+def tile_rows(stacked: np.ndarray, grid: ZoomGrid):
+    """
+    Resample a frame onto one row of tiles at a time, so a high zoom is never
+    held in memory whole.
+
+    :arg stacked: the frame as returned by stack_valid
+    yields: (tile row y, (TILE_SIZE, ncols * TILE_SIZE) array, NaN where there is no data)
+    """
+    for row in range(grid.nrows):
+        strip = grid.wy[row * TILE_SIZE : (row + 1) * TILE_SIZE] @ stacked
+        # (TILE_SIZE, 2 * width) -> (2 * TILE_SIZE, width)
+        strip = np.concatenate(np.split(strip, 2, axis=1))
+        total, coverage = np.split((grid.wx @ strip.T).T, 2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            yield grid.y0 + row, np.where(coverage >= MIN_COVERAGE, total / coverage, np.nan)
+
+
+def save_tiles(
+    frame: np.ndarray,
+    bounds,
+    cmap,
+    vmin: float,
+    vmax: float,
+    directory: Path | str,
+    zooms: tuple[int, int] | None = None,
+    workers: int = DEFAULT_WORKERS,
+    overwrite=False,
+    compression_level: int = TILE_COMPRESSION_LEVEL,
+) -> tuple[int, int]:
+    """
+    Write a Web Mercator frame as directory/{z}/{x}/{y}.png tiles and a
+    TileJSON description. The TileJSON is written last, so its presence
+    means the timestep is complete.
+
+    :arg frame: (height, width) level 0 frame as returned by reproject_bands, NaN for no data
+    :arg bounds: [(lat_min, lon_min), (lat_max, lon_max)] the frame was reprojected from
+    :arg directory: tile directory for this timestep
+    :kwarg zooms: (min, max) zoom, both included; default from default_zooms
+    :kwarg workers: threads colormapping, encoding and writing tiles
+    :kwarg overwrite: rewrite tiles that already exist
+    :kwarg compression_level: zlib level of the tile PNGs
+    returns: (tiles written, bytes written)
+    """
+    directory = Path(directory)
+    tilejson = directory / TILEJSON_NAME
+    if not overwrite and tilejson.exists():
+        logger.debug(f"Tiles in {directory} already exist. Skipping creation.")
+        return 0, 0
+
+    extent = frame_extent(bounds, frame.shape)
+    if zooms is None:
+        zooms = default_zooms(extent, frame.shape)
+    stacked = stack_valid(frame)
+
+    def write(job):
+        path, tile = job
+        if not overwrite and path.exists():
+            return 0
+        data = encode_tile(tile, cmap, vmin, vmax, compression_level)
+        with open(path, "wb") as f:
+            f.write(data)
+        return len(data)
+
+    count, size, empty = 0, 0, 0
+    pending = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for zoom in range(zooms[0], zooms[1] + 1):
+            grid = zoom_grid(extent, tuple(frame.shape), zoom)
+            for y, strip in tile_rows(stacked, grid):
+                submitted = []
+                for col in range(grid.ncols):
+                    tile = strip[:, col * TILE_SIZE : (col + 1) * TILE_SIZE]
+                    if np.isnan(tile).all():
+                        empty += 1
+                        continue
+                    path = directory / str(zoom) / str(grid.x0 + col) / f"{y}.png"
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    submitted.append(pool.submit(write, (path, tile)))
+                # the previous row is encoded while this one was resampled,
+                # at most two rows of tiles are held at once
+                written = [future.result() for future in pending]
+                count += sum(1 for n in written if n)
+                size += sum(written)
+                pending = submitted
+        written = [future.result() for future in pending]
+        count += sum(1 for n in written if n)
+        size += sum(written)
+
+    (lat_min, lon_min), (lat_max, lon_max) = bounds
+    with open(tilejson, "w") as f:
+        json.dump(
+            {
+                "tilejson": "2.2.0",
+                "tiles": ["{z}/{x}/{y}.png"],
+                "minzoom": zooms[0],
+                "maxzoom": zooms[1],
+                "bounds": [float(lon_min), float(lat_min), float(lon_max), float(lat_max)],
+                "scheme": "xyz",
+            },
+            f,
+        )
+    logger.debug(f"Wrote {count} tiles ({size / 2**20:.1f} MB) to {directory}, skipped {empty} empty tiles")
+    return count, size